@@ -0,0 +1,66 @@
+"""Compare the header-only exif reader with parsing the complete file with exif.Image.
+
+Usage: python bench_exif_header.py [amount] [image_size]
+"""
+
+import io
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from exif_header import read_exif_header
+from photo_renamer import PhotoRenamer
+from synthetic_library import write_corpus
+
+
+class CountingReader(io.RawIOBase):
+    """Raw file wrapper that counts the number of bytes read."""
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def readinto(self, buffer):
+        count = self.raw.readinto(buffer)
+        self.bytes_read += count or 0
+        return count
+
+
+def run(paths, reader) -> tuple:
+    """Run reader on every path, return (seconds, bytes read)."""
+    bytes_read = 0
+    start = perf_counter()
+    for path in paths:
+        counter = CountingReader(open(path, 'rb', buffering=0))
+        with io.BufferedReader(counter) as src_file:
+            reader(src_file)
+        bytes_read += counter.bytes_read
+    return perf_counter() - start, bytes_read
+
+
+def main(amount: int = 200, image_size: int = 3_000_000) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_corpus(tmp_dir, amount, image_size)
+        total_size = sum(os.path.getsize(path) for path in paths)
+        print(f'Corpus: {amount} files, {total_size / amount / 1e6:.1f} MB per file')
+        for name, reader in (('exif.Image', PhotoRenamer.read_exif_full),
+                             ('header only', read_exif_header)):
+            seconds, bytes_read = run(paths, reader)
+            print(f'{name:>12}: {amount / seconds:8.0f} files/s, '
+                  f'{bytes_read / amount:10.0f} bytes read per file')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,207 @@
+"""Run the complete sort_them pipeline on a synthetic library and report how fast it was.
+
+Usage: python benchmark.py [options], see python benchmark.py --help.
+
+Every invocation generates a library (the same arguments and seed give the same library), runs
+main_operation (or async_main_operation) on it and prints a json line (the last line of the
+output) with files/s, bytes read and read/write syscalls per file (from /proc/self/io, Linux
+only), peak RSS and the stage timings. With --latency-ms every file system call made during the
+run sleeps first, to mimic a network mount.
+
+Memory use should not depend on the size of the library: run_peak_rss_mb is the peak RSS during
+the run only (without generating the library; Linux only), and with --rss-budget-mb the exit
+status is 1 if it is higher than the budget, i.e.
+python benchmark.py --files 1000000 --image-size 200 --depth 3 --rss-budget-mb 64
+"""
+
+import argparse
+import asyncio
+import builtins
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+from contextlib import contextmanager
+from time import perf_counter, sleep
+from typing import Dict, Iterator, Union
+
+import mover
+import sort_them
+from get_arguments import parse_limit
+from metadata_cache import MetadataCache
+from synthetic_library import generate_library
+
+LATENCY_FUNCTIONS = ('stat', 'lstat', 'scandir', 'rename', 'link', 'remove', 'mkdir', 'listdir')
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak RSS of this process to the current RSS (Linux only).
+
+    Returns:
+        bool: False if not supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def read_peak_rss_mb() -> Union[float, None]:
+    """Peak RSS of this process since the last reset_peak_rss, in MB (None if not available)."""
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_proc_io() -> Union[Dict[str, int], None]:
+    """Read I/O counters of this process (None if not available)."""
+    try:
+        with open('/proc/self/io') as file:
+            return {key: int(value) for key, value in (line.split(': ') for line in file)}
+    except OSError:
+        return None
+
+
+@contextmanager
+def added_latency(latency_s: float) -> Iterator[None]:
+    """Make open(), the os file system functions and the renameat2 call of mover sleep latency_s
+    before every call."""
+    if not latency_s:
+        yield
+        return
+
+    def slow(function):
+        def wrapper(*args, **kwargs):
+            sleep(latency_s)
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    originals = {name: getattr(os, name) for name in LATENCY_FUNCTIONS}
+    original_open = builtins.open
+    original_renameat2 = mover._renameat2  # called through ctypes, not through os
+    try:
+        for name, function in originals.items():
+            setattr(os, name, slow(function))
+        builtins.open = slow(original_open)
+        if original_renameat2 is not None:
+            mover._renameat2 = slow(original_renameat2)
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(os, name, function)
+        builtins.open = original_open
+        mover._renameat2 = original_renameat2
+
+
+def run(args: argparse.Namespace) -> dict:
+    """Generate the library, run the pipeline and collect the results."""
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        src_path = os.path.join(tmp_dir, 'src')
+        target_path = os.path.join(tmp_dir, 'target')
+        kinds = generate_library(src_path, args.files, args.depth, args.fanout,
+                                 args.files_per_dir, args.jpeg_share, args.whatsapp_share,
+                                 args.no_exif_share, args.burst_share, args.mismatch_share,
+                                 args.image_size, args.seed)
+
+        os.chdir(tmp_dir)  # doubles.list, cache and logs end up in the temporary directory
+        logger = logging.getLogger(sort_them.LOG_NAME)
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.FileHandler(os.path.join(tmp_dir, sort_them.LOG_FILENAME)))
+        sort_them.PROCESS_DOUBLES = args.process_doubles
+        sort_them.DT_AND_DT_ORIG_NEED_TO_MATCH = args.require_dt_match
+        cache = MetadataCache(sort_them.METADATA_CACHE_FILENAME) if args.cache else None
+
+        peak_reset = reset_peak_rss()
+        io_before = read_proc_io()
+        start = perf_counter()
+        with added_latency(args.latency_ms / 1000):
+            if args.mode == 'async':
+                asyncio.run(
+                    sort_them.async_main_operation(src_path, target_path, logger, cache=cache,
+                                                   limits=dict(args.limits)))
+            else:
+                sort_them.main_operation(src_path, target_path, logger, jobs=args.jobs,
+                                         cache=cache)
+        seconds = perf_counter() - start
+        io_after = read_proc_io()
+        run_peak_rss_mb = read_peak_rss_mb() if peak_reset else None
+        if cache:
+            cache.close()
+        os.chdir(args.cwd)
+
+    result = {
+        'mode': args.mode,
+        'jobs': args.jobs,
+        'files': args.files,
+        'latency_ms': args.latency_ms,
+        'seconds': round(seconds, 3),
+        'files_per_s': round(args.files / seconds, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'run_peak_rss_mb': round(run_peak_rss_mb, 1) if run_peak_rss_mb else None,
+        'library': kinds,
+        'counters': sort_them.files,
+        'stages': sort_them.metrics.summary(),
+    }
+    if io_before and io_after:
+        result['bytes_read_per_file'] = round((io_after['rchar'] - io_before['rchar']) /
+                                              args.files)
+        result['syscalls_per_file'] = round(
+            (io_after['syscr'] + io_after['syscw'] - io_before['syscr'] - io_before['syscw']) /
+            args.files, 1)
+    return result
+
+
+def get_benchmark_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--files', type=int, default=2000, help='number of files (2000)')
+    parser.add_argument('--depth', type=int, default=2, help='directory levels (2)')
+    parser.add_argument('--fanout', type=int, default=10, help='subdirectories per level (10)')
+    parser.add_argument('--files-per-dir', type=int, default=100, help='files per directory (100)')
+    parser.add_argument('--jpeg-share', type=float, default=0.1, help='share of .jpeg files')
+    parser.add_argument('--whatsapp-share', type=float, default=0.1,
+                        help='share of WhatsApp IMG-YYYYMMDD-WAnnnn files')
+    parser.add_argument('--no-exif-share', type=float, default=0.05,
+                        help='share of files without exif data')
+    parser.add_argument('--burst-share', type=float, default=0.1,
+                        help='share of files in the same second as the previous one')
+    parser.add_argument('--mismatch-share', type=float, default=0.05,
+                        help='share of files with datetime != datetime_original')
+    parser.add_argument('--image-size', type=int, default=100_000, help='bytes per file')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mode', choices=('sequential', 'async'), default='sequential')
+    parser.add_argument('--jobs', type=int, default=1, help='threads reading exif (sequential)')
+    parser.add_argument('--limit', dest='limits', action='append', default=[],
+                        type=parse_limit, help='OPERATION=N for --mode async')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='added latency per file system call')
+    parser.add_argument('--cache', action='store_true', help='use a (new) metadata cache')
+    parser.add_argument('--process-doubles', action='store_true',
+                        help='give doubles a _COPY[n] name (PROCESS_DOUBLES)')
+    parser.add_argument('--require-dt-match', action='store_true',
+                        help='skip files with dt != dt_orig (DT_AND_DT_ORIG_NEED_TO_MATCH)')
+    parser.add_argument('--tmp-dir', help='where to create the library (default: system temp)')
+    parser.add_argument('--rss-budget-mb', type=float,
+                        help='exit with status 1 if the peak RSS of the run is higher')
+    args = parser.parse_args()
+    args.cwd = os.getcwd()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_benchmark_arguments()
+    result = run(args)
+    json.dump(result, sys.stdout)
+    print()
+    if args.rss_budget_mb and (result['run_peak_rss_mb'] or 0) > args.rss_budget_mb:
+        sys.exit(f'Peak RSS of the run ({result["run_peak_rss_mb"]} MB) is over the budget '
+                 f'of {args.rss_budget_mb} MB')
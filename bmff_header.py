@@ -0,0 +1,294 @@
+"""Seek-based metadata reader for ISO base media files: MP4/MOV videos and HEIC/HEIF pictures.
+
+These files are a sequence of boxes (size, type, payload). The reader jumps from box header to
+box header, so the media data (which can be several GB) is never read:
+- videos: creation time from moov/mvhd, model (and the local creation date, if present) from the
+  QuickTime metadata in moov/meta or moov/udta
+- HEIC: the Exif item, found through meta/iinf and meta/iloc, decoded with exif_header.parse_tiff
+
+The result has the same keys and format as exif_header.read_exif_header, so PhotoRenamer and the
+metadata cache treat both the same way.
+"""
+
+import io
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Dict, Iterator, Tuple, Union
+
+from exif_header import HeaderParseError, parse_tiff
+
+MAX_BOX_READ = 1024 * 1024  # boxes that are read completely (meta, udta, Exif item) are small
+MP4_EPOCH = datetime(1904, 1, 1, tzinfo=timezone.utc)
+EXIF_DT_FORMAT = '%Y:%m:%d %H:%M:%S'
+QUICKTIME_KEYS = {
+    'com.apple.quicktime.model': 'model',
+    'com.apple.quicktime.creationdate': 'creationdate',
+}
+UDTA_MODEL = b'\xa9mod'
+
+
+def iter_boxes(src_file: BinaryIO, start: int = 0,
+               end: Union[int, None] = None) -> Iterator[Tuple[bytes, int, int]]:
+    """Yield the boxes between start and end, only reading their headers.
+
+    Args:
+        src_file (BinaryIO): file (or BytesIO) opened in binary mode
+        start (int, optional): offset of the first box. Defaults to 0.
+        end (Union[int, None], optional): end of the parent box, None for the end of the file.
+                                          Defaults to None.
+
+    Raises:
+        HeaderParseError: if a box header is invalid
+
+    Yields:
+        Tuple[bytes, int, int]: box type, offset and size of the payload
+    """
+    offset = start
+    while end is None or offset + 8 <= end:
+        src_file.seek(offset)
+        header = src_file.read(8)
+        if len(header) < 8:
+            if end is None:
+                return  # end of file (or a file that is still being written)
+            raise HeaderParseError('Truncated box header')
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            large_size = src_file.read(8)
+            if len(large_size) < 8:
+                return
+            size = struct.unpack('>Q', large_size)[0]
+            header_size = 16
+        elif size == 0:
+            size = (end if end is not None else src_file.seek(0, io.SEEK_END)) - offset
+        if size < header_size:
+            raise HeaderParseError('Invalid box size')
+        yield box_type, offset + header_size, size - header_size
+        offset += size
+
+
+def read_payload(src_file: BinaryIO, offset: int, size: int) -> bytes:
+    """Read a complete box payload (at most MAX_BOX_READ bytes)."""
+    if size > MAX_BOX_READ:
+        raise HeaderParseError('Box too large to read')
+    src_file.seek(offset)
+    payload = src_file.read(size)
+    if len(payload) < size:
+        raise HeaderParseError('Truncated box')
+    return payload
+
+
+def read_bmff_header(src_file: BinaryIO) -> Dict[str, Union[str, None]]:
+    """Read the datetime, datetime_original and model of an MP4/MOV video or HEIC picture.
+
+    Args:
+        src_file (BinaryIO): File opened in binary mode.
+
+    Raises:
+        HeaderParseError: If the file is not an ISO base media file, or the boxes with the
+                          metadata are missing (i.e. a video that is still being recorded).
+
+    Returns:
+        Dict[str, Union[str, None]]: 'datetime', 'datetime_original' and 'model' (None if not
+                                     present), dates in exif format
+    """
+    boxes = iter_boxes(src_file)
+    first = next(boxes, None)
+    if first is None or first[0] not in (b'ftyp', b'moov', b'wide', b'free', b'mdat'):
+        raise HeaderParseError('Not an ISO base media file')
+    try:
+        for box_type, offset, size in [first, *boxes]:
+            if box_type == b'moov':
+                return read_moov(src_file, offset, size)
+            if box_type == b'meta':
+                return read_heif_meta(src_file, read_payload(src_file, offset, size))
+    except (struct.error, IndexError) as err:
+        raise HeaderParseError('Invalid box structure') from err
+    raise HeaderParseError('No moov or meta box')
+
+
+def read_moov(src_file: BinaryIO, offset: int, size: int) -> Dict[str, Union[str, None]]:
+    """Read the metadata of a video from its moov box."""
+    tags = {'datetime': None, 'datetime_original': None, 'model': None}
+    quicktime = {}
+    for box_type, child_offset, child_size in iter_boxes(src_file, offset, offset + size):
+        if box_type == b'mvhd':
+            tags['datetime'] = parse_mvhd(read_payload(src_file, child_offset,
+                                                       min(child_size, 32)))
+        elif box_type == b'meta':
+            quicktime.update(parse_quicktime_meta(read_payload(src_file, child_offset,
+                                                               child_size)))
+        elif box_type == b'udta':
+            udta = read_payload(src_file, child_offset, child_size)
+            for udta_type, udta_offset, udta_size in iter_boxes(io.BytesIO(udta), 0, len(udta)):
+                if udta_type == UDTA_MODEL and udta_size > 4:
+                    # text length, language code, text
+                    (length, ) = struct.unpack_from('>H', udta, udta_offset)
+                    quicktime.setdefault(
+                        'model', udta[udta_offset + 4:udta_offset + 4 + length].decode(
+                            'utf-8', 'replace'))
+
+    tags['model'] = quicktime.get('model')
+    if quicktime.get('creationdate'):
+        # local time of the recording (i.e. 2019-08-13T11:41:18+0200), mvhd only has UTC
+        try:
+            local = datetime.strptime(quicktime['creationdate'][:19], '%Y-%m-%dT%H:%M:%S')
+            tags['datetime'] = local.strftime(EXIF_DT_FORMAT)
+        except ValueError:
+            pass
+    tags['datetime_original'] = tags['datetime']
+    return tags
+
+
+def parse_mvhd(payload: bytes) -> Union[str, None]:
+    """Creation time of the movie header, converted to local time (None if not set).
+
+    Args:
+        payload (bytes): (start of the) mvhd payload
+
+    Returns:
+        Union[str, None]: creation time in exif format
+    """
+    if len(payload) < 12:
+        raise HeaderParseError('Truncated mvhd box')
+    if payload[0] == 1:
+        (seconds, ) = struct.unpack_from('>Q', payload, 4)
+    else:
+        (seconds, ) = struct.unpack_from('>I', payload, 4)
+    if not seconds:
+        return None
+    try:
+        utc = MP4_EPOCH + timedelta(seconds=seconds)
+    except OverflowError:
+        return None
+    return utc.astimezone().strftime(EXIF_DT_FORMAT)
+
+
+def parse_quicktime_meta(payload: bytes) -> Dict[str, str]:
+    """Decode the QUICKTIME_KEYS from a moov/meta box (keys and ilst children).
+
+    Args:
+        payload (bytes): meta payload
+
+    Returns:
+        Dict[str, str]: values found, by QUICKTIME_KEYS value
+    """
+    if payload[4:8] != b'hdlr':
+        payload = payload[4:]  # ISO meta is a full box (version and flags), QuickTime's is not
+    children = {box_type: (offset, size)
+                for box_type, offset, size in iter_boxes(io.BytesIO(payload), 0, len(payload))}
+    if b'keys' not in children or b'ilst' not in children:
+        return {}
+
+    keys = {}
+    offset, size = children[b'keys']
+    (count, ) = struct.unpack_from('>I', payload, offset + 4)
+    position = offset + 8
+    for index in range(1, count + 1):
+        key_size, _ = struct.unpack_from('>I4s', payload, position)
+        if key_size < 8:
+            raise HeaderParseError('Invalid QuickTime key')
+        key = payload[position + 8:position + key_size].decode('utf-8', 'replace')
+        if key in QUICKTIME_KEYS:
+            keys[struct.pack('>I', index)] = QUICKTIME_KEYS[key]
+        position += key_size
+
+    values = {}
+    offset, size = children[b'ilst']
+    ilst = io.BytesIO(payload)
+    for index, item_offset, item_size in iter_boxes(ilst, offset, offset + size):
+        if index not in keys:
+            continue
+        for data_type, data_offset, data_size in iter_boxes(ilst, item_offset,
+                                                            item_offset + item_size):
+            if data_type == b'data' and data_size >= 8:
+                # type indicator and locale, then the value
+                values[keys[index]] = payload[data_offset + 8:data_offset + data_size].decode(
+                    'utf-8', 'replace')
+    return values
+
+
+def read_heif_meta(src_file: BinaryIO, payload: bytes) -> Dict[str, Union[str, None]]:
+    """Find the Exif item of a HEIC/HEIF picture and decode it.
+
+    Args:
+        src_file (BinaryIO): the file, to read the Exif item from
+        payload (bytes): payload of the top level meta box
+
+    Returns:
+        Dict[str, Union[str, None]]: tags, all None if there is no Exif item
+    """
+    tags = {'datetime': None, 'datetime_original': None, 'model': None}
+    children = {box_type: (offset, size)
+                for box_type, offset, size in iter_boxes(io.BytesIO(payload), 4, len(payload))}
+    if b'iinf' not in children or b'iloc' not in children:
+        raise HeaderParseError('No iinf or iloc box in meta')
+    exif_id = find_exif_item(payload, *children[b'iinf'])
+    if exif_id is None:
+        return tags
+    extent = find_item_extent(payload, *children[b'iloc'], exif_id)
+    if extent is None:
+        raise HeaderParseError('Exif item has no location')
+    data = read_payload(src_file, *extent)
+    # the item starts with the offset of the TIFF header (after this 4 byte field)
+    (tiff_offset, ) = struct.unpack_from('>I', data, 0)
+    try:
+        parse_tiff(data[4 + tiff_offset:], tags)
+    except (struct.error, IndexError) as err:
+        raise HeaderParseError('Invalid TIFF structure in Exif item') from err
+    return tags
+
+
+def find_exif_item(payload: bytes, offset: int, size: int) -> Union[int, None]:
+    """Item id of the Exif item in the iinf box (None if there is none)."""
+    version = payload[offset]
+    count_format = '>H' if version == 0 else '>I'
+    position = offset + 4 + struct.calcsize(count_format)
+    iinf = io.BytesIO(payload)
+    for box_type, infe_offset, _ in iter_boxes(iinf, position, offset + size):
+        if box_type != b'infe' or payload[infe_offset] < 2:
+            continue  # item_type is only in infe version 2 and later
+        id_format = '>H' if payload[infe_offset] == 2 else '>I'
+        (item_id, ) = struct.unpack_from(id_format, payload, infe_offset + 4)
+        type_offset = infe_offset + 4 + struct.calcsize(id_format) + 2
+        if payload[type_offset:type_offset + 4] == b'Exif':
+            return item_id
+    return None
+
+
+def find_item_extent(payload: bytes, offset: int, size: int,
+                     item_id: int) -> Union[Tuple[int, int], None]:
+    """File offset and length of item_id according to the iloc box (first extent only)."""
+
+    def read_int(position: int, byte_count: int) -> Tuple[int, int]:
+        if byte_count == 0:
+            return 0, position
+        value = int.from_bytes(payload[position:position + byte_count], 'big')
+        return value, position + byte_count
+
+    version = payload[offset]
+    offset_size, length_size = payload[offset + 4] >> 4, payload[offset + 4] & 0x0F
+    base_offset_size, index_size = payload[offset + 5] >> 4, payload[offset + 5] & 0x0F
+    id_size = 2 if version < 2 else 4
+    count, position = read_int(offset + 6, id_size)
+    for _ in range(count):
+        current_id, position = read_int(position, id_size)
+        construction_method = 0
+        if version in (1, 2):
+            construction_method, position = read_int(position, 2)
+            construction_method &= 0x0F
+        position += 2  # data_reference_index
+        base_offset, position = read_int(position, base_offset_size)
+        extent_count, position = read_int(position, 2)
+        extents = []
+        for _ in range(extent_count):
+            if version in (1, 2):
+                _, position = read_int(position, index_size)
+            extent_offset, position = read_int(position, offset_size)
+            extent_length, position = read_int(position, length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        if current_id == item_id:
+            if construction_method != 0 or not extents:
+                return None  # stored in idat or another item, not supported
+            return extents[0]
+    return None
@@ -0,0 +1,143 @@
+"""Classify filenames with rules that are compiled once.
+
+The extensions to process, the messenger name patterns (WhatsApp, Signal), extra filename
+patterns given by the user and the keywords to keep are compiled once. Each file is then
+classified by its basename only (the directory names are never looked at), resulting in a
+Classification record.
+
+The extension of the name selects the rules: known extensions are a set lookup, and user
+patterns are grouped by their (literal) extension, so a name is only matched against the
+patterns for its extension. The cost per file doesn't grow with the number of patterns, except
+for patterns without a literal extension (i.e. 'IMG_*'), which are tried for every name.
+"""
+
+import fnmatch
+import os
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Tuple, Union
+
+EXTENSIONS = ('jpg', 'jpeg', 'heic', 'heif', 'mp4', 'mov')  # matched case insensitive
+# name patterns of pictures sent with a messenger app. They have no (or stripped) exif data, the
+# date (and sometimes time) is taken from the name instead
+MESSENGER_PATTERNS = {
+    # IMG-20181108-WA0025.jpg, VID-20181108-WA0003.mp4: date and a sequence number
+    'whatsapp': r'(?:IMG|VID)-(?P<whatsapp_date>\d{8})-WA(?P<whatsapp_number>\d{4})',
+    # signal-2020-01-31-123456.jpg: date and time
+    'signal': r'signal-(?P<signal_dt>\d{4}-\d\d-\d\d-\d{6})',
+}
+
+
+class Classification(NamedTuple):
+    ext: str  # lower case extension, with the dot
+    messenger: Union[str, None]  # key of MESSENGER_PATTERNS
+    messenger_dt: Union[datetime, None]  # date(time) from the name of a messenger file
+    keywords: Tuple[str, ...]  # keywords in the name, in the configured order
+
+
+def trie_regex(words: Iterable[str]) -> str:
+    """Build a regex matching any of words, with common prefixes factored out.
+
+    'HDR|HOT' becomes 'H(?:DR|OT)', so at each position in the name only the branches starting
+    with the character at that position are tried, however many words there are.
+    """
+    trie: Dict[str, dict] = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}  # end of a word
+
+    def to_regex(node: Dict[str, dict]) -> str:
+        branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items())
+                    if char]
+        optional = '' in node
+        if not branches:
+            return ''
+        regex = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        if optional:
+            regex = '(?:' + regex + ')?'
+        return regex
+
+    return to_regex(trie)
+
+
+class Classifier:
+    def __init__(self,
+                 keywords: Iterable[str] = (),
+                 extensions: Iterable[str] = EXTENSIONS,
+                 include: Iterable[str] = ()):
+        """Compile the rules.
+
+        Args:
+            keywords (Iterable[str], optional): keywords to find in the names (case sensitive).
+                                                Defaults to ().
+            extensions (Iterable[str], optional): extensions of the files to process.
+                                                  Defaults to EXTENSIONS.
+            include (Iterable[str], optional): extra filename patterns (fnmatch syntax, i.e.
+                                               'DSC*.ARW') of files to process. Defaults to ().
+        """
+        self.keywords = tuple(dict.fromkeys(keywords))
+        self._keyword_order = {keyword: idx for idx, keyword in enumerate(self.keywords)}
+        self._extensions = frozenset(ext.lstrip('.').lower() for ext in extensions)
+        # user patterns by their literal extension (case sensitive, like the pattern itself)
+        by_ext: Dict[Union[str, None], List[str]] = {}
+        for pattern in include:
+            _, dot, ext = pattern.rpartition('.')
+            key = ext if dot and not any(char in ext for char in '*?[') else None
+            by_ext.setdefault(key, []).append(fnmatch.translate(pattern))
+        self._include = {ext: re.compile('|'.join(patterns))
+                         for ext, patterns in by_ext.items() if ext is not None}
+        self._include_any = re.compile('|'.join(by_ext[None])) if None in by_ext else None
+        self._messenger_regex = re.compile('|'.join(
+            f'(?P<{name}>{pattern})' for name, pattern in MESSENGER_PATTERNS.items()))
+        # lookahead, so keywords that overlap (i.e. 'COVER' and 'OVER') are all found
+        self._keyword_regex = (re.compile(f'(?=({trie_regex(self.keywords)}))')
+                               if self.keywords else None)
+
+    def matches(self, name: str) -> bool:
+        """Check if a file (basename) should be processed."""
+        return self.extension(name) is not None
+
+    def extension(self, name: str) -> Union[str, None]:
+        """Lower case extension (with the dot) of a file that should be processed, else None."""
+        _, dot, ext = name.rpartition('.')
+        if dot and ext.lower() in self._extensions:
+            return '.' + ext.lower()
+        include = self._include.get(ext) if dot else None
+        if ((include and include.fullmatch(name))
+                or (self._include_any and self._include_any.fullmatch(name))):
+            return os.path.splitext(name)[1].lower()
+        return None
+
+    def classify(self, name: str) -> Union[Classification, None]:
+        """Classify a file by its basename, None if it should not be processed."""
+        ext = self.extension(name)
+        if ext is None:
+            return None
+        match = self._messenger_regex.match(name)
+        messenger = None
+        if match:
+            messenger = next(messenger for messenger in MESSENGER_PATTERNS if match[messenger])
+        keywords = ()
+        if self._keyword_regex:
+            found = set(self._keyword_regex.findall(name))
+            keywords = tuple(sorted(found, key=self._keyword_order.__getitem__))
+        return Classification(ext, messenger, messenger_dt(match, messenger), keywords)
+
+
+def messenger_dt(match: Union[re.Match, None],
+                 messenger: Union[str, None]) -> Union[datetime, None]:
+    """Date(time) in the name of a messenger file, None if it is not a valid date."""
+    try:
+        if messenger == 'whatsapp':
+            # no time in the name, the sequence number is used as minutes and seconds so pictures
+            # of the same day keep their order
+            number = int(match['whatsapp_number'])
+            return datetime.strptime(match['whatsapp_date'], '%Y%m%d').replace(
+                minute=number // 60, second=number % 60)
+        if messenger == 'signal':
+            return datetime.strptime(match['signal_dt'], '%Y-%m-%d-%H%M%S')
+    except ValueError:
+        pass
+    return None
@@ -0,0 +1,257 @@
+"""Content based duplicate detection.
+
+Files are compared in stages, each one more expensive than the previous: size, a quick hash of
+the first and last CHUNK_SIZE bytes and finally a hash of the complete file. The full hash is
+only computed when all previous stages match. Hashes are stored in the MetadataCache (if given)
+so they are computed only once per file.
+
+Run as a script to list groups of identical files in one or more directories:
+python dedup.py DIR [DIR ...]
+"""
+
+import hashlib
+import logging
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, Iterable, List, Union
+
+from metadata_cache import MetadataCache
+from mover import move_file
+from target_index import TargetIndex
+
+CHUNK_SIZE = 64 * 1024  # bytes read from start and end of the file for the quick hash
+READ_SIZE = 1024 * 1024  # read size when hashing the complete file
+METADATA_CACHE_FILENAME = 'metadata_cache.sqlite'  # same file as sort_them.py uses
+
+POLICY_KEEP = 'keep'  # leave the source file where it is, add it to the doubles list
+POLICY_DELETE = 'delete'  # remove the source file
+POLICY_MOVE = 'move'  # move the source file to a separate directory
+POLICIES = (POLICY_KEEP, POLICY_DELETE, POLICY_MOVE)
+DOUBLES_SEPARATOR = '\t'  # between the double and the file that is kept, in the doubles list
+
+
+def append_double(doubles_list: str, src_file: str, kept_file: str) -> None:
+    """Add a double to the doubles list (see remove_doubles.py).
+
+    Args:
+        doubles_list (str): list file
+        src_file (str): the double, which stays in the source directory
+        kept_file (str): the file in the target directory it is a double of
+    """
+    with open(doubles_list, 'a') as file:
+        file.write(src_file + DOUBLES_SEPARATOR + kept_file + '\n')
+
+
+def quick_hash(path: str, size: int) -> str:
+    """Hash the size, the first and the last CHUNK_SIZE bytes of a file.
+
+    Args:
+        path (str): file to hash
+        size (int): size of the file
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as file:
+        digest.update(file.read(CHUNK_SIZE))
+        if size > 2 * CHUNK_SIZE:
+            file.seek(-CHUNK_SIZE, os.SEEK_END)
+            digest.update(file.read(CHUNK_SIZE))
+        else:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def full_hash(path: str) -> str:
+    """Hash the complete file.
+
+    Args:
+        path (str): file to hash
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as file:
+        while chunk := file.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Deduplicator:
+    def __init__(self,
+                 policy: str = POLICY_KEEP,
+                 doubles_dir: Union[str, None] = None,
+                 doubles_list: Union[str, None] = None,
+                 cache: Union[MetadataCache, None] = None,
+                 logger: Union[logging.Logger, None] = None):
+        """Compare files by content and handle identical ones according to policy.
+
+        Args:
+            policy (str, optional): one of POLICIES. Defaults to POLICY_KEEP.
+            doubles_dir (Union[str, None], optional): where POLICY_MOVE moves files to.
+                                                      Defaults to None.
+            doubles_list (Union[str, None], optional): file POLICY_KEEP appends paths to.
+                                                       Defaults to None.
+            cache (Union[MetadataCache, None], optional): store for the hashes. Defaults to None.
+            logger (Union[logging.Logger, None], optional): where to log to. Defaults to None.
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy "{policy}", should be one of {POLICIES}')
+        if policy == POLICY_MOVE and not doubles_dir:
+            raise ValueError(f'Policy "{POLICY_MOVE}" requires doubles_dir')
+        self.policy = policy
+        self.doubles_dir = doubles_dir
+        self.doubles_list = doubles_list
+        self.cache = cache
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = {'identical': 0, 'name_collision': 0, 'quick_hashes': 0, 'full_hashes': 0}
+
+    def hashes(self, path: str, stat: os.stat_result, full: bool = False) -> tuple:
+        """Get (quick hash, full hash) of path, computing what is not cached yet.
+
+        Args:
+            path (str): file to hash
+            stat (os.stat_result): current stat of the file
+            full (bool, optional): compute the full hash as well. Defaults to False.
+
+        Returns:
+            tuple: quick hash, full hash (None if not full and not cached)
+        """
+        quick, complete = self.cache.get_hashes(path, stat) if self.cache else (None, None)
+        changed = False
+        if quick is None:
+            quick = quick_hash(path, stat.st_size)
+            self.stats['quick_hashes'] += 1
+            changed = True
+        if full and complete is None:
+            complete = full_hash(path)
+            self.stats['full_hashes'] += 1
+            changed = True
+        if changed and self.cache:
+            self.cache.put_hashes(path, stat, quick, complete)
+        return quick, complete
+
+    def is_identical(self, path_a: str, path_b: str) -> bool:
+        """Check if two files have the same content, doing as little I/O as possible."""
+        stat_a, stat_b = os.stat(path_a), os.stat(path_b)
+        if stat_a.st_size != stat_b.st_size:
+            return False
+        if self.hashes(path_a, stat_a)[0] != self.hashes(path_b, stat_b)[0]:
+            return False
+        return self.hashes(path_a, stat_a, True)[1] == self.hashes(path_b, stat_b, True)[1]
+
+    def unique_target(self,
+                      src_file: str,
+                      base_filename: str,
+                      target_index: Union[TargetIndex, None] = None) -> Union[str, None]:
+        """Find the target filename for src_file.
+
+        base_filename and its existing _COPY[n] variants are compared with src_file. If one of
+        them is identical, the policy is applied to src_file and None is returned. Otherwise the
+        first free name is returned (a name collision between different pictures).
+
+        Args:
+            src_file (str): file to move
+            base_filename (str): ideal target filename
+            target_index (Union[TargetIndex, None], optional): look up existing files in the
+                                                               index instead of on disk.
+                                                               Defaults to None.
+
+        Returns:
+            Union[str, None]: target filename, None if an identical file exists already
+        """
+        filename, ext = base_filename.rsplit('.', 1)
+        copy_filename = filename + '_COPY[{}]' + '.' + ext
+        target_file = base_filename
+        exists = target_index.exists if target_index else os.path.exists
+        counter = 0
+        while exists(target_file):
+            if self.is_identical(src_file, target_file):
+                self.stats['identical'] += 1
+                self.handle_identical(src_file, target_file)
+                return None
+            counter += 1
+            target_file = copy_filename.format(counter)
+        if counter:
+            self.stats['name_collision'] += 1
+            self.logger.info('Name collision for different files: %s', target_file)
+        return target_file
+
+    def handle_identical(self, src_file: str, existing_file: str) -> None:
+        """Apply the policy to src_file, which is identical to existing_file."""
+        self.logger.info('"%s" is identical to "%s" (%s)', src_file, existing_file, self.policy)
+        if self.policy == POLICY_KEEP:
+            if self.doubles_list:
+                append_double(self.doubles_list, src_file, existing_file)
+            return
+        if self.policy == POLICY_DELETE:
+            os.remove(src_file)
+        else:
+            os.makedirs(self.doubles_dir, exist_ok=True)
+            target = os.path.join(self.doubles_dir, os.path.basename(existing_file))
+            target = self.free_name(target)
+            move_file(src_file, target)
+            if self.cache:
+                self.cache.move_hashes(src_file, target)
+        if self.cache:
+            self.cache.discard(src_file)
+
+    @staticmethod
+    def free_name(path: str) -> str:
+        """Add a counter to path until it doesn't exist."""
+        filename, ext = os.path.splitext(path)
+        counter = 0
+        while os.path.exists(path):
+            counter += 1
+            path = f'{filename}_{counter}{ext}'
+        return path
+
+    def find_duplicates(self, paths: Iterable[str]) -> List[List[str]]:
+        """Group paths by identical content.
+
+        Args:
+            paths (Iterable[str]): files to check
+
+        Returns:
+            List[List[str]]: groups (of at least 2 files) with identical content
+        """
+        by_size: Dict[int, List[tuple]] = defaultdict(list)
+        for path in paths:
+            stat = os.stat(path)
+            by_size[stat.st_size].append((path, stat))
+
+        groups = []
+        for candidates in by_size.values():
+            if len(candidates) < 2:
+                continue
+            by_quick = defaultdict(list)
+            for path, stat in candidates:
+                by_quick[self.hashes(path, stat)[0]].append((path, stat))
+            for quick_candidates in by_quick.values():
+                if len(quick_candidates) < 2:
+                    continue
+                by_full = defaultdict(list)
+                for path, stat in quick_candidates:
+                    by_full[self.hashes(path, stat, True)[1]].append(path)
+                groups.extend(group for group in by_full.values() if len(group) > 1)
+        return groups
+
+
+def walk_files(directories: Iterable[str]) -> Iterable[str]:
+    """Yield all files in (subdirs of) directories."""
+    for directory in directories:
+        for path, _, filenames in os.walk(os.path.abspath(directory)):
+            for filename in filenames:
+                yield os.path.join(path, filename)
+
+
+if __name__ == '__main__':
+    cache = MetadataCache(METADATA_CACHE_FILENAME)
+    deduplicator = Deduplicator(cache=cache)
+    for group in deduplicator.find_duplicates(walk_files(sys.argv[1:])):
+        print('\n'.join(sorted(group)) + '\n')
+    print('Hashed: {0[quick_hashes]} quick, {0[full_hashes]} full'.format(deduplicator.stats))
+    cache.close()
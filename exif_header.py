@@ -0,0 +1,232 @@
+"""Fast-path exif reader that only reads the JPEG header.
+
+exif.Image reads (and parses) the complete file, which is expensive for multi-MB pictures on a
+network mount. The functions here walk the JPEG segment markers, read only the APP1 (Exif)
+segment and decode the three tags PhotoRenamer needs: DateTime, DateTimeOriginal and Model.
+TIFF based raw files (ARW, NEF, DNG, CR2, ...) are a TIFF structure themselves, of which only the
+start is read.
+"""
+
+import struct
+from typing import BinaryIO, Dict, Union
+
+JPEG_SOI = b'\xff\xd8'
+MARKER_APP1 = 0xE1
+MARKER_SOS = 0xDA
+MARKER_EOI = 0xD9
+EXIF_HEADER = b'Exif\x00\x00'
+TIFF_HEADERS = (b'II*\x00', b'MM\x00*')
+TIFF_READ_SIZE = 64 * 1024  # read first from raw files, IFD0 and the Exif IFD are near the start
+TIFF_MAX_READ_SIZE = 4 * 1024 * 1024  # read at most this much if the tags are further in the file
+
+TAG_MODEL = 0x0110
+TAG_DATETIME = 0x0132
+TAG_EXIF_IFD_POINTER = 0x8769
+TAG_THUMBNAIL_OFFSET = 0x0201  # JPEGInterchangeFormat in IFD1
+TAG_THUMBNAIL_LENGTH = 0x0202  # JPEGInterchangeFormatLength in IFD1
+TAG_DATETIME_ORIGINAL = 0x9003
+TYPE_ASCII = 2
+TYPE_LONG = 4
+TYPE_IFD = 13  # used for the Exif IFD pointer in some TIFF (raw) files
+
+IFD0_TAGS = {TAG_MODEL: 'model', TAG_DATETIME: 'datetime'}
+EXIF_IFD_TAGS = {TAG_DATETIME_ORIGINAL: 'datetime_original'}
+
+
+class HeaderParseError(Exception):
+    """The header could not be parsed by the fast path."""
+
+
+def read_exif_header(src_file: BinaryIO) -> Dict[str, Union[str, None]]:
+    """Read the datetime, datetime_original and model tags from the JPEG header.
+
+    Reading stops after the APP1 segment (or at the start of the image data if there is no
+    exif segment), so only the first few KB of the file are read.
+
+    Args:
+        src_file (BinaryIO): File opened in binary mode, positioned at the start of the file.
+
+    Raises:
+        HeaderParseError: If the header is not a (supported) JPEG/exif header.
+
+    Returns:
+        Dict[str, Union[str, None]]: 'datetime', 'datetime_original' and 'model' (None if the
+                                     tag is not present)
+    """
+    tags = {'datetime': None, 'datetime_original': None, 'model': None}
+    app1 = find_app1_segment(src_file)
+    if app1 is None:
+        return tags
+    try:
+        parse_tiff(app1, tags)
+    except (struct.error, IndexError) as err:
+        raise HeaderParseError('Invalid TIFF structure in APP1 segment') from err
+    return tags
+
+
+def read_tiff_header(src_file: BinaryIO) -> Dict[str, Union[str, None]]:
+    """Read the datetime, datetime_original and model tags from a TIFF based raw file.
+
+    Only the first TIFF_READ_SIZE bytes are read, more (up to TIFF_MAX_READ_SIZE) if the tags
+    are further in the file.
+
+    Args:
+        src_file (BinaryIO): File opened in binary mode, positioned at the start of the file.
+
+    Raises:
+        HeaderParseError: If the file is not a TIFF file or the structure is broken.
+
+    Returns:
+        Dict[str, Union[str, None]]: 'datetime', 'datetime_original' and 'model' (None if the
+                                     tag is not present)
+    """
+    size = TIFF_READ_SIZE
+    while True:
+        src_file.seek(0)
+        tiff = src_file.read(size)
+        if tiff[:4] not in TIFF_HEADERS:
+            raise HeaderParseError('Not a TIFF file')
+        tags = {'datetime': None, 'datetime_original': None, 'model': None}
+        try:
+            parse_tiff(tiff, tags)
+            return tags
+        except (struct.error, IndexError, HeaderParseError) as err:
+            # an offset beyond what has been read: read more, unless that was the whole file
+            if len(tiff) < size or size >= TIFF_MAX_READ_SIZE:
+                raise HeaderParseError('Invalid TIFF structure') from err
+            size *= 4
+
+
+def find_app1_segment(src_file: BinaryIO) -> Union[bytes, None]:
+    """Walk the JPEG markers and return the TIFF part of the exif APP1 segment.
+
+    Args:
+        src_file (BinaryIO): File opened in binary mode, positioned at the start of the file.
+
+    Raises:
+        HeaderParseError: If the file is not a JPEG or the marker structure is broken.
+
+    Returns:
+        Union[bytes, None]: TIFF data (after the 'Exif\\0\\0' header), None if no exif segment.
+    """
+    if src_file.read(2) != JPEG_SOI:
+        raise HeaderParseError('Not a JPEG file')
+    while True:
+        marker = src_file.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF:
+            raise HeaderParseError('Unexpected end of header or invalid marker')
+        marker_type = marker[1]
+        if marker_type in (MARKER_SOS, MARKER_EOI):
+            return None
+        length = struct.unpack('>H', marker[2:])[0] - 2
+        if length < 0:
+            raise HeaderParseError('Invalid segment length')
+        if marker_type != MARKER_APP1:
+            src_file.seek(length, 1)
+            continue
+        segment = src_file.read(length)
+        if len(segment) < length:
+            raise HeaderParseError('Truncated APP1 segment')
+        if segment.startswith(EXIF_HEADER):
+            return segment[len(EXIF_HEADER):]
+        # XMP data is stored in an APP1 segment as well, keep looking
+
+
+def parse_tiff(tiff: bytes, tags: Dict[str, Union[str, None]]) -> None:
+    """Decode the required tags from IFD0 and the Exif sub-IFD into tags.
+
+    Args:
+        tiff (bytes): TIFF structure as found in the APP1 segment
+        tags (Dict[str, Union[str, None]]): dict to fill in
+    """
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        raise HeaderParseError('Invalid TIFF byte order')
+    magic, ifd0_offset = struct.unpack(endian + 'HI', tiff[2:8])
+    if magic != 42:
+        raise HeaderParseError('Invalid TIFF magic number')
+
+    exif_offset = parse_ifd(tiff, ifd0_offset, endian, IFD0_TAGS, tags)
+    if exif_offset:
+        parse_ifd(tiff, exif_offset, endian, EXIF_IFD_TAGS, tags)
+
+
+def parse_ifd(tiff: bytes, offset: int, endian: str, wanted: Dict[int, str],
+              tags: Dict[str, Union[str, None]]) -> Union[int, None]:
+    """Decode the ASCII tags in wanted from one IFD.
+
+    Args:
+        tiff (bytes): TIFF structure
+        offset (int): offset of the IFD in tiff
+        endian (str): struct byte order character
+        wanted (Dict[int, str]): tag id -> key in tags
+        tags (Dict[str, Union[str, None]]): dict to fill in
+
+    Returns:
+        Union[int, None]: offset of the Exif sub-IFD if this IFD points to one
+    """
+    exif_offset = None
+    (entries, ) = struct.unpack_from(endian + 'H', tiff, offset)
+    for idx in range(entries):
+        tag, tag_type, count, value = struct.unpack_from(endian + 'HHI4s', tiff,
+                                                         offset + 2 + 12 * idx)
+        if tag == TAG_EXIF_IFD_POINTER and tag_type in (TYPE_LONG, TYPE_IFD):
+            exif_offset = struct.unpack(endian + 'I', value)[0]
+        elif tag in wanted and tag_type == TYPE_ASCII:
+            if count <= 4:
+                raw = value[:count]
+            else:
+                start = struct.unpack(endian + 'I', value)[0]
+                raw = tiff[start:start + count]
+                if len(raw) < count:
+                    raise HeaderParseError('Tag value outside of APP1 segment')
+            try:
+                tags[wanted[tag]] = raw.split(b'\x00', 1)[0].decode('ascii')
+            except UnicodeDecodeError:
+                tags[wanted[tag]] = None
+    return exif_offset
+
+
+def read_exif_thumbnail(src_file: BinaryIO) -> Union[bytes, None]:
+    """Read the JPEG thumbnail embedded in the exif data (IFD1).
+
+    Args:
+        src_file (BinaryIO): File opened in binary mode, positioned at the start of the file.
+
+    Raises:
+        HeaderParseError: If the header is not a (supported) JPEG/exif header.
+
+    Returns:
+        Union[bytes, None]: the thumbnail (a complete JPEG file), None if there is none
+    """
+    tiff = find_app1_segment(src_file)
+    if tiff is None:
+        return None
+    try:
+        return find_thumbnail(tiff)
+    except (struct.error, IndexError) as err:
+        raise HeaderParseError('Invalid TIFF structure in APP1 segment') from err
+
+
+def find_thumbnail(tiff: bytes) -> Union[bytes, None]:
+    """Get the thumbnail from the TIFF structure, following IFD0 to IFD1."""
+    endian = '<' if tiff[:2] == b'II' else '>'
+    (ifd0_offset, ) = struct.unpack_from(endian + 'I', tiff, 4)
+    (entries, ) = struct.unpack_from(endian + 'H', tiff, ifd0_offset)
+    (ifd1_offset, ) = struct.unpack_from(endian + 'I', tiff, ifd0_offset + 2 + 12 * entries)
+    if not ifd1_offset:
+        return None
+    offset = length = None
+    (entries, ) = struct.unpack_from(endian + 'H', tiff, ifd1_offset)
+    for idx in range(entries):
+        tag, _, _, value = struct.unpack_from(endian + 'HHII', tiff, ifd1_offset + 2 + 12 * idx)
+        if tag == TAG_THUMBNAIL_OFFSET:
+            offset = value
+        elif tag == TAG_THUMBNAIL_LENGTH:
+            length = value
+    if offset is None or not length or offset + length > len(tiff):
+        return None
+    return tiff[offset:offset + length]
@@ -1,11 +1,20 @@
 import argparse
 
-def get_arguments()->tuple:
+ASYNC_OPERATIONS = ('scan', 'read', 'move')
+
+
+def parse_limit(value: str) -> tuple:
+    """Parse an OPERATION=N concurrency limit."""
+    operation, _, limit = value.partition('=')
+    if operation not in ASYNC_OPERATIONS or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError('expected OPERATION=N with OPERATION one of {} and N >= 1'.format(', '.join(ASYNC_OPERATIONS)))
+    return operation, int(limit)
+
+
+def get_arguments() -> argparse.Namespace:
     """Get and check user arguments.
 
     """
-    input_path = None
-    output_path = None
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', 
                         action = 'store',  # stores argument in dest variable, optionally doing type conversion/checking
@@ -73,13 +82,122 @@ def get_arguments()->tuple:
                         dest='keywords', 
                         default = [],
                         help = 'Additional keywords to keep from original filename')
+    parser.add_argument('-j', '--jobs',
+                        action = 'store',
+                        default = 1,
+                        dest='jobs',
+                        help = 'Number of worker threads reading exif data (default: 1)',
+                        type = int)
+    parser.add_argument('--no-cache',
+                        action = 'store_true',
+                        default = False,
+                        dest='no_cache',
+                        help = 'Don\'t use (or update) the metadata cache, read exif data of every file')
+    parser.add_argument('--incremental',
+                        action = 'store_true',
+                        default = False,
+                        dest='incremental',
+                        help = 'Skip directories that did not change since the previous (incremental) run')
+    parser.add_argument('--dedup',
+                        action = 'store',
+                        choices = ('keep', 'delete', 'move'),
+                        dest='dedup',
+                        help = 'Compare doubles by content. Identical files are kept in place (and listed in doubles.list), deleted or moved to _doubles. Different files with the same name always get a _COPY[n] name')
+    parser.add_argument('--async',
+                        action = 'store_true',
+                        default = False,
+                        dest='async_io',
+                        help = 'Run scanning, exif reading and moving as asyncio tasks (for high latency network storage)')
+    parser.add_argument('--limit',
+                        action = 'append',
+                        default = [],
+                        dest='limits',
+                        help = 'Concurrency of one operation with --async, i.e. --limit read=100. Operations: scan, read, move',
+                        type = parse_limit)
+    parser.add_argument('--summary',
+                        action = 'store',
+                        dest='summary',
+                        help = 'Write counters and per-stage timings of the run to this json file (default: run_summary.json)',
+                        type = str)
+    parser.add_argument('--profile',
+                        action = 'store',
+                        dest='profile',
+                        help = 'Profile the main operation with cProfile and write the stats to this file',
+                        type = str)
+    parser.add_argument('--plan',
+                        action = 'store',
+                        dest='plan',
+                        help = 'Dry run: write what would be done to this JSON lines file, without moving files',
+                        type = str)
+    parser.add_argument('--execute',
+                        action = 'store',
+                        dest='execute',
+                        help = 'Move the files of a plan made with --plan (resumes an interrupted execution)',
+                        type = str)
+    parser.add_argument('--watch',
+                        action = 'store_true',
+                        default = False,
+                        dest='watch',
+                        help = 'Keep running and move new files as soon as they are completely written (stop with Ctrl+C)')
+    parser.add_argument('--poll',
+                        action = 'store_true',
+                        default = False,
+                        dest='poll',
+                        help = 'With --watch: find new files by polling instead of inotify (for network/FUSE mounts that send no inotify events)')
+    parser.add_argument('--log-level',
+                        action = 'store',
+                        choices = ('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        default = 'DEBUG',
+                        dest='log_level',
+                        help = 'Minimum level of the messages written to output.log (default: DEBUG). Messages below it are not even formatted')
+    parser.add_argument('--log-records',
+                        action = 'store_true',
+                        default = False,
+                        dest='log_records',
+                        help = 'Log one json line per file with what was decided (moved, copy, double, no_dt, ...) instead of several free-form messages')
+    parser.add_argument('--shard',
+                        action = 'store',
+                        default = None,
+                        dest='shard',
+                        metavar='LEDGER',
+                        help = 'Sort together with other workers (on this or other machines) that use the same LEDGER, a database file all workers can reach (i.e. on the target volume). Each worker claims source directories from the ledger until none are left')
+    parser.add_argument('--thumbnails',
+                        action = 'store_true',
+                        default = False,
+                        dest='thumbnails',
+                        help = 'Add the thumbnail of every moved file to an index in its YYYY/MM directory (_thumbnails.pack and _thumbnails.json), to review a month without opening every picture')
+    parser.add_argument('--include',
+                        action = 'append',
+                        default = [],
+                        dest='include',
+                        metavar='GLOB',
+                        help = 'Also process files whose name matches GLOB (i.e. "DSC*.ARW", case sensitive, can be repeated). JPEG, HEIC/HEIF and MP4/MOV files are always processed. Exif data is read from TIFF based raw files (ARW, NEF, NRW, DNG, CR2, PEF, SRW, TIF); other files are only sorted if they have a messenger name')
                         
     results = parser.parse_args()
+    if results.jobs < 1:
+        parser.error('--jobs should be at least 1')
+    results.limits = dict(results.limits)
+    if results.async_io and (results.plan or results.execute or results.dedup or results.incremental):
+        parser.error('--async can not be combined with --plan, --execute, --dedup or --incremental')
+    if results.watch and (results.plan or results.execute or results.async_io or results.incremental):
+        parser.error('--watch can not be combined with --plan, --execute, --async or --incremental')
+    if results.shard and (results.plan or results.execute or results.async_io or results.watch or results.incremental):
+        parser.error('--shard can not be combined with --plan, --execute, --async, --watch or --incremental')
+    if results.thumbnails and (results.plan or results.execute):
+        parser.error('--thumbnails can not be combined with --plan or --execute, use "python month_index.py TARGET" after executing the plan')
+    if results.poll and not results.watch:
+        parser.error('--poll can only be used with --watch')
+    if results.plan and results.execute:
+        parser.error('--plan and --execute can not be combined')
+    if results.plan and results.dedup:
+        parser.error('--dedup compares file contents while moving and can not be used with --plan')
     
 
     print('input: {}\noutput: {}\nkeywords: {}'.format(results.input_path, results.output_path, results.keywords))
 
 
-    return (input_path, output_path)
+    return results
+
 
-get_arguments()
\ No newline at end of file
+if __name__ == '__main__':
+    get_arguments()
\ No newline at end of file
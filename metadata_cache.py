@@ -0,0 +1,219 @@
+"""Persistent cache of the exif data read by PhotoRenamer.get_exif_data, of content hashes and
+of perceptual hashes.
+
+Entries are keyed by path and only valid as long as size and mtime of the file are unchanged,
+so files that were skipped in a previous run don't have to be opened again.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Tuple, Union
+
+COMMIT_EVERY = 1000  # number of changes after which the cache is committed to disk
+HASH_TABLES = ('hashes', 'phashes')  # tables with hashes that stay valid when a file is renamed
+PHASH_MASK = 2**64 - 1
+PHASH_VERSION = 1  # bumped when perceptual hashes are computed differently
+
+
+class MetadataCache:
+    def __init__(self, filename: str):
+        """Open (or create) the cache.
+
+        Args:
+            filename (str): sqlite database file
+        """
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self.run_id = time.time_ns()
+        self._changes = 0
+        self._lock = threading.Lock()  # connection is shared by the --jobs worker threads
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                         'dt TEXT, dt_orig TEXT, model TEXT, last_seen INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                         'quick_hash TEXT, full_hash TEXT)')
+        if self._db.execute('PRAGMA user_version').fetchone()[0] < PHASH_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS phashes')
+            self._db.execute(f'PRAGMA user_version = {PHASH_VERSION}')
+        self._db.execute('CREATE TABLE IF NOT EXISTS phashes ('
+                         'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, phash INTEGER)')
+
+    def get(self, path: str, stat: os.stat_result) -> Union[Dict[str, Union[str, None]], None]:
+        """Get cached exif data of path.
+
+        Args:
+            path (str): full path of the file
+            stat (os.stat_result): current stat of the file
+
+        Returns:
+            Union[Dict[str, Union[str, None]], None]: 'datetime', 'datetime_original' and 'model'
+                                                      None if not cached or file has changed
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, dt, dt_orig, model FROM metadata WHERE path = ?',
+                (path, )).fetchone()
+            if not row or row[:2] != (stat.st_size, stat.st_mtime_ns):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE metadata SET last_seen = ? WHERE path = ?',
+                             (self.run_id, path))
+            self._changed()
+        return {'datetime': row[2], 'datetime_original': row[3], 'model': row[4]}
+
+    def put(self, path: str, stat: os.stat_result,
+            exif_tags: Dict[str, Union[str, None]]) -> None:
+        """Store exif data of path.
+
+        Args:
+            path (str): full path of the file
+            stat (os.stat_result): stat of the file at the moment the exif data was read
+            exif_tags (Dict[str, Union[str, None]]): 'datetime', 'datetime_original' and 'model'
+        """
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, exif_tags['datetime'],
+                 exif_tags['datetime_original'], exif_tags['model'], self.run_id))
+            self._changed()
+
+    def get_hashes(self, path: str,
+                   stat: os.stat_result) -> Tuple[Union[str, None], Union[str, None]]:
+        """Get cached content hashes of path.
+
+        Args:
+            path (str): full path of the file
+            stat (os.stat_result): current stat of the file
+
+        Returns:
+            Tuple[Union[str, None], Union[str, None]]: quick hash, full hash (None if unknown)
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size, mtime_ns, quick_hash, full_hash FROM hashes WHERE path = ?',
+                (path, )).fetchone()
+        if not row or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None, None
+        return row[2], row[3]
+
+    def put_hashes(self, path: str, stat: os.stat_result, quick_hash: Union[str, None],
+                   full_hash: Union[str, None]) -> None:
+        """Store content hashes of path.
+
+        Args:
+            path (str): full path of the file
+            stat (os.stat_result): stat of the file at the moment it was hashed
+            quick_hash (Union[str, None]): hash of size, start and end of the file
+            full_hash (Union[str, None]): hash of the complete file
+        """
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                             (path, stat.st_size, stat.st_mtime_ns, quick_hash, full_hash))
+            self._changed()
+
+    def get_phash(self, path: str, stat: os.stat_result) -> Union[int, None]:
+        """Get the cached perceptual hash of path (None if unknown or the file has changed)."""
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, phash FROM phashes WHERE path = ?',
+                                   (path, )).fetchone()
+        if not row or row[:2] != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return row[2] & PHASH_MASK
+
+    def put_phash(self, path: str, stat: os.stat_result, phash: int) -> None:
+        """Store the (64 bit) perceptual hash of path.
+
+        Args:
+            path (str): full path of the file
+            stat (os.stat_result): stat of the file at the moment it was hashed
+            phash (int): unsigned 64 bit hash, stored as a signed sqlite INTEGER
+        """
+        if phash > PHASH_MASK >> 1:
+            phash -= PHASH_MASK + 1
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO phashes VALUES (?, ?, ?, ?)',
+                             (path, stat.st_size, stat.st_mtime_ns, phash))
+            self._changed()
+
+    def move_hashes(self, src_path: str, target_path: str) -> None:
+        """Keep the hashes of a renamed file (a rename keeps size and mtime)."""
+        with self._lock:
+            for table in HASH_TABLES:
+                self._db.execute(f'DELETE FROM {table} WHERE path = ?', (target_path, ))
+                self._db.execute(f'UPDATE {table} SET path = ? WHERE path = ?',
+                                 (target_path, src_path))
+            self._changed()
+
+    def discard(self, path: str) -> None:
+        """Remove the entries of path (i.e. because the file has been moved or removed)."""
+        with self._lock:
+            for table in ('metadata', *HASH_TABLES):
+                self._db.execute(f'DELETE FROM {table} WHERE path = ?', (path, ))
+            self._changed()
+
+    def evict_unseen(self, root: str) -> int:
+        """Remove entries below root that were not used in this run.
+
+        After a full scan of root, these are files that have been moved, removed or changed.
+
+        Args:
+            root (str): directory that has been scanned completely in this run
+
+        Returns:
+            int: number of removed entries
+        """
+        prefix = os.path.join(root, '')
+        with self._lock:
+            cursor = self._db.execute(
+                'DELETE FROM metadata WHERE last_seen != ? AND substr(path, 1, ?) = ?',
+                (self.run_id, len(prefix), prefix))
+            self._db.commit()
+            self._changes = 0
+        return cursor.rowcount
+
+    def evict_unseen_files(self, directories: Iterable[str]) -> int:
+        """Remove entries of files directly in directories that were not used in this run.
+
+        For directories that have been listed completely in this run (the changed directories of
+        an incremental scan) or that don't exist anymore. Subdirectories are not included.
+
+        Args:
+            directories (Iterable[str]): directories
+
+        Returns:
+            int: number of removed entries
+        """
+        evicted = 0
+        with self._lock:
+            for directory in directories:
+                prefix = os.path.join(directory, '')
+                cursor = self._db.execute(
+                    'DELETE FROM metadata WHERE last_seen != ? AND substr(path, 1, ?) = ? '
+                    'AND instr(substr(path, ?), ?) = 0',
+                    (self.run_id, len(prefix), prefix, len(prefix) + 1, os.sep))
+                evicted += cursor.rowcount
+            self._db.commit()
+            self._changes = 0
+        return evicted
+
+    def hit_rate(self) -> float:
+        """Fraction of lookups in this run that were found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+    def _changed(self) -> None:
+        self._changes += 1
+        if self._changes >= COMMIT_EVERY:
+            self._db.commit()
+            self._changes = 0
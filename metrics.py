@@ -0,0 +1,88 @@
+"""Per-stage timing of a run.
+
+Every stage ('scan', 'exif', 'name', 'unique', 'makedirs', 'move') gets a count, total and max
+time and a histogram with power-of-two microsecond buckets, so percentiles can be estimated
+without storing every sample. Recording a sample is a lock and a few additions.
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter_ns
+from typing import Dict, Iterator, Union
+
+STAGES = ('scan', 'exif', 'name', 'unique', 'makedirs', 'move')
+BUCKETS = 40  # bucket i holds durations < 2**i microseconds (last bucket: everything longer)
+
+progress = {'found': 0, 'scan_done': False}  # files found by the scan so far
+_stages: Dict[str, dict] = {}
+_lock = threading.Lock()
+
+
+def record(stage: str, duration_ns: int) -> None:
+    """Add one sample to stage."""
+    bucket = min((duration_ns // 1000).bit_length(), BUCKETS - 1)
+    with _lock:
+        stats = _stages.get(stage)
+        if stats is None:
+            stats = _stages[stage] = {'count': 0, 'total_ns': 0, 'max_ns': 0,
+                                      'buckets': [0] * BUCKETS}
+        stats['count'] += 1
+        stats['total_ns'] += duration_ns
+        stats['max_ns'] = max(stats['max_ns'], duration_ns)
+        stats['buckets'][bucket] += 1
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record the time spent in the with block for stage."""
+    start = perf_counter_ns()
+    try:
+        yield
+    finally:
+        record(stage, perf_counter_ns() - start)
+
+
+def percentile(buckets: list, count: int, fraction: float) -> float:
+    """Estimate a percentile (in ms) as the upper bound of the bucket it falls in."""
+    threshold = fraction * count
+    seen = 0
+    for idx, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= threshold:
+            return 2**idx / 1000
+    return 2**(len(buckets) - 1) / 1000
+
+
+def summary() -> Dict[str, dict]:
+    """Stage statistics: count, total (s), mean, p50, p90, p99 and max (ms)."""
+    result = {}
+    with _lock:
+        stages = [stage for stage in STAGES if stage in _stages]
+        stages += sorted(set(_stages) - set(STAGES))
+        for stage in stages:
+            stats = _stages[stage]
+            count = stats['count']
+            result[stage] = {
+                'count': count,
+                'total_s': round(stats['total_ns'] / 1e9, 3),
+                'mean_ms': round(stats['total_ns'] / count / 1e6, 3),
+                'p50_ms': percentile(stats['buckets'], count, 0.5),
+                'p90_ms': percentile(stats['buckets'], count, 0.9),
+                'p99_ms': percentile(stats['buckets'], count, 0.99),
+                'max_ms': round(stats['max_ns'] / 1e6, 3),
+            }
+    return result
+
+
+def eta_seconds(processed: int, elapsed_s: float) -> Union[float, None]:
+    """Estimated remaining time, None while the scan is running or nothing is processed yet."""
+    if not progress['scan_done'] or not processed or not elapsed_s:
+        return None
+    return max(progress['found'] - processed, 0) / (processed / elapsed_s)
+
+
+def write_summary(filename: str, run_info: dict) -> None:
+    """Write run_info plus the stage statistics to a json file."""
+    with open(filename, 'w') as file:
+        json.dump({**run_info, 'stages': summary()}, file, indent=2)
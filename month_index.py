@@ -0,0 +1,216 @@
+"""Thumbnail index per target month directory, to review a month without opening every picture.
+
+Every YYYY/MM directory gets two files:
+- THUMBNAILS_FILENAME: the thumbnails (complete JPEG files) one after the other
+- MANIFEST_FILENAME: json with the offset and length of the thumbnail of every file, and its
+  date, camera model and original name
+
+The thumbnail is the one embedded in the exif data if there is one, otherwise the picture is
+decoded at reduced size (Pillow's draft mode, so only a fraction of the DCT data is decoded) and
+saved as a small JPEG. Videos and HEIC pictures get an entry without thumbnail.
+
+The index is updated incrementally: new thumbnails are appended and the manifest is rewritten, in
+batches per month. Thumbnails of entries that are replaced or removed stay in the thumbnails file
+until the index is rebuilt.
+
+Run as a script to update the index of directories that were sorted without --thumbnails:
+python month_index.py [--rebuild] DIR [DIR ...]
+"""
+
+import argparse
+import io
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from exif_header import HeaderParseError, read_exif_thumbnail
+from photo_renamer import JPEG_EXTENSIONS, METADATA_READERS, PhotoRenamer
+
+THUMBNAILS_FILENAME = '_thumbnails.pack'
+MANIFEST_FILENAME = '_thumbnails.json'
+THUMBNAIL_SIZE = 160  # longest side of decoded thumbnails (exif thumbnails are kept as they are)
+THUMBNAIL_QUALITY = 75
+FLUSH_EVERY = 500  # thumbnails kept in memory per month before they are written
+ORIENTATION_TAG = 0x0112
+THUMBNAIL_EXIF = 'exif'
+THUMBNAIL_DECODED = 'decoded'
+
+
+def make_thumbnail(path: str) -> Tuple[Union[bytes, None], Union[str, None], Union[int, None]]:
+    """Get the thumbnail of a picture.
+
+    Args:
+        path (str): picture
+
+    Returns:
+        Tuple[Union[bytes, None], Union[str, None], Union[int, None]]: thumbnail (JPEG), where it
+            comes from (THUMBNAIL_EXIF or THUMBNAIL_DECODED) and the exif orientation of the
+            picture (decoded thumbnails are rotated already), all None if there is no thumbnail
+    """
+    if os.path.splitext(path)[1].lower() not in JPEG_EXTENSIONS:
+        return None, None, None
+    try:
+        with open(path, 'rb') as file:
+            try:
+                thumbnail = read_exif_thumbnail(file)
+            except HeaderParseError:
+                thumbnail = None
+            file.seek(0)
+            image = Image.open(file)  # only reads the header
+            if thumbnail:
+                return thumbnail, THUMBNAIL_EXIF, image.getexif().get(ORIENTATION_TAG)
+            image.draft('RGB', (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            output = io.BytesIO()
+            image.convert('RGB').save(output, 'JPEG', quality=THUMBNAIL_QUALITY)
+            return output.getvalue(), THUMBNAIL_DECODED, None
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None, None, None
+
+
+def read_manifest(directory: str) -> dict:
+    """Read the manifest of a month directory (an empty one if there is none)."""
+    try:
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return {'thumbnails': THUMBNAILS_FILENAME, 'entries': {}}
+
+
+class MonthIndex:
+    def __init__(self, flush_every: int = FLUSH_EVERY):
+        """Collect thumbnails of moved files and write them to the index of their month.
+
+        Args:
+            flush_every (int, optional): thumbnails per month kept in memory.
+                                         Defaults to FLUSH_EVERY.
+        """
+        self.flush_every = flush_every
+        self.stats = {THUMBNAIL_EXIF: 0, THUMBNAIL_DECODED: 0, 'none': 0}
+        self._pending: Dict[str, List[Tuple[str, dict, Union[bytes, None]]]] = {}
+        self._lock = threading.Lock()  # add is called from the --async move threads
+
+    def add(self, path: str, dt: Union[datetime, None], model: Union[str, None],
+            src_name: Union[str, None]) -> None:
+        """Add a file that has been moved to a month directory.
+
+        Args:
+            path (str): new path of the file
+            dt (Union[datetime, None]): date of the picture
+            model (Union[str, None]): camera model
+            src_name (Union[str, None]): original file name
+        """
+        thumbnail, source, orientation = make_thumbnail(path)
+        entry = {'src': src_name, 'dt': dt.isoformat(sep=' ') if dt else None, 'model': model,
+                 'thumbnail': source, 'orientation': orientation}
+        directory, name = os.path.split(path)
+        with self._lock:
+            self.stats[source or 'none'] += 1
+            pending = self._pending.setdefault(directory, [])
+            pending.append((name, entry, thumbnail))
+            if len(pending) < self.flush_every:
+                return
+            del self._pending[directory]
+        self.write(directory, pending)
+
+    def flush(self, directory: Union[str, None] = None) -> None:
+        """Write the pending thumbnails of directory (of all directories if None)."""
+        with self._lock:
+            if directory is None:
+                pending, self._pending = self._pending, {}
+            else:
+                pending = {directory: self._pending.pop(directory, [])}
+        for month_dir, entries in pending.items():
+            if entries:
+                self.write(month_dir, entries)
+
+    @staticmethod
+    def write(directory: str,
+              entries: Iterable[Tuple[str, dict, Union[bytes, None]]],
+              removed: Iterable[str] = (),
+              rebuild: bool = False) -> None:
+        """Append thumbnails to the index of directory and rewrite its manifest.
+
+        The thumbnails are written first: if the manifest can't be written, the index is still
+        valid (it just has unused data at the end of the thumbnails file).
+
+        Args:
+            directory (str): month directory
+            entries (Iterable[Tuple[str, dict, Union[bytes, None]]]): file name, manifest entry
+                                                                      (without offset), thumbnail
+            removed (Iterable[str], optional): names to remove from the manifest. Defaults to ().
+            rebuild (bool, optional): start a new index instead of adding to the existing one.
+                                      Defaults to False.
+        """
+        manifest = {'thumbnails': THUMBNAILS_FILENAME, 'entries': {}}
+        if not rebuild:
+            manifest = read_manifest(directory)
+            for name in removed:
+                manifest['entries'].pop(name, None)
+        with open(os.path.join(directory, THUMBNAILS_FILENAME), 'wb' if rebuild else 'ab') as pack:
+            offset = pack.tell()
+            for name, entry, thumbnail in entries:
+                entry['offset'] = offset if thumbnail else None
+                entry['length'] = len(thumbnail) if thumbnail else None
+                if thumbnail:
+                    pack.write(thumbnail)
+                    offset += len(thumbnail)
+                manifest['entries'][name] = entry
+        manifest['entries'] = dict(sorted(manifest['entries'].items()))
+        tmp_filename = os.path.join(directory, MANIFEST_FILENAME + '.tmp')
+        with open(tmp_filename, 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(tmp_filename, os.path.join(directory, MANIFEST_FILENAME))
+
+
+def update_directory(directory: str, rebuild: bool = False) -> int:
+    """Add the files of directory that are not in its index yet, drop entries of removed files.
+
+    Args:
+        directory (str): month directory
+        rebuild (bool, optional): index all files again, in a new thumbnails file.
+                                  Defaults to False.
+
+    Returns:
+        int: number of files added to the index
+    """
+    indexed = read_manifest(directory)['entries']
+    names = {entry.name for entry in os.scandir(directory) if entry.is_file()
+             and os.path.splitext(entry.name)[1].lower() in METADATA_READERS}
+    entries = []
+    for name in sorted(names if rebuild else names - indexed.keys()):
+        jpg = PhotoRenamer(directory, name, None)
+        jpg.get_exif_data()
+        dt = jpg.dt_orig or jpg.dt
+        thumbnail, source, orientation = make_thumbnail(os.path.join(directory, name))
+        # the original name can't be read from the file, keep it from the previous index
+        entries.append((name, {'src': indexed.get(name, {}).get('src'),
+                               'dt': dt.isoformat(sep=' ') if dt else None, 'model': jpg.model,
+                               'thumbnail': source, 'orientation': orientation}, thumbnail))
+    removed = indexed.keys() - names
+    if entries or removed or rebuild:
+        MonthIndex.write(directory, entries, removed, rebuild)
+    return len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update the thumbnail index of month directories')
+    parser.add_argument('directories', nargs='+', help='month directories, or directories above')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='index all files again (removes unused thumbnail data)')
+    args = parser.parse_args()
+
+    added = 0
+    for root in args.directories:
+        for path, _, filenames in os.walk(root):
+            if any(os.path.splitext(name)[1].lower() in METADATA_READERS for name in filenames):
+                count = update_directory(path, args.rebuild)
+                if count:
+                    print(f'{path}: {count} files added')
+                added += count
+    print(f'{added} files added to the index')
@@ -0,0 +1,224 @@
+"""Move files, with a verified copy when source and target are on different filesystems.
+
+On the same filesystem a move is a rename. Across filesystems (the rename fails with EXDEV) the
+file is copied with large buffers while hashing the data, the copy is read back and compared, and
+only then the source is removed. shutil.move would silently do an unverified copy with small
+buffers in that case.
+
+An existing target is never replaced, both ways raise FileExistsError. The caller checks names in
+an index of the target (see target_index), which can be out of date; os.rename would silently
+replace a file that was added by another process.
+"""
+
+import ctypes
+import errno
+import hashlib
+import os
+import shutil
+import threading
+from time import perf_counter
+from typing import Set, Tuple
+
+import metrics
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+VERIFY_COPY: bool = True  # read back copies before removing the source
+
+stats = {'renamed': 0, 'copied': 0, 'bytes_copied': 0, 'copy_seconds': 0.0}
+stats_lock = threading.Lock()
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+_cross_device: Set[Tuple[str, str]] = set()  # (source dir, target dir) pairs that can't rename
+RENAME_NOREPLACE = 1  # renameat2 flag (Linux)
+AT_FDCWD = -100
+# errors of renameat2 and link on filesystems that don't support them (EPERM: no hard links)
+NOREPLACE_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM}
+_no_renameat2: Set[Tuple[str, str]] = set()  # (source dir, target dir) pairs to link instead
+_no_link: Set[Tuple[str, str]] = set()  # (source dir, target dir) pairs to check and rename
+
+try:
+    _renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    _renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p,
+                           ctypes.c_uint]
+except (AttributeError, OSError, TypeError):  # not Linux, or glibc < 2.28
+    _renameat2 = None
+
+
+class CopyVerificationError(OSError):
+    """The copy doesn't match the source, the source has not been removed."""
+
+
+def move_file(src_file: str, target_file: str) -> str:
+    """Move src_file to target_file.
+
+    Args:
+        src_file (str): file to move
+        target_file (str): new path, its directory should exist
+
+    Returns:
+        str: target_file
+    """
+    with metrics.timed('move'):
+        return _move_file(src_file, target_file)
+
+
+def _move_file(src_file: str, target_file: str) -> str:
+    dirs = (os.path.dirname(src_file), os.path.dirname(target_file))
+    if dirs not in _cross_device:
+        try:
+            rename_noreplace(src_file, target_file, dirs)
+        except FileExistsError:
+            raise
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            _cross_device.add(dirs)
+        else:
+            with stats_lock:
+                stats['renamed'] += 1
+            return target_file
+
+    start = perf_counter()
+    size = copy_verified(src_file, target_file)
+    os.remove(src_file)
+    with stats_lock:
+        stats['copied'] += 1
+        stats['bytes_copied'] += size
+        stats['copy_seconds'] += perf_counter() - start
+    return target_file
+
+
+def rename_noreplace(src_file: str, target_file: str, dirs: Tuple[str, str]) -> None:
+    """Rename src_file to target_file, unless target_file exists.
+
+    renameat2 with RENAME_NOREPLACE (Linux) checks and renames in one step. Where that is not
+    supported, os.link (which fails if the target exists) and os.remove are used. On filesystems
+    without hard links either, the target is checked right before os.rename.
+
+    Args:
+        src_file (str): file to rename
+        target_file (str): new name
+        dirs (Tuple[str, str]): directories of src_file and target_file, to remember which way
+                                works
+
+    Raises:
+        FileExistsError: if target_file exists
+        OSError: errno EXDEV if the files are on different filesystems
+    """
+    if _renameat2 is not None and dirs not in _no_renameat2:
+        if _renameat2(AT_FDCWD, os.fsencode(src_file), AT_FDCWD, os.fsencode(target_file),
+                      RENAME_NOREPLACE) == 0:
+            return
+        err = ctypes.get_errno()
+        if err not in NOREPLACE_UNSUPPORTED_ERRNOS:
+            raise OSError(err, os.strerror(err), src_file, None, target_file)
+        _no_renameat2.add(dirs)
+    if dirs not in _no_link:
+        try:
+            os.link(src_file, target_file, follow_symlinks=False)
+        except OSError as err:
+            if err.errno not in NOREPLACE_UNSUPPORTED_ERRNOS:
+                raise
+            _no_link.add(dirs)
+        else:
+            try:
+                os.remove(src_file)
+            except BaseException:
+                os.remove(target_file)
+                raise
+            return
+    if os.path.lexists(target_file):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), target_file)
+    os.rename(src_file, target_file)
+
+
+def copy_verified(src_file: str, target_file: str) -> int:
+    """Copy src_file to target_file (which may not exist yet).
+
+    With VERIFY_COPY, the data is hashed while it is copied with large buffers, and the copy is
+    read back and compared with that hash. Without it, the kernel copies the data (see
+    kernel_copy). Timestamps and permissions are copied as well. A failed
+    copy is removed.
+
+    Args:
+        src_file (str): file to copy
+        target_file (str): new file
+
+    Raises:
+        CopyVerificationError: if the copy doesn't match the source
+
+    Returns:
+        int: number of bytes copied
+    """
+    with open(src_file, 'rb', buffering=0) as src:
+        target = open(target_file, 'xb', buffering=0)  # never overwrite an existing file
+        try:
+            with target:
+                if VERIFY_COPY:
+                    size, src_digest = copy_and_hash(src, target)
+                else:
+                    size = kernel_copy(src, target)
+            if VERIFY_COPY and hash_file(target_file) != src_digest:
+                raise CopyVerificationError(f'Copy of {src_file} to {target_file} does not match')
+            shutil.copystat(src_file, target_file)
+        except BaseException:
+            os.remove(target_file)
+            raise
+    return size
+
+
+def copy_and_hash(src, target) -> Tuple[int, bytes]:
+    """Copy all data from src to target (unbuffered files), return size and hash of the data."""
+    digest = hashlib.blake2b()
+    size = 0
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while count := src.readinto(buffer):
+        digest.update(view[:count])
+        written = 0
+        while written < count:
+            written += target.write(view[written:count])
+        size += count
+    return size, digest.digest()
+
+
+def kernel_copy(src, target) -> int:
+    """Copy all data from src to target without passing it through Python, return the size.
+
+    os.copy_file_range is tried first, then os.sendfile. Not every kernel/filesystem supports
+    these between different filesystems, in that case the data is copied with copy_and_hash.
+    """
+    for copy_function in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if copy_function is None:
+            continue
+        size = 0
+        try:
+            if copy_function is os.sendfile:
+                while count := os.sendfile(target.fileno(), src.fileno(), size, COPY_BUFFER_SIZE):
+                    size += count
+            else:
+                while count := os.copy_file_range(src.fileno(), target.fileno(), COPY_BUFFER_SIZE):
+                    size += count
+            return size
+        except OSError as err:
+            if size or err.errno not in UNSUPPORTED_ERRNOS:
+                raise
+    return copy_and_hash(src, target)[0]
+
+
+def hash_file(path: str) -> bytes:
+    """Hash a file, reading it with COPY_BUFFER_SIZE reads."""
+    digest = hashlib.blake2b()
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while count := file.readinto(buffer):
+            digest.update(view[:count])
+    return digest.digest()
+
+
+def throughput() -> float:
+    """Average copy throughput in MB/s (0 if nothing has been copied)."""
+    with stats_lock:
+        if not stats['copy_seconds']:
+            return 0.0
+        return stats['bytes_copied'] / 1e6 / stats['copy_seconds']
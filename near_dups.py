@@ -0,0 +1,259 @@
+"""Perceptual near-duplicate detection: re-encoded copies, edited exports, burst frames.
+
+Every picture gets a 64 bit difference hash (dHash) of a 9x8 grayscale version of the picture.
+Pictures that look alike have hashes that differ in only a few bits. The picture is taken from
+the exif thumbnail if there is one, otherwise the JPEG is decoded at 1/8 scale (Pillow's draft
+mode), so full size pictures are never decoded. Cameras letterbox the thumbnail of a picture with
+another aspect ratio (i.e. 16:9 in a 160x120 thumbnail); those bars are cropped, so both ways
+give the same picture. Hashes are stored in the MetadataCache.
+
+Pairs within the Hamming distance threshold are found with multi-index hashing: the hash is
+split in threshold + 1 chunks, and two hashes within the threshold are equal in at least one
+chunk. Only hashes sharing a chunk value are compared, instead of every pair.
+
+Run as a script to print groups of similar pictures for review:
+python near_dups.py [--threshold N] [--jobs N] DIR [DIR ...]
+"""
+
+import argparse
+import io
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from PIL import Image, ImageStat
+
+from dedup import METADATA_CACHE_FILENAME, walk_files
+from exif_header import HeaderParseError, read_exif_thumbnail
+from metadata_cache import MetadataCache
+from photo_renamer import JPEG_EXTENSIONS
+
+HASH_SIZE = 8  # hash of HASH_SIZE x HASH_SIZE bits
+HASH_BITS = HASH_SIZE * HASH_SIZE
+DEFAULT_THRESHOLD = 4  # max differing bits; higher thresholds make the chunks (and search) slower
+LETTERBOX_MAX = 16  # mean brightness of letterbox bars (JPEG ringing makes a few pixels lighter)
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def dhash(image: Image.Image) -> int:
+    """Difference hash: is each pixel darker than its right neighbour, in a 9x8 grayscale image."""
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        start = row * (HASH_SIZE + 1)
+        for col in range(start, start + HASH_SIZE):
+            value = value << 1 | (pixels[col] < pixels[col + 1])
+    return value
+
+
+def strip_letterbox(thumbnail: Image.Image, size: Tuple[int, int]) -> Image.Image:
+    """Crop the dark bars a thumbnail has when the picture has another aspect ratio.
+
+    Only the part outside the aspect ratio of the picture is cropped, and only if it is dark, so
+    dark parts of the picture itself are never cropped.
+
+    Args:
+        thumbnail (Image.Image): the thumbnail
+        size (Tuple[int, int]): width and height of the picture (as stored, not rotated)
+
+    Returns:
+        Image.Image: the thumbnail without letterbox bars
+    """
+    width, height = thumbnail.size
+    if width * size[1] > height * size[0]:  # bars left and right
+        content = round(height * size[0] / size[1])
+        bar = (width - content) // 2
+        bars = [(0, 0, bar, height), (bar + content, 0, width, height)]
+        box = (bar, 0, bar + content, height)
+    else:  # bars at the top and bottom (or none)
+        content = round(width * size[1] / size[0])
+        bar = (height - content) // 2
+        bars = [(0, 0, width, bar), (0, bar + content, width, height)]
+        box = (0, bar, width, bar + content)
+    if bar < 1:
+        return thumbnail
+    gray = thumbnail.convert('L')
+    if any(ImageStat.Stat(gray.crop(bar_box)).mean[0] > LETTERBOX_MAX for bar_box in bars):
+        return thumbnail  # not letterboxed (i.e. stretched or cropped by the camera)
+    return thumbnail.crop(box)
+
+
+def perceptual_hash(path: str) -> Union[int, None]:
+    """Compute the dHash of a JPEG file, from its exif thumbnail if it has one.
+
+    Args:
+        path (str): JPEG file
+
+    Returns:
+        Union[int, None]: 64 bit hash, None if the file can't be decoded
+    """
+    try:
+        with open(path, 'rb') as file:
+            try:
+                thumbnail = read_exif_thumbnail(file)
+            except HeaderParseError:
+                thumbnail = None
+            file.seek(0)
+            image = Image.open(file)  # only reads the header
+            orientation = image.getexif().get(ORIENTATION_TAG)
+            if thumbnail:
+                image = strip_letterbox(Image.open(io.BytesIO(thumbnail)), image.size)
+            else:
+                image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+            if orientation in ORIENTATION_TRANSPOSE:
+                image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+            return dhash(image)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+class MultiIndex:
+    def __init__(self, threshold: int = DEFAULT_THRESHOLD):
+        """Index of hashes, to find all pairs within threshold differing bits.
+
+        Args:
+            threshold (int, optional): max Hamming distance. Defaults to DEFAULT_THRESHOLD.
+        """
+        self.threshold = threshold
+        chunks = threshold + 1
+        bounds = [HASH_BITS * idx // chunks for idx in range(chunks + 1)]
+        self.chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds, bounds[1:])]
+        self.tables: List[Dict[int, List[int]]] = [defaultdict(list) for _ in self.chunks]
+        self.hashes: List[int] = []
+        self.comparisons = 0
+
+    def add(self, phash: int) -> int:
+        """Add a hash, return its index."""
+        index = len(self.hashes)
+        self.hashes.append(phash)
+        for table, (shift, mask) in zip(self.tables, self.chunks):
+            table[phash >> shift & mask].append(index)
+        return index
+
+    def pairs(self) -> Iterator[Tuple[int, int, int]]:
+        """Yield (index, index, distance) of every pair within the threshold, once."""
+        hashes = self.hashes
+        threshold = self.threshold
+        for chunk, table in enumerate(self.tables):
+            for bucket in table.values():
+                for position, first in enumerate(bucket):
+                    first_hash = hashes[first]
+                    for second in bucket[position + 1:]:
+                        self.comparisons += 1
+                        distance = (first_hash ^ hashes[second]).bit_count()
+                        if distance <= threshold and self.first_equal_chunk(
+                                first_hash, hashes[second]) == chunk:
+                            yield first, second, distance
+
+    def first_equal_chunk(self, first: int, second: int) -> int:
+        """Index of the first chunk in which the hashes are equal (pairs are reported there)."""
+        for chunk, (shift, mask) in enumerate(self.chunks):
+            if (first ^ second) >> shift & mask == 0:
+                return chunk
+        return -1
+
+
+def group_pairs(pairs: Iterable[Tuple[int, int, int]]) -> List[List[int]]:
+    """Group indexes that are connected by pairs (union-find)."""
+    parent: Dict[int, int] = {}
+
+    def root(index: int) -> int:
+        while parent.setdefault(index, index) != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for first, second, _ in pairs:
+        parent[root(first)] = root(second)
+    groups = defaultdict(list)
+    for index in parent:
+        groups[root(index)].append(index)
+    return list(groups.values())
+
+
+def hash_files(paths: Iterable[str], cache: Union[MetadataCache, None] = None,
+               jobs: int = 4, logger: Union[logging.Logger, None] = None) -> Dict[str, int]:
+    """Perceptual hashes of the JPEG files in paths, cached ones are not computed again.
+
+    Args:
+        paths (Iterable[str]): files (files that are not JPEG files are skipped)
+        cache (Union[MetadataCache, None], optional): hash store. Defaults to None.
+        jobs (int, optional): threads decoding pictures. Defaults to 4.
+        logger (Union[logging.Logger, None], optional): where to log to. Defaults to None.
+
+    Returns:
+        Dict[str, int]: path -> hash, for the files that could be decoded
+    """
+    logger = logger or logging.getLogger(__name__)
+
+    def hash_file(path: str) -> Tuple[str, Union[int, None]]:
+        try:
+            stat = os.stat(path)
+        except OSError as err:  # removed or unreadable since it was found
+            logger.warning('Can\'t read "%s": %s', path, err)
+            return path, None
+        phash = cache.get_phash(path, stat) if cache else None
+        if phash is None:
+            phash = perceptual_hash(path)
+            if cache and phash is not None:
+                cache.put_phash(path, stat, phash)
+        return path, phash
+
+    jpegs = (path for path in paths if os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return {path: phash for path, phash in executor.map(hash_file, jpegs)
+                if phash is not None}
+
+
+def find_near_duplicates(hashes: Dict[str, int],
+                         threshold: int = DEFAULT_THRESHOLD) -> List[List[Tuple[str, int]]]:
+    """Group pictures whose hashes are within threshold of each other (directly or via others).
+
+    Args:
+        hashes (Dict[str, int]): path -> perceptual hash
+        threshold (int, optional): max Hamming distance. Defaults to DEFAULT_THRESHOLD.
+
+    Returns:
+        List[List[Tuple[str, int]]]: groups of (path, distance to the first path), the largest
+                                     file of the group first
+    """
+    paths = list(hashes)
+    index = MultiIndex(threshold)
+    for path in paths:
+        index.add(hashes[path])
+    groups = []
+    for group in group_pairs(index.pairs()):
+        members = sorted((paths[idx] for idx in group), key=os.path.getsize, reverse=True)
+        first = hashes[members[0]]
+        groups.append([(path, (first ^ hashes[path]).bit_count()) for path in members])
+    return groups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print groups of similar pictures')
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD,
+                        help=f'max differing bits of {HASH_BITS} (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--jobs', type=int, default=4, help='decoding threads (default: 4)')
+    args = parser.parse_args()
+
+    cache = MetadataCache(METADATA_CACHE_FILENAME)
+    hashes = hash_files(walk_files(args.directories), cache, args.jobs)
+    groups = find_near_duplicates(hashes, args.threshold)
+    for group in groups:
+        print('\n'.join(f'{distance:>2} {os.path.getsize(path):>10} {path}'
+                        for path, distance in group) + '\n')
+    print(f'{len(hashes)} pictures hashed, {sum(map(len, groups))} in {len(groups)} groups')
+    cache.close()
@@ -1,17 +1,54 @@
 from datetime import datetime
+import logging
 import os
-import shutil
-from typing import Tuple, Union, List
+from typing import Dict, Tuple, Union, List
 from exif import Image
+from exif_header import read_exif_header, read_tiff_header, HeaderParseError
+from bmff_header import read_bmff_header
+from classifier import Classification
+from metadata_cache import MetadataCache
+from dedup import Deduplicator, append_double
+from target_index import TargetIndex
+import metrics
+import mover
 
 DOUBLES_FILENAME = 'doubles.list'
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+# header readers by (lower case) extension, all return the tags of exif_header.read_exif_header
+METADATA_READERS = {
+    '.jpg': read_exif_header,
+    '.jpeg': read_exif_header,
+    '.heic': read_bmff_header,
+    '.heif': read_bmff_header,
+    '.mp4': read_bmff_header,
+    '.mov': read_bmff_header,
+    # TIFF based raw files, processed with --include (i.e. --include 'DSC*.ARW')
+    '.arw': read_tiff_header,
+    '.nef': read_tiff_header,
+    '.nrw': read_tiff_header,
+    '.dng': read_tiff_header,
+    '.cr2': read_tiff_header,
+    '.pef': read_tiff_header,
+    '.srw': read_tiff_header,
+    '.tif': read_tiff_header,
+    '.tiff': read_tiff_header,
+}
+EMPTY_TAGS = {'datetime': None, 'datetime_original': None, 'model': None}
 
 
 class PhotoRenamer:
-    def __init__(self, src_path, file, logger):
+    # one instance per file in flight, no __dict__ per instance
+    __slots__ = ('logger', 'path', 'src_file', 'classification', 'dt', 'dt_orig', 'model')
+
+    def __init__(self, src_path, file, logger,
+                 classification: Union[Classification, None] = None):
         self.logger = logger
         self.path = src_path
         self.src_file = file
+        # result of classifier.Classifier.classify for the file name, only the extension is known
+        # if not given
+        self.classification = classification or Classification(
+            os.path.splitext(file)[1].lower(), None, None, ())
 
     def rename_if_jpeg(self) -> None:
         """If file exention is .jpeg, rename to .jpg and update self.src_file"""
@@ -19,79 +56,103 @@ class PhotoRenamer:
             return
         jpg_filename = self.src_file[:-5] + '.jpg'
         if self.logger:
-            self.logger.info('Renaming "{}" to "{}"'.format(self.src_file, jpg_filename))
+            self.logger.info('Renaming "%s" to "%s"', self.src_file, jpg_filename)
         os.rename(os.path.join(self.path, self.src_file), os.path.join(self.path, jpg_filename))
         self.src_file = jpg_filename
 
-    def get_exif_data(self) -> bool:
+    def get_exif_data(self, cache: Union[MetadataCache, None] = None) -> bool:
         """Populate properties from exif data.
 
         Populate self.dt, self.dt_orig, self.model
 
+        Args:
+            cache (Union[MetadataCache, None], optional): If given, the file is only opened if its
+                                                          exif data is not in the cache yet.
+                                                          Defaults to None.
+
         Returns:
             bool: True is self.dt or self.dt_orig has succesfully been parsed.
         """
-        with open(os.path.join(self.path, self.src_file), 'rb') as src_file:
-            exif_src = Image(src_file)
+        src_path = os.path.join(self.path, self.src_file)
+        exif_tags = None
+        if cache:
+            stat = os.stat(src_path)
+            exif_tags = cache.get(src_path, stat)
 
-            # get datetime
-            try:
-                dt = getattr(exif_src, 'datetime')
-                self.dt = datetime.strptime(dt, '%Y:%m:%d %H:%M:%S')
-            except (KeyError, ValueError, AttributeError):
-                self.dt = None
+        if exif_tags is None:
+            ext = self.classification.ext
+            with metrics.timed('exif'), open(src_path, 'rb') as src_file:
+                try:
+                    exif_tags = METADATA_READERS.get(ext, read_exif_header)(src_file)
+                except HeaderParseError:
+                    if ext not in JPEG_EXTENSIONS:
+                        exif_tags = EMPTY_TAGS
+                    else:
+                        # fast path can't handle this header, let exif parse the complete file
+                        src_file.seek(0)
+                        exif_tags = self.read_exif_full(src_file)
+            if cache:
+                cache.put(src_path, stat, exif_tags)
 
-            # get datetime_original
-            try:
-                dt_orig = getattr(exif_src, 'datetime_original')
-                self.dt_orig = datetime.strptime(dt_orig, '%Y:%m:%d %H:%M:%S')
-            except (KeyError, ValueError, AttributeError):
-                self.dt_orig = None
-
-            # get model
-            try:
-                self.model = getattr(exif_src, 'model')
-            except (KeyError, AttributeError):
-                self.model = None
+        self.dt = self.parse_exif_dt(exif_tags['datetime'])
+        self.dt_orig = self.parse_exif_dt(exif_tags['datetime_original'])
+        self.model = exif_tags['model']
 
         properties = (self.dt, self.dt_orig, self.model)
-        if not all(properties):
-            issues = []
-            if not self.dt:
-                issues.append('dt')
-            if not self.dt_orig:
-                issues.append('dt_orig')
-            if not self.model:
-                issues.append('model')
-            msg = 'Could not get the following exif data for file {}: '.format(self.src_file)
-            msg += ','.join(issues)
-            self.logger.info(msg)
+        # no logger with LOG_RECORDS (the decision record has the exif data)
+        if self.logger and not all(properties) and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Could not get the following exif data for file %s: %s',
+                             self.src_file, ','.join(name for name, value in zip(
+                                 ('dt', 'dt_orig', 'model'), properties) if not value))
 
         return bool(self.dt or self.dt_orig)
 
+    @staticmethod
+    def read_exif_full(src_file) -> Dict[str, Union[str, None]]:
+        """Read datetime, datetime_original and model by parsing the complete file with exif.
+
+        Args:
+            src_file: File opened in binary mode
+
+        Returns:
+            Dict[str, Union[str, None]]: tag values, None if not available
+        """
+        exif_src = Image(src_file)
+        exif_tags = {}
+        for tag in ('datetime', 'datetime_original', 'model'):
+            try:
+                exif_tags[tag] = getattr(exif_src, tag)
+            except (KeyError, ValueError, AttributeError):
+                exif_tags[tag] = None
+        return exif_tags
+
+    @staticmethod
+    def parse_exif_dt(dt: Union[str, None]) -> Union[datetime, None]:
+        """Convert exif datetime string to datetime, None if missing or invalid."""
+        if not dt:
+            return None
+        try:
+            return datetime.strptime(dt, '%Y:%m:%d %H:%M:%S')
+        except ValueError:
+            return None
+
     def check_whatsapp(self) -> Union[bool, None]:
-        """ Check if filename matches whatsapp pattern and extract date and set number.
-        example filename: IMG-20181108-WA0025
+        """ Check if filename matches a messenger (WhatsApp, Signal) pattern and use its date.
+        example filenames: IMG-20181108-WA0025 (VID-20181108-WA0025 for videos),
+        signal-2020-01-31-123456 (see classifier.MESSENGER_PATTERNS)
         Returns True succesful
-        Returns False if not
+        Returns False if the date in the name is invalid
+        Returns None if the name doesn't match
         TODO: maybe files can have a WA filename with correct original date,
                 but have exif data that doesn't match.
         TODO: If that is possible, check first if whatsapp image, then overwrite exif dt_orig.
         """
-        if os.path.split(self.src_file)[1][:4] == 'IMG-':
-            try:
-                without_ext = os.path.splitext(os.path.split(self.src_file)[1])[0]
-                self.dt = datetime.strptime(without_ext[4:12], '%Y%m%d')
-                number = int(without_ext[-4:])
-                self.dt = self.dt.replace(minute=number // 60, second=number % 60)
-
-            except Exception:
-                return False
-
-            else:
-                return True
-        else:
+        if not self.classification.messenger:
             return None
+        if not self.classification.messenger_dt:
+            return False
+        self.dt = self.classification.messenger_dt
+        return True
 
     def dt_matches_dt_orig(self) -> bool:
         """ check if both datetimes are filled in and match.
@@ -104,7 +165,6 @@ class PhotoRenamer:
     def new_filename(self,
                      target_path: str,
                      include_cam_model: bool = True,
-                     keywords_to_keep: Union[str, None] = None,
                      replace_chars_in_model: Union[None, List[str]] = None) -> Tuple[str, str]:
         """Generate new filename based on target path and picture properties
 
@@ -112,9 +172,6 @@ class PhotoRenamer:
             target_path (str): Base path for target
             include_cam_model (bool, optional): Add camera model (if available)to filename. 
                                                 Defaults to True.
-            keywords_to_keep (Union[str, None], optional): Certain keywords that should be kept if
-                                                           they are in orig filename (BURST,...)
-                                                           Defaults to None.
             replace_chars_in_model (Union[None, list[str]], optional): List of lists containing . Defaults to None.
 
         Returns:
@@ -124,17 +181,18 @@ class PhotoRenamer:
         date_source = self.dt_orig or self.dt
         new_filename += date_source.strftime('%Y%m%d_%H%M%S')
 
-        if keywords_to_keep:
-            for keyword in keywords_to_keep:
-                if keyword in self.src_file:
-                    new_filename += '_' + keyword
+        # keywords to keep (BURST,...) that were found in the orig filename by the classifier
+        for keyword in self.classification.keywords:
+            new_filename += '_' + keyword
 
         if include_cam_model and self.model and replace_chars_in_model:
+            model = self.model
             for i, j in replace_chars_in_model:
-                self.model = self.model.replace(i, j)
-            new_filename += '(_{})'.format(self.model)
+                model = model.replace(i, j)
+            new_filename += '(_{})'.format(model)
 
-        new_filename += '.jpg'
+        ext = self.classification.ext
+        new_filename += '.jpg' if ext in JPEG_EXTENSIONS else ext
         year = str(date_source.year)
         month = ('{:02d}'.format(date_source.month))
         target_dir = os.path.join(target_path, year, month)
@@ -144,7 +202,9 @@ class PhotoRenamer:
                   src_file: str,
                   new_path: str,
                   new_filename: str,
-                  process_doubles: bool = True) -> Tuple[Union[str, None], bool]:
+                  process_doubles: bool = True,
+                  deduplicator: Union[Deduplicator, None] = None,
+                  target_index: Union[TargetIndex, None] = None) -> Tuple[Union[str, None], bool]:
         """Move source file to new path and filename.
 
         Args:
@@ -153,6 +213,15 @@ class PhotoRenamer:
             new_filename (str): target filename
             process_doubles (bool, optional): If target already exists, generate new filename. 
                                               Defaults to True.
+            deduplicator (Union[Deduplicator, None], optional): If given, existing targets are
+                                                                compared by content: identical
+                                                                files are handled by its policy,
+                                                                different files always get a new
+                                                                filename. Defaults to None.
+            target_index (Union[TargetIndex, None], optional): If given, existing targets and
+                                                               directories are looked up in the
+                                                               index instead of on disk.
+                                                               Defaults to None.
 
         Returns:
             Tuple[Union[str,None], bool]: filename if new file was moved (None if not),
@@ -160,12 +229,33 @@ class PhotoRenamer:
         """
 
         ideal_target_file = os.path.join(new_path, new_filename)
-        target_file = self.generate_unique_filename(ideal_target_file, process_doubles, src_file)
+        with metrics.timed('unique'):
+            if deduplicator:
+                target_file = deduplicator.unique_target(src_file, ideal_target_file,
+                                                         target_index)
+            else:
+                target_file = self.generate_unique_filename(ideal_target_file, process_doubles,
+                                                            src_file, target_index)
         is_double = (target_file != ideal_target_file)
         if target_file:
-            if not os.path.isdir(new_path):
-                os.makedirs(new_path)
-            return (shutil.move(src_file, target_file), is_double)
+            if target_index:
+                target_index.makedirs(new_path)
+            else:
+                with metrics.timed('makedirs'):
+                    if not os.path.isdir(new_path):
+                        os.makedirs(new_path)
+            try:
+                moved_file = mover.move_file(src_file, target_file)
+            except FileExistsError:
+                if not target_index:
+                    raise
+                # added by another process since the directory was indexed: list it again
+                target_index.forget(new_path)
+                return self.move_file(src_file, new_path, new_filename, process_doubles,
+                                      deduplicator, target_index)
+            if target_index:
+                target_index.add(target_file)
+            return (moved_file, is_double)
         else:
             return (None, is_double)
         """Generate unique filename (if required)
@@ -176,7 +266,10 @@ class PhotoRenamer:
 
     def generate_unique_filename(self, base_filename: str,
                                  process_doubles: bool,
-                                 src_file:str) -> Union[str, None]:
+                                 src_file:str,
+                                 target_index: Union[TargetIndex, None] = None,
+                                 doubles_list: Union[str, None] = DOUBLES_FILENAME
+                                 ) -> Union[str, None]:
         """Generate a unique target file name
 
         If target file name already exists, add underscore and counter until target filename is
@@ -187,22 +280,35 @@ class PhotoRenamer:
             process_doubles (bool): proceed with generating alternative filenames if 
                                     target already exists
             src_filename (str): the original filename, used to log if double
+            target_index (Union[TargetIndex, None], optional): look up existing files in the
+                                                               index instead of on disk.
+                                                               Defaults to None.
+            doubles_list (Union[str, None], optional): list to add doubles to, None to not list
+                                                       them. Defaults to DOUBLES_FILENAME.
 
         Returns:
             Union[str, None]: None if target exists but process_doubles is True
                               str if a new, unique filename has been generated
         """
-        if not os.path.isfile(base_filename):
+        if target_index:
+            if not target_index.exists(base_filename):
+                return base_filename
+        elif not os.path.isfile(base_filename):
             return base_filename
 
-        with open(DOUBLES_FILENAME, 'a+') as file:
-            file.write(src_file + '\n')
+        if doubles_list:
+            append_double(doubles_list, src_file, base_filename)
         if not process_doubles:
             return None
-        counter = 1
         filename, ext = base_filename.rsplit('.', 1)
         new_filename = filename + '_COPY[{}]' + '.' + ext
-        while os.path.exists(new_filename.format(counter)):
-            counter += 1
-        self.logger.info('Double filename: {}'.format(new_filename.format(counter)))
-        return new_filename.format(counter)
+        if target_index:
+            new_filename = target_index.next_free_copy(new_filename)
+        else:
+            counter = 1
+            while os.path.exists(new_filename.format(counter)):
+                counter += 1
+            new_filename = new_filename.format(counter)
+        if self.logger:
+            self.logger.info('Double filename: %s', new_filename)
+        return new_filename
@@ -0,0 +1,146 @@
+"""Move plans: decide all target names first, move the files later.
+
+A plan is a JSON lines file with one entry per source file:
+{"src": ..., "target_dir": ..., "target_name": ..., "status": ..., "double": ...}
+Only entries with status PLAN_MOVE are moved. The other statuses (the STATUS_* values of
+sort_them and PLAN_DOUBLE) are kept in the plan so it can be reviewed.
+
+Making a plan doesn't write anything but the plan. Executing it moves the files and then adds
+the PLAN_DOUBLE entries to the doubles list. Every handled source file is appended to
+<plan>.done, so an interrupted execution can be resumed by executing the same plan again.
+"""
+
+import json
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Union
+
+from dedup import append_double
+from metadata_cache import MetadataCache
+from mover import move_file
+from target_index import TargetIndex
+
+PLAN_MOVE = 'move'  # file will be moved to target_dir/target_name
+PLAN_DOUBLE = 'double'  # target exists and doubles are not processed
+
+
+class PlanWriter:
+    def __init__(self, filename: str):
+        """Create (or overwrite) the plan file.
+
+        Args:
+            filename (str): JSON lines file to write to
+        """
+        self.filename = filename
+        self.entries = 0
+        self._file = open(filename, 'w')
+
+    def write(self, entry: dict) -> None:
+        self._file.write(json.dumps(entry) + '\n')
+        self.entries += 1
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_plan(filename: str) -> Iterator[dict]:
+    """Yield the entries of a plan file."""
+    with open(filename) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def group_by_target_dir(entries: Iterator[dict]) -> Dict[str, List[dict]]:
+    """Group the PLAN_MOVE entries by target directory, keeping the order of the plan."""
+    grouped = defaultdict(list)
+    for entry in entries:
+        if entry['status'] == PLAN_MOVE:
+            grouped[entry['target_dir']].append(entry)
+    return grouped
+
+
+def execute_plan(filename: str,
+                 logger: logging.Logger,
+                 cache: Union[MetadataCache, None] = None,
+                 count: Union[Callable[[str], None], None] = None,
+                 doubles_list: Union[str, None] = None) -> Dict[str, int]:
+    """Move the files of a plan, one target directory at a time.
+
+    Each target directory is created (if needed) and listed once. A target that exists already
+    (i.e. added after the plan was made) is never overwritten, the file is skipped instead.
+
+    Args:
+        filename (str): plan file
+        logger (logging.Logger): where to log to
+        cache (Union[MetadataCache, None], optional): cache to update for moved files.
+                                                      Defaults to None.
+        count (Union[Callable[[str], None], None], optional): called with 'moved' for every
+                                                              moved file. Defaults to None.
+        doubles_list (Union[str, None], optional): list to add the doubles of the plan to
+                                                   (after the files they are a double of have
+                                                   been moved). Defaults to None.
+
+    Returns:
+        Dict[str, int]: number of files moved, already done (resumed), skipped (conflict or
+                        missing source) and doubles listed
+    """
+    done_filename = filename + '.done'
+    done = set()
+    if os.path.isfile(done_filename):
+        with open(done_filename) as file:
+            done = {line.rstrip('\n') for line in file}
+    stats = {'moved': 0, 'resumed': 0, 'skipped': 0, 'doubles': 0}
+    target_index = TargetIndex()
+
+    with open(done_filename, 'a') as done_file:
+        for target_dir, entries in group_by_target_dir(read_plan(filename)).items():
+            target_index.makedirs(target_dir)
+            for entry in entries:
+                src_file = entry['src']
+                target_file = os.path.join(target_dir, entry['target_name'])
+                if src_file in done:
+                    stats['resumed'] += 1
+                    continue
+                if target_index.exists(target_file):
+                    if not os.path.exists(src_file):
+                        # moved, but interrupted before it was written to the done file
+                        stats['resumed'] += 1
+                    else:
+                        logger.warning('Target %s exists, not moving %s', target_file,
+                                       src_file)
+                        stats['skipped'] += 1
+                    continue
+                try:
+                    move_file(src_file, target_file)
+                except FileNotFoundError:
+                    logger.warning('Source file %s no longer exists', src_file)
+                    stats['skipped'] += 1
+                    continue
+                except FileExistsError:  # added after the directory was listed
+                    logger.warning('Target %s exists, not moving %s', target_file, src_file)
+                    stats['skipped'] += 1
+                    continue
+                target_index.add(target_file)
+                done_file.write(src_file + '\n')
+                logger.debug('moved file %s to %s', src_file, target_file)
+                stats['moved'] += 1
+                if count:
+                    count('moved')
+                if cache:
+                    cache.move_hashes(src_file, target_file)
+                    cache.discard(src_file)
+            done_file.flush()
+
+        if doubles_list:
+            for entry in read_plan(filename):
+                src_file = entry['src']
+                if entry['status'] != PLAN_DOUBLE or src_file in done:
+                    continue
+                if os.path.exists(src_file):
+                    append_double(doubles_list, src_file,
+                                  os.path.join(entry['target_dir'], entry['target_name']))
+                    stats['doubles'] += 1
+                done_file.write(src_file + '\n')
+    return stats
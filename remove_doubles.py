@@ -1,8 +1,227 @@
+"""Reclaim the space taken by the doubles in doubles.list.
+
+Every line of the list has a double (a file left in the source directory) and the file in the
+target directory it is a double of, separated by DOUBLES_SEPARATOR. The list is appended to by
+every run, so it is de-duplicated first. A double is only removed if the kept file still exists
+and has the same content: same size, same quick hash and same full hash (hashes are taken from
+the MetadataCache when the file hasn't changed). Lines written by older versions have no kept
+file and are never removed.
+
+The doubles are checked and removed (or moved to a trash directory, keeping their path) in
+batches on several threads, so the latency of network storage is spent in parallel. Afterwards
+the list is rewritten with only the entries that are still there and were not removed.
+
+Don't run this while sort_them.py is running, it may append to the list in the meantime.
+
+Run as a script:
+python remove_doubles.py [--trash DIR] [--dry-run] [--jobs N] [LIST]
+"""
+
+import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Dict, Iterator, List, Tuple, Union
+
+from dedup import DOUBLES_SEPARATOR, METADATA_CACHE_FILENAME, Deduplicator
+from metadata_cache import MetadataCache
+from mover import move_file
+from photo_renamer import DOUBLES_FILENAME
+
+RECLAIM_JOBS = 8  # threads checking and removing doubles
+BATCH_SIZE = 100  # doubles per task
+RECLAIMED = 'reclaimed'  # removed, or moved to the trash directory
+VERIFIED = 'verified'  # identical to the kept file, but not removed (dry run)
+GONE = 'gone'  # the double doesn't exist anymore
+KEPT_MISSING = 'kept_missing'  # the kept file doesn't exist (anymore)
+DIFFERENT = 'different'  # a different picture with the same target name
+UNVERIFIED = 'unverified'  # no kept file in the list (written by an older version)
+FAILED = 'failed'  # error reading or removing a file
+OUTCOMES = (RECLAIMED, VERIFIED, GONE, KEPT_MISSING, DIFFERENT, UNVERIFIED, FAILED)
+DROPPED_OUTCOMES = (RECLAIMED, GONE)  # left out of the compacted list
+
+
+def read_doubles(filename: str) -> Dict[str, Union[str, None]]:
+    """Read the doubles list, every double once.
+
+    Args:
+        filename (str): list file
+
+    Returns:
+        Dict[str, Union[str, None]]: double -> kept file (None if unknown), in the order of the
+                                     list. If a double is listed more than once, the last kept
+                                     file is used.
+    """
+    doubles: Dict[str, Union[str, None]] = {}
+    with open(filename) as file:
+        for line in file:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            src_file, _, kept_file = line.partition(DOUBLES_SEPARATOR)
+            doubles.pop(src_file, None)  # keep the order of the last occurrence
+            doubles[src_file] = kept_file or None
+    return doubles
+
+
+def write_doubles(filename: str, doubles: Dict[str, Union[str, None]]) -> None:
+    """Replace the doubles list (atomically, the old list stays if writing fails)."""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as file:
+        for src_file, kept_file in doubles.items():
+            file.write(src_file + (DOUBLES_SEPARATOR + kept_file if kept_file else '') + '\n')
+    os.replace(tmp_filename, filename)
+
+
+def trash_path(trash_dir: str, src_file: str) -> str:
+    """Path of src_file in the trash directory: its complete path below trash_dir."""
+    return Deduplicator.free_name(
+        os.path.join(trash_dir, os.path.splitdrive(os.path.abspath(src_file))[1].lstrip(os.sep)))
+
+
+def reclaim_double(deduplicator: Deduplicator,
+                   src_file: str,
+                   kept_file: Union[str, None],
+                   trash_dir: Union[str, None] = None,
+                   dry_run: bool = False) -> Tuple[str, int]:
+    """Check a double against the kept file and remove it if they are identical.
+
+    Args:
+        deduplicator (Deduplicator): compares the files (and holds the hash cache)
+        src_file (str): the double
+        kept_file (Union[str, None]): file it should be identical to
+        trash_dir (Union[str, None], optional): move the double here instead of removing it.
+                                                Defaults to None.
+        dry_run (bool, optional): only check. Defaults to False.
+
+    Returns:
+        Tuple[str, int]: one of OUTCOMES and the size of the double (0 if it doesn't exist)
+    """
+    try:
+        size = os.stat(src_file).st_size
+    except FileNotFoundError:
+        return GONE, 0
+    except OSError as err:
+        deduplicator.logger.warning('Can\'t read "%s": %s', src_file, err)
+        return FAILED, 0
+    if kept_file is None:
+        return UNVERIFIED, size
+    try:
+        if os.path.samefile(src_file, kept_file):  # same file (or a hard link): the only copy
+            return DIFFERENT, size
+        if not deduplicator.is_identical(src_file, kept_file):
+            return DIFFERENT, size
+    except FileNotFoundError:
+        return KEPT_MISSING, size
+    except OSError as err:
+        deduplicator.logger.warning('Can\'t compare "%s" to "%s": %s', src_file, kept_file, err)
+        return FAILED, size
+    if dry_run:
+        return VERIFIED, size
+    cache = deduplicator.cache
+    try:
+        if trash_dir:
+            target = trash_path(trash_dir, src_file)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            move_file(src_file, target)
+            if cache:
+                cache.move_hashes(src_file, target)
+        else:
+            os.remove(src_file)
+    except FileNotFoundError:
+        return GONE, 0
+    except OSError as err:
+        deduplicator.logger.warning('Can\'t remove "%s": %s', src_file, err)
+        return FAILED, size
+    if cache:
+        cache.discard(src_file)
+    return RECLAIMED, size
+
+
+def batches(doubles: Dict[str, Union[str, None]],
+            size: int = BATCH_SIZE) -> Iterator[List[Tuple[str, Union[str, None]]]]:
+    """Split the doubles in lists of size (double, kept file) pairs."""
+    items = list(doubles.items())
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def reclaim(filename: str,
+            deduplicator: Deduplicator,
+            trash_dir: Union[str, None] = None,
+            dry_run: bool = False,
+            jobs: int = RECLAIM_JOBS) -> Dict[str, Union[int, float]]:
+    """Remove the verified doubles of a doubles list and compact the list.
+
+    Args:
+        filename (str): doubles list
+        deduplicator (Deduplicator): compares the files (and holds the hash cache)
+        trash_dir (Union[str, None], optional): move doubles here instead of removing them.
+                                                Defaults to None.
+        dry_run (bool, optional): only check, don't remove anything or change the list.
+                                  Defaults to False.
+        jobs (int, optional): threads. Defaults to RECLAIM_JOBS.
+
+    Returns:
+        Dict[str, Union[int, float]]: number of doubles per outcome, 'listed' (lines in the list),
+                                      'doubles' (different doubles), 'bytes' (reclaimed, or
+                                      reclaimable in a dry run) and 'seconds'
+    """
+    start = perf_counter()
+    with open(filename) as file:
+        listed = sum(1 for line in file if line.strip())
+    doubles = read_doubles(filename)
+    stats: Dict[str, Union[int, float]] = dict.fromkeys(OUTCOMES, 0)
+    stats.update(listed=listed, doubles=len(doubles), bytes=0)
+    remaining = {}
+
+    def reclaim_batch(batch: List[Tuple[str, Union[str, None]]]) -> List[Tuple[str, int]]:
+        return [reclaim_double(deduplicator, src_file, kept_file, trash_dir, dry_run)
+                for src_file, kept_file in batch]
+
+    work = list(batches(doubles))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for batch, results in zip(work, executor.map(reclaim_batch, work)):
+            for (src_file, kept_file), (outcome, size) in zip(batch, results):
+                stats[outcome] += 1
+                if outcome in (RECLAIMED, VERIFIED):
+                    stats['bytes'] += size
+                if outcome not in DROPPED_OUTCOMES:
+                    remaining[src_file] = kept_file
+    if not dry_run:
+        write_doubles(filename, remaining)
+    stats['seconds'] = perf_counter() - start
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Remove the doubles in the doubles list that are identical to the kept file')
+    parser.add_argument('list', nargs='?', default=DOUBLES_FILENAME,
+                        help=f'doubles list (default: {DOUBLES_FILENAME})')
+    parser.add_argument('--trash', metavar='DIR',
+                        help='move the doubles to DIR (keeping their path) instead of removing them')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only check the doubles, don\'t remove anything or change the list')
+    parser.add_argument('--jobs', type=int, default=RECLAIM_JOBS,
+                        help=f'threads (default: {RECLAIM_JOBS})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help=f'don\'t use the hashes in {METADATA_CACHE_FILENAME}')
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else MetadataCache(METADATA_CACHE_FILENAME)
+    deduplicator = Deduplicator(cache=cache)
+    stats = reclaim(args.list, deduplicator, args.trash, args.dry_run, args.jobs)
+    if cache:
+        cache.close()
 
-with open('doubles.list') as f:
-    for line in f:
-        try:
-            os.remove(line.strip())
-        except FileNotFoundError:
-            pass
\ No newline at end of file
+    seconds = stats['seconds']
+    done = 'can be reclaimed' if args.dry_run else 'reclaimed'
+    print(f'{stats["listed"]} lines, {stats["doubles"]} doubles: '
+          + ', '.join(f'{stats[outcome]} {outcome}' for outcome in OUTCOMES if stats[outcome]))
+    print(f'{stats["bytes"] / 1e6:.1f} MB {done} in {seconds:.1f} s '
+          f'({stats["doubles"] / seconds if seconds else 0:.0f} files/s, '
+          f'{stats["bytes"] / 1e6 / seconds if seconds else 0:.1f} MB/s)')
+    print('Hashed: {0[quick_hashes]} quick, {0[full_hashes]} full'.format(deduplicator.stats))
+    if not args.dry_run and stats['doubles'] - stats[RECLAIMED] - stats[GONE]:
+        print(f'{stats["doubles"] - stats[RECLAIMED] - stats[GONE]} doubles left in {args.list}')
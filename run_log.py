@@ -0,0 +1,129 @@
+"""Logging off the hot path.
+
+Records are put on a queue as they are (not formatted) and written by a background thread, which
+takes every record waiting in the queue, formats them in one go, writes them with one write and
+flushes once per batch. The threads doing the work only pay for creating the record.
+
+Use %-style arguments (logger.debug('moved %s', file)) so messages below the log level are never
+formatted at all, and FileRecord for the structured one-line-per-file records.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+from typing import List
+
+LOG_BATCH_SIZE = 1000  # records written per write/flush at most
+LOG_QUEUE_SIZE = 10 * LOG_BATCH_SIZE  # records waiting, logging blocks when the writer lags
+
+
+class FileRecord:
+    """Message with the decision for one file, formatted as a compact json object when written."""
+    __slots__ = ('fields', )
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return json.dumps(self.fields, default=str, separators=(',', ':'))
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting the message to the writer thread.
+
+    The default QueueHandler formats the message before it is queued (so the record can be
+    pickled), which is exactly the work that should not be done on the hot path. Records never
+    leave this process, so they can be queued as they are.
+
+    When the queue is full (the log file can't be written as fast as records are created), the
+    logging thread waits, so memory doesn't grow with the backlog.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put(record)
+
+
+class BatchWriter(threading.Thread):
+    def __init__(self, log_queue: queue.SimpleQueue, handler: logging.StreamHandler):
+        """Thread writing the records in log_queue with handler, in batches.
+
+        Args:
+            log_queue (queue.Queue): queue the LazyQueueHandler puts the records in
+            handler (logging.StreamHandler): handler whose formatter and stream are used. For a
+                                             RotatingFileHandler, the file is rolled over (if
+                                             needed) before each batch.
+        """
+        super().__init__(name='log_writer', daemon=True)
+        self.queue = log_queue
+        self.handler = handler
+        self.batches = 0
+        self._stopped = False
+
+    def run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self.write([record for record in batch if record is not None])
+            if stop:
+                return
+
+    def write(self, records: List[logging.LogRecord]) -> None:
+        """Format records and write them with a single write and flush."""
+        handler = self.handler
+        lines = []
+        for record in records:
+            if record.levelno < handler.level or not handler.filter(record):
+                continue
+            try:
+                lines.append(handler.format(record) + handler.terminator)
+            except Exception:
+                handler.handleError(record)
+        if not lines:
+            return
+        text = ''.join(lines)
+        with handler.lock:
+            if isinstance(handler, logging.handlers.RotatingFileHandler) and handler.maxBytes:
+                if handler.stream.tell() + len(text) >= handler.maxBytes:
+                    handler.doRollover()
+            handler.stream.write(text)
+            handler.flush()
+        self.batches += 1
+
+    def stop(self) -> None:
+        """Write the records still in the queue and stop the thread."""
+        if self._stopped:
+            return
+        self._stopped = True
+        self.queue.put(None)
+        self.join()
+
+
+def start_logging(logger: logging.Logger, handler: logging.StreamHandler) -> BatchWriter:
+    """Route the records of logger through a queue to a BatchWriter using handler.
+
+    The writer is stopped (and the queue written) at exit at the latest.
+
+    Args:
+        logger (logging.Logger): logger to add the queue handler to
+        handler (logging.StreamHandler): handler that writes the records
+
+    Returns:
+        BatchWriter: the (started) writer thread
+    """
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    writer = BatchWriter(log_queue, handler)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
@@ -0,0 +1,74 @@
+"""Directory modification times of the previous run, used for incremental scanning.
+
+The mtime of a directory changes when an entry is added, removed or renamed in it. If it didn't
+change since the previous run, the directory doesn't have to be listed again: its files have
+been processed before and its subdirectories are known. Subdirectories still have to be checked
+(one stat each), because changes deeper in the tree don't update the mtime of the parents.
+"""
+
+import json
+import os
+from typing import Dict, List, Tuple, Union
+
+
+class ScanState:
+    def __init__(self, filename: Union[str, None]):
+        """Load the state of the previous run from filename (if it exists).
+
+        Args:
+            filename (Union[str, None]): json file to load from and save to, None for a state
+                                         that is only kept in memory
+        """
+        self.filename = filename
+        self.previous: Dict[str, Tuple[int, List[str]]] = {}
+        self.current: Dict[str, Tuple[int, List[str]]] = {}
+        self.listed: List[str] = []  # directories listed (not skipped) in this run
+        self.skipped = 0
+        if filename is None:
+            return
+        try:
+            with open(filename) as file:
+                self.previous = json.load(file)
+        except FileNotFoundError:
+            pass
+
+    def unchanged_subdirs(self, path: str, mtime_ns: int) -> Union[List[str], None]:
+        """Check if path is unchanged since the previous run.
+
+        If it is, it is recorded in the current state as well.
+
+        Args:
+            path (str): full path of the directory
+            mtime_ns (int): current mtime of the directory
+
+        Returns:
+            Union[List[str], None]: names of the subdirectories if unchanged, else None
+        """
+        previous = self.previous.get(path)
+        if not previous or previous[0] != mtime_ns:
+            return None
+        self.current[path] = previous
+        self.skipped += 1
+        return previous[1]
+
+    def record(self, path: str, mtime_ns: int, subdirs: List[str]) -> None:
+        """Record a directory that has been listed in this run.
+
+        Args:
+            path (str): full path of the directory
+            mtime_ns (int): mtime of the directory at the moment it was listed
+            subdirs (List[str]): names of the subdirectories
+        """
+        self.current[path] = (mtime_ns, subdirs)
+        self.listed.append(path)
+
+    def removed(self) -> List[str]:
+        """Directories of the previous run that were not found in this run."""
+        return [path for path in self.previous if path not in self.current]
+
+    def save(self) -> None:
+        """Save the current state, to be used in the next run."""
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as file:
+            json.dump(self.current, file)
+        os.replace(tmp_filename, self.filename)
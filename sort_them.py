@@ -1,88 +1,161 @@
 # TODO: handling of whatsapp files that have no datetime in exif, but do have in filename
-# TODO: use command line arguments for paths, PROCESS_DOUBLES and DT_AND_DT_ORIG_NEED_TO_MATCH
-# TODO: Options for doubles: move to separate dir, delete, copy with new filename, log
-# TODO: In status print: total amount of photos, start or elapsed time
+# TODO: use command line arguments for PROCESS_DOUBLES and DT_AND_DT_ORIG_NEED_TO_MATCH
 
+import asyncio
+import cProfile
 import logging, logging.handlers
 import os
 import threading
-from time import sleep
-from typing import Iterator, List, Tuple
-from photo_renamer import PhotoRenamer as pr
-from datetime import datetime
-from fnmatch import fnmatch as filename_match
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+from get_arguments import get_arguments
+from metadata_cache import MetadataCache
+from month_index import MonthIndex
+import metrics
+import mover
+import run_log
+from run_log import FileRecord
+from planner import PlanWriter, PLAN_DOUBLE, PLAN_MOVE, execute_plan
+from scan_state import ScanState
+from target_index import TargetIndex
+from watcher import Debouncer, InotifyWatcher, PollingWatcher
+from work_ledger import WorkLedger, from_key, to_key
+from dedup import Deduplicator
+from photo_renamer import PhotoRenamer as pr, DOUBLES_FILENAME
+from datetime import datetime, timedelta
+from classifier import Classifier
 
 INCLUDE_CAMERA_MODEL: bool = True
 REPLACE_CHARS_IN_MODEL = (('_', '-'), ('(', ''), (')', ''), (' ', '-'))
 KEYWORDS_TO_KEEP = ['HDR', 'PORTRAIT', 'WA', 'BURST', 'COVER', 'TOP']
 PROCESS_DOUBLES: bool = False  # if a picture with same datetime exist: True: rename, else: don't process original
 DT_AND_DT_ORIG_NEED_TO_MATCH: bool = False
+LOG_RECORDS: bool = False  # log one json line per file instead of free-form messages
+# selects the files to process and finds the keywords (and messenger names) in their names,
+# rebuilt with the keywords and --include patterns of the command line
+CLASSIFIER = Classifier(KEYWORDS_TO_KEEP)
 # SOURCE_PATH = 'P:\Automatic Upload\Motorola moto g(8) plus'
 # TARGET_PATH = 'P:\Automatic Upload\deevee_sorted'
 SOURCE_PATH = '/home/dieter/pCloudDrive/Automatic Upload/Motorola moto g(8) plus/'
 TARGET_PATH = '/home/dieter/pCloudDrive/Automatic Upload/deevee_sorted/'
 
 MSG_PROCESSED = ('Processed: {0[processed]}, moved: {0[moved]}, double: {0[double]}, '
-                 'no dt: {0[no_dt]}, whatsapp: {0[whatsapp]}, dt_mismatch: {0[dt_mismatch]}')
+                 'identical: {0[identical]}, no dt: {0[no_dt]}, whatsapp: {0[whatsapp]}, '
+                 'dt_mismatch: {0[dt_mismatch]}, failed: {0[failed]}')
+MSG_PROGRESS = ', {:.1f} files/s, found: {}'
+MSG_STAGE = ('{0:>8}: {1[count]} x, total {1[total_s]} s, mean {1[mean_ms]} ms, '
+             'p90 < {1[p90_ms]} ms, max {1[max_ms]} ms')
+MSG_COPIED = ', copied: {:.0f} MB ({:.1f} MB/s)'
 LOG_FILENAME = 'output.log'
+METADATA_CACHE_FILENAME = 'metadata_cache.sqlite'
+SCAN_STATE_FILENAME = 'scan_state.json'
+SUMMARY_FILENAME = 'run_summary.json'
+DOUBLES_DIRNAME = '_doubles'  # in TARGET_PATH, used by --dedup move
 DT_FORMAT = '%d/%m/%Y %H:%M:%S'
 LOG_MSG_FORMAT = '%(asctime)s|%(levelname)s|%(message)s'
 LOG_NAME = 'PhotoRenamer'
-files = {'processed': 0, 'moved': 0, 'double': 0, 'no_dt': 0, 'whatsapp': 0, 'dt_mismatch': 0}
+QUEUE_SIZE_PER_JOB = 4  # files read ahead per worker thread when running with --jobs
+TARGET_INDEX_MAX_NAMES = 100_000  # target file names kept in memory (about 15 MB)
+ASYNC_LIMITS = {'scan': 8, 'read': 64, 'move': 16}  # operations in flight with --async
+ASYNC_QUEUE_SIZE = 256  # files waiting between the --async stages
+ASYNC_MOVES_PER_SLOT = 4  # move tasks created (waiting for a 'move' slot) per slot
+WATCH_SETTLE_SECONDS = 2  # --watch: size and mtime of a new file must be stable this long
+WATCH_MAX_WAIT_SECONDS = 60  # --watch: stable files with an incomplete header are moved anyway
+WATCH_CHECK_INTERVAL = 1  # --watch: seconds between checks of the files that are being written
+WATCH_POLL_INTERVAL = 10  # --watch without inotify: seconds between polls of the source tree
+WATCH_SWEEP_INTERVAL = 3600  # --watch: seconds between full scans, to catch missed events
+SHARD_WAIT_SECONDS = 5  # --shard: wait for shards when the others are still listing directories
+SHARD_DIR_WAIT_SECONDS = 1  # --shard: wait when all target directories needed are owned by others
+STATUS_OK = 'ok'
+STATUS_WHATSAPP = 'whatsapp'
+STATUS_NO_DT = 'no_dt'
+STATUS_DT_MISMATCH = 'dt_mismatch'
+files = {
+    'processed': 0,
+    'moved': 0,
+    'double': 0,
+    'identical': 0,
+    'no_dt': 0,
+    'whatsapp': 0,
+    'dt_mismatch': 0,
+    'failed': 0  # could not be read or moved
+}
+files_lock = threading.Lock()
 
 
-def create_logger():
+def create_logger(level: int = logging.DEBUG) -> Tuple[logging.Logger, run_log.BatchWriter]:
+    """Create the logger. Records are written to LOG_FILENAME by a background thread.
+
+    Args:
+        level (int, optional): log level. Defaults to logging.DEBUG.
+
+    Returns:
+        Tuple[logging.Logger, run_log.BatchWriter]: logger, thread writing the log file (stop it
+                                                    to write the remaining records)
+    """
     rf_handler = logging.handlers.RotatingFileHandler(LOG_FILENAME,
                                                       maxBytes=1000000,
                                                       backupCount=5)
     formatter = logging.Formatter(LOG_MSG_FORMAT, DT_FORMAT)
     rf_handler.setFormatter(formatter)
     logger = logging.getLogger(LOG_NAME)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(rf_handler)
+    logger.setLevel(level)
+    writer = run_log.start_logging(logger, rf_handler)
     logger.info('---Init logger---')
-    logger.debug('Base directory: "{}"'.format(abs_src_path))
-    return logger
+    logger.debug('Base directory: "%s"', abs_src_path)
+    return logger, writer
+
+
+def log_decision(logger: logging.Logger, jpg: pr, decision: str, target: str = None) -> None:
+    """Log a FileRecord with what has been decided for jpg (only if LOG_RECORDS is set)."""
+    if LOG_RECORDS:
+        logger.info(FileRecord(src=os.path.join(jpg.path, jpg.src_file), decision=decision,
+                               target=target, dt=getattr(jpg, 'dt', None),
+                               dt_orig=getattr(jpg, 'dt_orig', None),
+                               model=getattr(jpg, 'model', None)))
 
 
 def find_files(source_dir: str,
-               pattern: Tuple[str, ...],
+               classifier: Classifier,
                logger: logging.Logger,
-               e: threading.Event = None) -> Iterator[str]:
-    """Generate a list of picture files and yield one by one.
+               e: threading.Event = None,
+               scan_state: ScanState = None) -> Iterator[str]:
+    """Scan source_dir for picture files and yield them as soon as they are found.
 
     Args:
         source_dir (str): Source dir to scan for pictures
-        pattern (Tuple[str, ...]): Filename pattern to search for (i.e. '*.jpg')
+        classifier (Classifier): selects the files to process by name
         logger (logging.Logger): Where to log to.
-        e (threading.Event, optional): To signal that list has been created. Defaults to None.
+        e (threading.Event, optional): To signal that the first file has been found (or that the
+                                       scan is done if there are no files). Defaults to None.
+        scan_state (ScanState, optional): If given, directories that haven't changed since the
+                                          previous run are not listed. Defaults to None.
 
     Yields:
-        str: file in (subdir of) source_dir matching the pattern.
+        str: file in (subdir of) source_dir matched by the classifier.
     """
     try:
-        logger.debug('Creating file list, this might take a while.')
-
-        # all_files_full = [
-        #     file for file in os.listdir(source_dir)
-        #     if os.path.isfile(os.path.join(source_dir, file))
-        # ]  # all files (full path) in (subdirs of) source_dir
-        print(f'{source_dir=}')
-        all_files_full = [
-            os.path.join(path, fn) for path, _, filename in os.walk(source_dir) for fn in filename
-        ]
-        print(f'{len(all_files_full)=}')
-        files_full = [file for file in all_files_full if check_multiple_patterns(file, pattern)]
-
-        msg = f'Done creating file list, total of {len(files_full)} files in {source_dir}'
+        logger.debug(f'Scanning {source_dir} for files.')
+        found = 0
+        for file in scan_directory(source_dir, classifier, logger, scan_state):
+            if e and not found:
+                e.set()
+            found += 1
+            metrics.progress['found'] = found
+            yield file
+        metrics.progress['scan_done'] = True
+
+        msg = f'Done scanning, total of {found} files in {source_dir}'
+        if scan_state:
+            msg += f' ({scan_state.skipped} unchanged directories skipped)'
         print(msg)
         logger.debug(msg)
 
         if e:
             e.set()
 
-        yield from files_full
-
     except FileNotFoundError:
         import sys
         msg = 'FileNotFoundError: No files found, does directory exist? Exiting...'
@@ -91,21 +164,89 @@ def find_files(source_dir: str,
         sys.exit()
 
 
-def check_multiple_patterns(file_full: str, patterns: Tuple[str, ...]) -> bool:
-    """Check if the filename matches one of the patterns in patterns
+def scan_directory(source_dir: str,
+                   classifier: Classifier,
+                   logger: logging.Logger,
+                   scan_state: ScanState = None) -> Iterator[str]:
+    """Walk source_dir top-down with os.scandir, yielding matching files directory per directory.
+
+    Only the file names of the current directory are kept in memory. They are collected before
+    yielding, so moving files out of the directory doesn't interfere with the listing.
+
+    Args:
+        source_dir (str): directory to scan
+        classifier (Classifier): selects the files to process by name
+        logger (logging.Logger): Where to log to.
+        scan_state (ScanState, optional): skip directories that haven't changed since the
+                                          previous run. Defaults to None.
+
+    Raises:
+        FileNotFoundError: if source_dir does not exist
+
+    Yields:
+        str: file in (subdir of) source_dir matched by the classifier.
+    """
+    stack = [(source_dir, os.stat(source_dir).st_mtime_ns)]
+    while stack:
+        path, mtime_ns = stack.pop()
+        subdirs = scan_state.unchanged_subdirs(path, mtime_ns) if scan_state else None
+        if subdirs is not None:
+            matches = []
+        else:
+            try:
+                subdirs, matches = list_directory(path, classifier)
+            except OSError as err:
+                if path == source_dir:
+                    raise
+                logger.warning(f'Could not list directory "{path}": {err}')
+                continue
+            if scan_state:
+                scan_state.record(path, mtime_ns, subdirs)
+
+        subdir_stack = []
+        for subdir in subdirs:
+            subdir_path = os.path.join(path, subdir)
+            try:
+                subdir_stack.append((subdir_path, os.stat(subdir_path).st_mtime_ns))
+            except OSError as err:
+                logger.warning(f'Could not stat directory "{subdir_path}": {err}')
+        stack.extend(reversed(subdir_stack))
+
+        yield from matches
+
+
+def list_directory(path: str, classifier: Classifier) -> Tuple[List[str], List[str]]:
+    """List one directory.
 
     Args:
-        file_full (str): Full path of the file to check
-        patterns (List[str]): List of patterns to check for
+        path (str): directory to list
+        classifier (Classifier): selects the files to process by name
 
     Returns:
-        bool: True if filename matches one of the patterns
+        Tuple[List[str], List[str]]: names of the subdirectories, full paths of matching files
     """
-    return any(filename_match(file_full, pattern) for pattern in patterns)
+    subdirs, matches = [], []
+    with metrics.timed('scan'), os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if not entry.is_symlink():  # same as os.walk: don't follow links
+                    subdirs.append(entry.name)
+            elif classifier.matches(entry.name):
+                matches.append(entry.path)
+    return subdirs, matches
 
 
-def print_results() -> None:
-    """Print actions and time taken."""
+def print_results(cache: MetadataCache = None,
+                  deduplicator: Deduplicator = None,
+                  summary_filename: str = None) -> None:
+    """Print actions and time taken, and write the json summary.
+
+    Args:
+        cache (MetadataCache, optional): metadata cache used in this run. Defaults to None.
+        deduplicator (Deduplicator, optional): deduplicator used in this run. Defaults to None.
+        summary_filename (str, optional): json file to write the counters and stage timings to.
+                                          Defaults to None.
+    """
     total_time = datetime.now() - start_time
     total_time_str = '{} minutes, {} seconds'.format(total_time.seconds // 60,
                                                      total_time.seconds % 60)
@@ -116,10 +257,46 @@ def print_results() -> None:
     print(MSG_PROCESSED.format(files))
     logger.info(MSG_PROCESSED.format(files))
 
+    if cache:
+        msg_cache = 'Metadata cache: {} hits, {} misses (hit rate {:.1%})'.format(
+            cache.hits, cache.misses, cache.hit_rate())
+        print(msg_cache)
+        logger.info(msg_cache)
+
+    if mover.stats['copied']:
+        msg_copied = 'Moved across filesystems:' + MSG_COPIED.format(
+            mover.stats['bytes_copied'] / 1e6, mover.throughput())[1:]
+        print(msg_copied)
+        logger.info(msg_copied)
+
+    if deduplicator:
+        msg_dedup = ('Doubles: {0[identical]} identical, {0[name_collision]} name collisions '
+                     '({0[quick_hashes]} quick and {0[full_hashes]} full hashes computed)'.format(
+                         deduplicator.stats))
+        print(msg_dedup)
+        logger.info(msg_dedup)
+
+    for stage, stats in metrics.summary().items():
+        msg_stage = MSG_STAGE.format(stage, stats)
+        print(msg_stage)
+        logger.info(msg_stage)
+
     msg_time = 'Total time: ' + total_time_str
     print(msg_time)
     logger.info(msg_time)
 
+    if summary_filename:
+        metrics.write_summary(
+            summary_filename, {
+                'start': start_time.isoformat(),
+                'seconds': total_time.total_seconds(),
+                'files': files,
+                'found': metrics.progress['found'],
+                'cache': {'hits': cache.hits, 'misses': cache.misses} if cache else None,
+                'copies': mover.stats,
+                'dedup': deduplicator.stats if deduplicator else None,
+            })
+
 
 def print_info(e: threading.Event = None) -> None:
     """Print info to stdout
@@ -127,21 +304,251 @@ def print_info(e: threading.Event = None) -> None:
     Print either that files are being listed of the current status.
 
     Args:
-        e (threading.Event, optional): signal that file list has been made. Defaults to None.
+        e (threading.Event, optional): signal that the first file has been found.
+                                       Defaults to None.
     """
     while True:
         cur_time = datetime.now().strftime(DT_FORMAT)
         if e and not e.is_set():
             print(cur_time + ' Listing files, this might take a while...')
         else:
-            print(cur_time + ' ' + MSG_PROCESSED.format(files))
+            msg = cur_time + ' ' + MSG_PROCESSED.format(files)
+            elapsed = (datetime.now() - start_time).total_seconds()
+            msg += MSG_PROGRESS.format(files['processed'] / elapsed if elapsed else 0,
+                                       metrics.progress['found'])
+            eta = metrics.eta_seconds(files['processed'], elapsed)
+            msg += ', ETA: ' + (str(timedelta(seconds=round(eta))) if eta is not None else '?')
+            if mover.stats['copied']:
+                msg += MSG_COPIED.format(mover.stats['bytes_copied'] / 1e6, mover.throughput())
+            print(msg)
         sleep(5)
 
 
+def read_metadata(file: str,
+                  abs_src_path: str,
+                  logger: logging.Logger,
+                  cache: MetadataCache = None) -> Tuple[pr, str]:
+    """Read the exif data of one file and decide if it can be moved.
+
+    This part does not touch the target directory, so it can safely run in a worker thread.
+
+    Args:
+        file (str): file to process
+        abs_src_path (str): Absolute source directory
+        logger (logging.Logger): where to log to
+        cache (MetadataCache, optional): cache for the exif data. Defaults to None.
+
+    Returns:
+        Tuple[pr, str]: PhotoRenamer instance, one of the STATUS_* values
+    """
+    # with LOG_RECORDS, the decision for the file is logged as one record by the caller
+    jpg = pr(src_path=abs_src_path, file=file, logger=None if LOG_RECORDS else logger,
+             classification=CLASSIFIER.classify(os.path.basename(file)))
+    if not LOG_RECORDS:
+        logger.debug('Processing "%s"', file)
+    status = STATUS_OK
+
+    if not jpg.get_exif_data(cache):
+        if jpg.check_whatsapp():
+            status = STATUS_WHATSAPP
+        else:
+            if not LOG_RECORDS:
+                logger.warning(
+                    'no dt(_orig) for file "%s" and not a messenger picture. Skipping this file.',
+                    file)
+            return jpg, STATUS_NO_DT
+    if DT_AND_DT_ORIG_NEED_TO_MATCH and not jpg.dt_matches_dt_orig():
+        # both are in exif data, but don't match. Might add option to keep the oldest date
+        if not LOG_RECORDS:
+            logger.warning('dt (%s) does not match dt_orig (%s) for "%s". Skipping this file...',
+                           jpg.dt, jpg.dt_orig, file)
+        return jpg, STATUS_DT_MISMATCH
+    return jpg, status
+
+
+def count_file(*keys: str) -> None:
+    """Increase the counters in files (thread safe)."""
+    with files_lock:
+        for key in keys:
+            files[key] += 1
+
+
+def move_to_target(jpg: pr,
+                   status: str,
+                   abs_target_path: str,
+                   logger: logging.Logger,
+                   cache: MetadataCache = None,
+                   deduplicator: Deduplicator = None,
+                   target_index: TargetIndex = None,
+                   month_index: MonthIndex = None) -> Tuple[str, Union[str, None]]:
+    """Update the counters and move the file to its new name if status allows it.
+
+    Generating a unique target name is not thread safe, so this always runs on one thread.
+
+    Args:
+        jpg (pr): PhotoRenamer instance with exif data read
+        status (str): one of the STATUS_* values, as returned by read_metadata
+        abs_target_path (str): Absolute target directory (where files should go)
+        logger (logging.Logger): where to log to
+        cache (MetadataCache, optional): cache to update for moved files. Defaults to None.
+        deduplicator (Deduplicator, optional): compare with existing targets by content.
+                                               Defaults to None.
+        target_index (TargetIndex, optional): index of the target directories. Defaults to None.
+        month_index (MonthIndex, optional): add moved files to the thumbnail index of their
+                                            month. Defaults to None.
+
+    Returns:
+        Tuple[str, Union[str, None]]: decision (as in the log records), target file
+    """
+    count_file('processed')
+    if status == STATUS_NO_DT:
+        count_file('no_dt')
+        log_decision(logger, jpg, status)
+        return status, None
+    if status == STATUS_WHATSAPP:
+        count_file('no_dt', 'whatsapp')
+    elif status == STATUS_DT_MISMATCH:
+        count_file('dt_mismatch')
+        log_decision(logger, jpg, status)
+        return status, None
+
+    file = jpg.src_file
+    with metrics.timed('name'):
+        new_path, new_filename = jpg.new_filename(target_path=abs_target_path,
+                                                  include_cam_model=INCLUDE_CAMERA_MODEL,
+                                                  replace_chars_in_model=REPLACE_CHARS_IN_MODEL)
+    src_file = os.path.join(jpg.path, file)
+    rtn = jpg.move_file(src_file, new_path, new_filename, PROCESS_DOUBLES, deduplicator,
+                        target_index)
+    if rtn[0]:
+        count_file('moved')
+        decision, target = 'copy' if rtn[1] else 'moved', rtn[0]
+        if LOG_RECORDS:
+            log_decision(logger, jpg, decision, target)
+        else:
+            logger.debug('moved file %s to %s', file, rtn[0])
+        if cache:
+            cache.move_hashes(src_file, rtn[0])
+            cache.discard(src_file)
+        if month_index:
+            with metrics.timed('thumbnail'):
+                month_index.add(rtn[0], jpg.dt_orig or jpg.dt, jpg.model, os.path.basename(file))
+    elif deduplicator:
+        count_file('identical')
+        decision, target = 'identical', os.path.join(new_path, new_filename)
+        if LOG_RECORDS:
+            log_decision(logger, jpg, decision, target)
+        else:
+            logger.info('file %s is identical to an existing file (%s)', file,
+                        deduplicator.policy)
+    else:
+        decision, target = 'double', os.path.join(new_path, new_filename)
+        if LOG_RECORDS:
+            log_decision(logger, jpg, decision, target)
+        else:
+            logger.info(
+                'file %s is a double and has not been processed (PROCESS_DOUBLES SET TO %s)',
+                file, PROCESS_DOUBLES)
+    if rtn[1]:
+        count_file('double')
+    return decision, target
+
+
+def plan_move(jpg: pr, status: str, abs_target_path: str, logger: logging.Logger,
+              target_index: TargetIndex, doubles_list: Union[str, None] = None) -> dict:
+    """Update the counters and decide where the file should go, without moving it.
+
+    The chosen target name is reserved in target_index, so later files in the same plan don't
+    get the same name.
+
+    Args:
+        jpg (pr): PhotoRenamer instance with exif data read
+        status (str): one of the STATUS_* values, as returned by read_metadata
+        abs_target_path (str): Absolute target directory (where files should go)
+        logger (logging.Logger): where to log to
+        target_index (TargetIndex): index of the target directories
+        doubles_list (Union[str, None], optional): list to add doubles to. Defaults to None: a
+                                                   plan lists them when it is executed.
+
+    Returns:
+        dict: plan entry (see planner)
+    """
+    count_file('processed')
+    src_file = os.path.join(jpg.path, jpg.src_file)
+    entry = {'src': src_file, 'target_dir': None, 'target_name': None, 'status': status,
+             'double': False}
+    if status == STATUS_NO_DT:
+        count_file('no_dt')
+        log_decision(logger, jpg, status)
+        return entry
+    if status == STATUS_WHATSAPP:
+        count_file('no_dt', 'whatsapp')
+    elif status == STATUS_DT_MISMATCH:
+        count_file('dt_mismatch')
+        log_decision(logger, jpg, status)
+        return entry
+
+    with metrics.timed('name'):
+        new_path, new_filename = jpg.new_filename(target_path=abs_target_path,
+                                                  include_cam_model=INCLUDE_CAMERA_MODEL,
+                                                  replace_chars_in_model=REPLACE_CHARS_IN_MODEL)
+    ideal_target_file = os.path.join(new_path, new_filename)
+    with metrics.timed('unique'):
+        target_file = jpg.generate_unique_filename(ideal_target_file, PROCESS_DOUBLES, src_file,
+                                                   target_index, doubles_list)
+    entry['target_dir'] = new_path
+    entry['double'] = target_file != ideal_target_file
+    if entry['double']:
+        count_file('double')
+    if target_file:
+        target_index.add(target_file)
+        entry['target_name'] = os.path.basename(target_file)
+        entry['status'] = PLAN_MOVE
+        log_decision(logger, jpg, 'copy' if entry['double'] else 'move', target_file)
+    else:
+        entry['target_name'] = new_filename
+        entry['status'] = PLAN_DOUBLE
+        if LOG_RECORDS:
+            log_decision(logger, jpg, 'double', ideal_target_file)
+        else:
+            logger.info('file %s is a double and will not be processed', src_file)
+    return entry
+
+
+def parallel_map(function: Callable, items: Iterable, jobs: int) -> Iterator:
+    """Apply function to items on a pool of jobs threads, yield the results in order.
+
+    At most QUEUE_SIZE_PER_JOB * jobs items are submitted but not yet yielded, so the file
+    list is consumed at the pace the results are handled.
+
+    Args:
+        function (Callable): function to call with each item
+        items (Iterable): items to process
+        jobs (int): number of worker threads
+
+    Yields:
+        Iterator: function(item) for each item
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='read_metadata') as executor:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= QUEUE_SIZE_PER_JOB * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def main_operation(abs_src_path: str,
                    abs_target_path: str,
                    logger: logging.Logger,
-                   e: threading.Event = None):
+                   e: threading.Event = None,
+                   jobs: int = 1,
+                   cache: MetadataCache = None,
+                   scan_state: ScanState = None,
+                   deduplicator: Deduplicator = None,
+                   plan: PlanWriter = None,
+                   month_index: MonthIndex = None):
     """List all files to be checked, then go over them and move if necessary.
 
     Args:
@@ -149,64 +556,522 @@ def main_operation(abs_src_path: str,
         abs_target_path (str): Absolute target directory (where files should go)
         logger (logging.Logger): where to log to
         e (threading.Event, optional): [description]. Defaults to None.
+        jobs (int, optional): Number of threads reading exif data. Moving files is always done
+                              on the calling thread. Defaults to 1.
+        cache (MetadataCache, optional): cache for the exif data. Entries of files that are no
+                                         longer in abs_src_path are removed at the end.
+                                         Defaults to None.
+        scan_state (ScanState, optional): only scan directories that changed since the previous
+                                          run. The state is saved when all files are processed.
+                                          Defaults to None.
+        deduplicator (Deduplicator, optional): compare doubles by content instead of by name.
+                                               Defaults to None.
+        plan (PlanWriter, optional): if given, don't move files but write what would be done
+                                     to the plan. Defaults to None.
+        month_index (MonthIndex, optional): thumbnail index of the target months.
+                                            Defaults to None.
     """
-    global files
+    file_list = find_files(abs_src_path, CLASSIFIER,
+                           logger=logger,
+                           e=e,
+                           scan_state=scan_state)
+    if jobs > 1:
+        results = parallel_map(lambda file: read_metadata(file, abs_src_path, logger, cache),
+                               file_list, jobs)
+    else:
+        results = (read_metadata(file, abs_src_path, logger, cache) for file in file_list)
 
-    for file in find_files(abs_src_path, ('*.jpeg', '*.jpg'), logger=logger, e=e):
-        jpg = pr(src_path=abs_src_path, file=file, logger=logger)
-        files['processed'] += 1
-        logger.debug('Processing "{}"'.format(file))
+    target_index = TargetIndex(None if plan else TARGET_INDEX_MAX_NAMES)
+    for jpg, status in results:
+        if plan:
+            plan.write(plan_move(jpg, status, abs_target_path, logger, target_index))
+        else:
+            move_to_target(jpg, status, abs_target_path, logger, cache, deduplicator,
+                           target_index, month_index)
+    logger.debug(f'Listed {target_index.loaded_dirs} target directories')
 
-        if not jpg.get_exif_data():
-            files['no_dt'] += 1
-            if jpg.check_whatsapp():
-                files['whatsapp'] += 1
-            else:
-                logger.warning(
-                    'no dt(_orig) for file "{}" and not a WhatsApp picture. Skipping this file.'.
-                    format(file))
+    if plan:
+        # files have not been moved yet, so directories are not done for incremental runs
+        logger.info(f'Wrote plan with {plan.entries} entries to {plan.filename}')
+    elif scan_state:
+        scan_state.save()
+        if cache:
+            # files in skipped directories are not seen, only directories that were listed (or
+            # are gone) are complete
+            evicted = cache.evict_unseen_files(scan_state.listed + scan_state.removed())
+            logger.debug(f'Removed {evicted} entries of missing files from the metadata cache')
+    elif cache:
+        # only after a full scan, an unseen entry means the file is gone
+        evicted = cache.evict_unseen(abs_src_path)
+        logger.debug(f'Removed {evicted} entries of missing files from the metadata cache')
+
+
+async def async_main_operation(abs_src_path: str,
+                               abs_target_path: str,
+                               logger: logging.Logger,
+                               e: threading.Event = None,
+                               limits: Dict[str, int] = None,
+                               cache: MetadataCache = None,
+                               month_index: MonthIndex = None) -> None:
+    """Same as main_operation, but scanning, reading exif data and moving run as asyncio tasks.
+
+    Every blocking call runs on a thread pool, with at most limits[operation] calls of each
+    operation type ('scan', 'read', 'move') in flight. This keeps many requests outstanding on
+    high-latency (network) filesystems without a thread per file. Target names are still chosen
+    one file at a time; because files are handled in the order their exif data is read, _COPY[n]
+    numbering within a burst can differ from a sequential run.
+
+    Args:
+        abs_src_path (str): Absolute source directory (where files currently are)
+        abs_target_path (str): Absolute target directory (where files should go)
+        logger (logging.Logger): where to log to
+        e (threading.Event, optional): set when the first file has been found. Defaults to None.
+        limits (Dict[str, int], optional): concurrency per operation type, overrides
+                                           ASYNC_LIMITS. Defaults to None.
+        cache (MetadataCache, optional): cache for the exif data. Defaults to None.
+        month_index (MonthIndex, optional): thumbnail index of the target months.
+                                            Defaults to None.
+    """
+    limits = {**ASYNC_LIMITS, **(limits or {})}
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=sum(limits.values()) + 1,
+                                  thread_name_prefix='async_io')
+    semaphores = {operation: asyncio.Semaphore(limit) for operation, limit in limits.items()}
+    file_queue = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+    result_queue = asyncio.Queue(maxsize=ASYNC_QUEUE_SIZE)
+
+    async def run_blocking(operation: str, function: Callable, *args):
+        async with semaphores[operation]:
+            return await loop.run_in_executor(executor, function, *args)
+
+    async def scan_dir(path: str) -> Tuple[str, List[str], List[str]]:
+        try:
+            return (path, *await run_blocking('scan', list_directory, path, CLASSIFIER))
+        except OSError as err:
+            if path == abs_src_path:
+                raise
+            logger.warning(f'Could not list directory "{path}": {err}')
+            return path, [], []
+
+    async def scan() -> None:
+        found = 0
+        pending = {asyncio.create_task(scan_dir(abs_src_path))}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                path, subdirs, matches = task.result()
+                pending.update(
+                    asyncio.create_task(scan_dir(os.path.join(path, subdir)))
+                    for subdir in subdirs)
+                for match in matches:
+                    if e and not found:
+                        e.set()
+                    found += 1
+                    metrics.progress['found'] = found
+                    await file_queue.put(match)
+        metrics.progress['scan_done'] = True
+        logger.debug(f'Done scanning, total of {found} files in {abs_src_path}')
+        if e:
+            e.set()
+        for _ in range(limits['read']):
+            await file_queue.put(None)
+
+    async def read() -> None:
+        while (file := await file_queue.get()) is not None:
+            try:
+                result = await run_blocking('read', read_metadata, file, abs_src_path, logger,
+                                            cache)
+            except OSError as err:
+                # i.e. removed or moved away between the scan and now
+                logger.warning('Could not read "%s": %s', file, err)
+                count_file('failed')
                 continue
-        if DT_AND_DT_ORIG_NEED_TO_MATCH and not jpg.dt_matches_dt_orig():
-            # both are in exif data, but don't match. Might add option to keep the oldest date
-            logger.warning(
-                'dt ({}) does not match dt_orig ({}) for "{}". Skipping this file...'.format(
-                    jpg.dt, jpg.dt_orig, file))
-            files['dt_mismatch'] += 1
+            await result_queue.put(result)
+
+    async def move(entry: dict, jpg: pr) -> None:
+        src_file = entry['src']
+        target_file = os.path.join(entry['target_dir'], entry['target_name'])
+        await run_blocking('move', mover.move_file, src_file, target_file)
+        if not LOG_RECORDS:
+            # with LOG_RECORDS, plan_move logged the decision already
+            logger.debug('moved file %s to %s', src_file, target_file)
+        count_file('moved')
+        if cache:
+            cache.move_hashes(src_file, target_file)
+            cache.discard(src_file)
+        if month_index:
+            # reading the thumbnail is (like reading exif data) a 'read' operation
+            await run_blocking('read', month_index.add, target_file, jpg.dt_orig or jpg.dt,
+                               jpg.model, os.path.basename(src_file))
+
+    async def allocate() -> None:
+        target_index = TargetIndex(TARGET_INDEX_MAX_NAMES)
+        moves: Dict[asyncio.Task, Tuple[str, str]] = {}  # task -> source file, target file
+
+        def finish(done: Iterable[asyncio.Task]) -> None:
+            for task in done:
+                src_file, target_file = moves.pop(task)
+                try:
+                    task.result()
+                except OSError as err:
+                    logger.error('Could not move "%s" to "%s": %s', src_file, target_file, err)
+                    count_file('failed')
+                    if not isinstance(err, FileExistsError):
+                        target_index.remove(target_file)  # the name is free again
+                target_index.unpin(os.path.dirname(target_file))
+
+        while (result := await result_queue.get()) is not None:
+            # only this task touches target_index, so names are handed out one at a time
+            entry = await loop.run_in_executor(executor, plan_move, *result, abs_target_path,
+                                               logger, target_index, DOUBLES_FILENAME)
+            if entry['status'] != PLAN_MOVE:
+                continue
+            # the reserved name is not on disk until the move is done
+            target_index.pin(entry['target_dir'])
+            await loop.run_in_executor(executor, target_index.makedirs, entry['target_dir'])
+            if len(moves) >= limits['move'] * ASYNC_MOVES_PER_SLOT:
+                finish((await asyncio.wait(moves, return_when=asyncio.FIRST_COMPLETED))[0])
+            moves[asyncio.create_task(move(entry, result[0]))] = (
+                entry['src'], os.path.join(entry['target_dir'], entry['target_name']))
+        if moves:
+            finish((await asyncio.wait(moves))[0])
+
+    async def scan_and_read() -> None:
+        readers = [asyncio.create_task(read()) for _ in range(limits['read'])]
+        try:
+            await scan()
+            await asyncio.gather(*readers)
+        finally:
+            for reader in readers:
+                reader.cancel()
+        await result_queue.put(None)
+
+    tasks = [asyncio.create_task(scan_and_read()), asyncio.create_task(allocate())]
+    try:
+        await asyncio.gather(*tasks)
+    except FileNotFoundError:
+        msg = 'FileNotFoundError: No files found, does directory exist? Exiting...'
+        print(msg)
+        logger.error(msg)
+        return
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if cache:
+        evicted = cache.evict_unseen(abs_src_path)
+        logger.debug(f'Removed {evicted} entries of missing files from the metadata cache')
+
+
+def watch_operation(abs_src_path: str,
+                    abs_target_path: str,
+                    logger: logging.Logger,
+                    e: threading.Event = None,
+                    stop: threading.Event = None,
+                    cache: MetadataCache = None,
+                    deduplicator: Deduplicator = None,
+                    poll: bool = False,
+                    month_index: MonthIndex = None) -> None:
+    """Keep moving new files from abs_src_path to abs_target_path, until stop is set.
+
+    New files are found with inotify (or by polling the directories whose mtime changed, if
+    inotify is not available or poll is set). They are moved once they are completely written
+    (see watcher.Debouncer). A full scan every WATCH_SWEEP_INTERVAL seconds (and when inotify
+    events were lost) catches files that were missed. Files that stay in the source directory
+    (no exif datetime, doubles, ...) are not processed again unless they change.
+
+    Args:
+        abs_src_path (str): Absolute source directory (where files currently are)
+        abs_target_path (str): Absolute target directory (where files should go)
+        logger (logging.Logger): where to log to
+        e (threading.Event, optional): set when the files already in abs_src_path have been
+                                       found. Defaults to None.
+        stop (threading.Event, optional): set to stop watching. Defaults to None.
+        cache (MetadataCache, optional): cache for the exif data. Defaults to None.
+        deduplicator (Deduplicator, optional): compare doubles by content instead of by name.
+                                               Defaults to None.
+        poll (bool, optional): poll, even if inotify is available. Defaults to False.
+        month_index (MonthIndex, optional): thumbnail index of the target months, written
+                                            after every batch of files. Defaults to None.
+    """
+    watcher = None
+    if not poll:
+        try:
+            watcher = InotifyWatcher(abs_src_path,
+                                     lambda path: CLASSIFIER.matches(os.path.basename(path)),
+                                     logger)
+        except OSError as err:
+            logger.warning('inotify not available (%s), polling instead', err)
+    if watcher is None:
+        watcher = PollingWatcher(
+            abs_src_path, lambda root, state: scan_directory(root, CLASSIFIER, logger, state),
+            WATCH_POLL_INTERVAL)
+    logger.info('Watching %s with %s', abs_src_path, type(watcher).__name__)
+
+    debouncer = Debouncer(WATCH_SETTLE_SECONDS, WATCH_MAX_WAIT_SECONDS)
+    stayed: Dict[str, Tuple[int, int]] = {}  # files left in the source -> size, mtime_ns
+
+    def add(paths: Iterable[str]) -> None:
+        for path in paths:
+            if path in stayed:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stayed[path] == (stat.st_size, stat.st_mtime_ns):
+                    continue
+            if path not in debouncer.pending:
+                metrics.progress['found'] += 1
+            debouncer.add(path)
+
+    add(watcher.initial_files)
+    metrics.progress['scan_done'] = True
+    if e:
+        e.set()
+    next_sweep = monotonic() + WATCH_SWEEP_INTERVAL
+    try:
+        while not (stop and stop.is_set()):
+            add(watcher.changed_files(WATCH_CHECK_INTERVAL))
+            if watcher.overflowed or monotonic() >= next_sweep:
+                logger.info('Sweeping %s for missed files', abs_src_path)
+                watcher.overflowed = False
+                found = list(scan_directory(abs_src_path, CLASSIFIER, logger))
+                stayed = {path: stayed[path] for path in set(found) & stayed.keys()}
+                add(found)
+                next_sweep = monotonic() + WATCH_SWEEP_INTERVAL
+
+            ready = debouncer.ready()
+            # other processes add files to the target while watching: an index is only used
+            # for one batch
+            target_index = TargetIndex(TARGET_INDEX_MAX_NAMES)
+            for file in ready:
+                try:
+                    jpg, status = read_metadata(file, abs_src_path, logger, cache)
+                    move_to_target(jpg, status, abs_target_path, logger, cache, deduplicator,
+                                   target_index, month_index)
+                    stat = os.stat(file)
+                except FileNotFoundError:
+                    stayed.pop(file, None)  # moved (or removed while it was processed)
+                except OSError as err:
+                    logger.warning('Could not process "%s": %s', file, err)
+                else:
+                    stayed[file] = (stat.st_size, stat.st_mtime_ns)
+            if ready and month_index:
+                month_index.flush()
+    finally:
+        watcher.close()
+        logger.info('Stopped watching %s', abs_src_path)
+
+
+def shard_operation(abs_src_path: str,
+                    abs_target_path: str,
+                    logger: logging.Logger,
+                    ledger: WorkLedger,
+                    e: threading.Event = None,
+                    stop: threading.Event = None,
+                    jobs: int = 1,
+                    cache: MetadataCache = None,
+                    deduplicator: Deduplicator = None,
+                    month_index: MonthIndex = None) -> None:
+    """Process shards (source directories) claimed from a shared ledger, until none are left.
+
+    Several workers can run this at the same time, on one or more machines, with the same ledger
+    (see work_ledger). The files of a shard are grouped by target directory, and a group is only
+    moved while this worker owns the directory, so _COPY[n] numbering is the same as in a
+    single run.
+
+    Args:
+        abs_src_path (str): Absolute source directory (where files currently are)
+        abs_target_path (str): Absolute target directory (where files should go)
+        logger (logging.Logger): where to log to
+        ledger (WorkLedger): shared ledger
+        e (threading.Event, optional): set when the first shard has been claimed.
+                                       Defaults to None.
+        stop (threading.Event, optional): set to stop after the current shard. Defaults to None.
+        jobs (int, optional): Number of threads reading exif data. Defaults to 1.
+        cache (MetadataCache, optional): cache for the exif data. Defaults to None.
+        deduplicator (Deduplicator, optional): compare doubles by content instead of by name.
+                                               Defaults to None.
+        month_index (MonthIndex, optional): thumbnail index of the target months, written
+                                            before a target directory is released.
+                                            Defaults to None.
+    """
+    ledger.add_shards([to_key(abs_src_path, abs_src_path)])
+    target_index = TargetIndex(TARGET_INDEX_MAX_NAMES)
+    while not (stop and stop.is_set()):
+        shard_key = ledger.claim_shard()
+        if shard_key is None:
+            if not ledger.shards_in_progress():
+                break
+            sleep(SHARD_WAIT_SECONDS)
             continue
+        if e:
+            e.set()
+        shard = from_key(shard_key, abs_src_path)
+        logger.info('Claimed shard %s', shard)
+        try:
+            subdirs, file_list = list_directory(shard, CLASSIFIER)
+        except OSError as err:
+            logger.warning('Could not list directory "%s": %s', shard, err)
+            ledger.complete_shard(shard_key, 0, failed=not isinstance(err, FileNotFoundError))
+            continue
+        ledger.add_shards(to_key(os.path.join(shard, subdir), abs_src_path) for subdir in subdirs)
+        metrics.progress['found'] += len(file_list)
+        owned_key = None  # target directory acquired and not released yet
+        try:
+            if jobs > 1:
+                results = parallel_map(
+                    lambda file: read_metadata(file, abs_src_path, logger, cache), file_list, jobs)
+            else:
+                results = (read_metadata(file, abs_src_path, logger, cache) for file in file_list)
 
-        new_path, new_filename = jpg.new_filename(target_path=abs_target_path,
+            groups: Dict[Union[str, None], List[Tuple[pr, str]]] = {}
+            for jpg, status in results:
+                target_dir = None
+                if status not in (STATUS_NO_DT, STATUS_DT_MISMATCH):
+                    target_dir = jpg.new_filename(target_path=abs_target_path,
                                                   include_cam_model=INCLUDE_CAMERA_MODEL,
-                                                  keywords_to_keep=KEYWORDS_TO_KEEP,
-                                                  replace_chars_in_model=REPLACE_CHARS_IN_MODEL)
-        rtn = jpg.move_file(os.path.join(abs_src_path, file), new_path, new_filename,
-                            PROCESS_DOUBLES)
-        if rtn[0]:
-            logger.debug(f'moved file {file} to {rtn[0]}')
-            files['moved'] += 1
-        else:
-            logger.info(
-                f'file {file} is a double and has not been processed (PROCESS_DOUBLES SET TO {PROCESS_DOUBLES}'
-            )
-        if rtn[1]:
-            files['double'] += 1
+                                                  replace_chars_in_model=REPLACE_CHARS_IN_MODEL)[0]
+                groups.setdefault(target_dir, []).append((jpg, status))
+
+            def move_group(group: List[Tuple[pr, str]]) -> List[Tuple[str, str, Union[str, None]]]:
+                results = []
+                for jpg, status in group:
+                    decision, target = move_to_target(jpg, status, abs_target_path, logger, cache,
+                                                      deduplicator, target_index, month_index)
+                    results.append((to_key(os.path.join(jpg.path, jpg.src_file), abs_src_path),
+                                    decision, target and to_key(target, abs_target_path)))
+                return results
+
+            unmoved = move_group(groups.pop(None, []))  # nothing to move, no directory to own
+            while groups:
+                for target_dir in list(groups):
+                    target_key = to_key(target_dir, abs_target_path)
+                    if not ledger.acquire_dir(target_key):
+                        continue
+                    owned_key = target_key
+                    target_index.forget(target_dir)  # other workers may have added files
+                    group_results = move_group(groups.pop(target_dir))
+                    if month_index:
+                        month_index.flush(target_dir)
+                    if not ledger.release_dir(target_key, group_results):
+                        logger.warning('Lease of %s expired while moving files to it', target_dir)
+                    owned_key = None
+                if groups:
+                    sleep(SHARD_DIR_WAIT_SECONDS)
+        except Exception:  # don't retry a shard that crashes the worker on every other worker
+            logger.exception('Could not process shard %s', shard)
+            if owned_key:
+                ledger.release_dir(owned_key)
+            ledger.complete_shard(shard_key, len(file_list), failed=True)
+            continue
+        ledger.complete_shard(shard_key, len(file_list), unmoved)
+    metrics.progress['scan_done'] = True
+    msg = 'No shards left. Ledger: ' + ', '.join(
+        f'{key}: {value}' for key, value in ledger.summary().items())
+    print(msg)
+    logger.info(msg)
+
+
+def run_profiled(profile_filename: str, target: Callable, *args) -> None:
+    """Run target(*args) with cProfile, write the stats to profile_filename.
+
+    Only the calling thread is profiled, not the --jobs or --async worker threads.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(target, *args)
+    finally:
+        profiler.dump_stats(profile_filename)
+
+
+def execute_plan_operation(plan_filename: str, logger: logging.Logger,
+                           cache: MetadataCache = None) -> None:
+    """Move the files of a plan made with --plan (second phase).
+
+    Args:
+        plan_filename (str): plan file
+        logger (logging.Logger): where to log to
+        cache (MetadataCache, optional): cache to update for moved files. Defaults to None.
+    """
+    stats = execute_plan(plan_filename, logger, cache, count_file, DOUBLES_FILENAME)
+    msg = ('Executed plan {}: {moved} moved, {resumed} already done, {skipped} skipped, '
+           '{doubles} doubles listed'.format(plan_filename, **stats))
+    print(msg)
+    logger.info(msg)
 
 
 if __name__ == '__main__':
 
-    abs_src_path = os.path.abspath(SOURCE_PATH)
-    abs_target_path = os.path.abspath(TARGET_PATH)
-    logger = create_logger()
+    args = get_arguments()
+    abs_src_path = os.path.abspath(args.input_path or SOURCE_PATH)
+    abs_target_path = os.path.abspath(args.output_path or TARGET_PATH)
+    LOG_RECORDS = args.log_records
+    CLASSIFIER = Classifier(KEYWORDS_TO_KEEP + args.keywords, include=args.include)
+    logger, log_writer = create_logger(getattr(logging, args.log_level))
 
     start_time = datetime.now()
 
     e = threading.Event()
+    cache = None if args.no_cache else MetadataCache(METADATA_CACHE_FILENAME)
+    scan_state = ScanState(SCAN_STATE_FILENAME) if args.incremental else None
+    deduplicator = None
+    if args.dedup:
+        deduplicator = Deduplicator(policy=args.dedup,
+                                    doubles_dir=os.path.join(abs_target_path, DOUBLES_DIRNAME),
+                                    doubles_list=DOUBLES_FILENAME,
+                                    cache=cache,
+                                    logger=logger)
+
+    plan = PlanWriter(args.plan) if args.plan else None
+    ledger = WorkLedger(args.shard) if args.shard else None
+    month_index = MonthIndex() if args.thumbnails else None
+    stop = threading.Event()
 
-    main_thread = threading.Thread(name='main_operation',
-                                   target=main_operation,
-                                   args=(abs_src_path, abs_target_path, logger, e))
+    if args.async_io:
+        operation = asyncio.run
+        operation_args = (async_main_operation(abs_src_path, abs_target_path, logger, e,
+                                               args.limits, cache, month_index), )
+    elif args.watch:
+        operation = watch_operation
+        operation_args = (abs_src_path, abs_target_path, logger, e, stop, cache, deduplicator,
+                          args.poll, month_index)
+    elif ledger:
+        operation = shard_operation
+        operation_args = (abs_src_path, abs_target_path, logger, ledger, e, stop, args.jobs,
+                          cache, deduplicator, month_index)
+    elif args.execute:
+        e.set()
+        operation = execute_plan_operation
+        operation_args = (args.execute, logger, cache)
+    else:
+        operation = main_operation
+        operation_args = (abs_src_path, abs_target_path, logger, e, args.jobs, cache, scan_state,
+                          deduplicator, plan, month_index)
+    if args.profile:
+        operation_args = (args.profile, operation, *operation_args)
+        operation = run_profiled
+
+    main_thread = threading.Thread(name='main_operation', target=operation, args=operation_args)
     print_thread = threading.Thread(name='print_info', target=print_info, args=(e, ), daemon=True)
     main_thread.start()
     print_thread.start()
-    main_thread.join()
+    try:
+        main_thread.join()
+    except KeyboardInterrupt:
+        if not (args.watch or ledger):
+            raise
+        stop.set()
+        main_thread.join()
 
-    print_results()
\ No newline at end of file
+    if plan:
+        plan.close()
+    if month_index:
+        month_index.flush()
+    if ledger:
+        ledger.close()
+    print_results(cache, deduplicator, args.summary or SUMMARY_FILENAME)
+    if cache:
+        cache.close()
+    log_writer.stop()
\ No newline at end of file
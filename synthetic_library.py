@@ -0,0 +1,288 @@
+"""Generate synthetic JPEG, MP4 and HEIC files and photo libraries, used by the benchmarks."""
+
+import os
+import random
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Union
+
+from exif_header import (EXIF_HEADER, JPEG_SOI, TAG_DATETIME, TAG_DATETIME_ORIGINAL,
+                         TAG_EXIF_IFD_POINTER, TAG_MODEL, TYPE_ASCII, TYPE_LONG)
+
+EXIF_DT_FORMAT = '%Y:%m:%d %H:%M:%S'
+
+
+def build_ifd(entries: list, offset: int, next_ifd: int = 0, endian: str = '<') -> bytes:
+    """Build an IFD located at offset in the TIFF structure.
+
+    Args:
+        entries (list): (tag, type, value) tuples, value is bytes (ASCII) or int (LONG)
+        offset (int): offset of this IFD from the start of the TIFF header
+        next_ifd (int, optional): offset of the next IFD. Defaults to 0.
+        endian (str, optional): struct byte order character. Defaults to '<' (little endian).
+
+    Returns:
+        bytes: IFD including the out-of-line values
+    """
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack(endian + 'H', len(entries))
+    data = b''
+    for tag, tag_type, value in sorted(entries):
+        if tag_type == TYPE_ASCII:
+            if len(value) <= 4:
+                ifd += struct.pack(endian + 'HHI4s', tag, tag_type, len(value), value)
+            else:
+                ifd += struct.pack(endian + 'HHII', tag, tag_type, len(value),
+                                   data_offset + len(data))
+                data += value
+        else:
+            ifd += struct.pack(endian + 'HHII', tag, tag_type, 1, value)
+    return ifd + struct.pack(endian + 'I', next_ifd) + data
+
+
+def build_app1(dt: Union[datetime, None] = None,
+               dt_orig: Union[datetime, None] = None,
+               model: Union[str, None] = None,
+               endian: str = '<') -> bytes:
+    """Build an exif APP1 segment containing the given tags (None: tag is left out).
+
+    The TIFF structure is little endian ('II'), or big endian ('MM') with endian '>'.
+
+    Returns:
+        bytes: complete APP1 segment, including marker and length
+    """
+    ifd0 = []
+    if model is not None:
+        ifd0.append((TAG_MODEL, TYPE_ASCII, model.encode('ascii') + b'\x00'))
+    if dt is not None:
+        ifd0.append((TAG_DATETIME, TYPE_ASCII, dt.strftime(EXIF_DT_FORMAT).encode() + b'\x00'))
+    exif_ifd = []
+    if dt_orig is not None:
+        exif_ifd.append((TAG_DATETIME_ORIGINAL, TYPE_ASCII,
+                         dt_orig.strftime(EXIF_DT_FORMAT).encode() + b'\x00'))
+
+    tiff = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', 42, 8)
+    if exif_ifd:
+        # pointer value is patched in once the size of IFD0 is known
+        ifd0.append((TAG_EXIF_IFD_POINTER, TYPE_LONG, 0))
+        exif_offset = len(tiff) + len(build_ifd(ifd0, len(tiff), endian=endian))
+        ifd0[-1] = (TAG_EXIF_IFD_POINTER, TYPE_LONG, exif_offset)
+        tiff += build_ifd(ifd0, len(tiff), endian=endian)
+        tiff += build_ifd(exif_ifd, len(tiff), endian=endian)
+    else:
+        tiff += build_ifd(ifd0, len(tiff), endian=endian)
+
+    payload = EXIF_HEADER + tiff
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def make_jpeg(dt: Union[datetime, None] = None,
+              dt_orig: Union[datetime, None] = None,
+              model: Union[str, None] = None,
+              image_size: int = 3_000_000,
+              with_exif: bool = True,
+              endian: str = '<') -> bytes:
+    """Build a JPEG-like file: SOI, APP0, APP1 (exif), SOS with random data and EOI.
+
+    The image data is not a decodable picture, but the marker structure is valid, which is all
+    the exif readers look at.
+
+    Args:
+        image_size (int, optional): number of bytes of (fake) image data. Defaults to 3_000_000.
+        with_exif (bool, optional): add the APP1 segment. Defaults to True.
+        endian (str, optional): byte order of the exif data ('<' or '>'). Defaults to '<'.
+
+    Returns:
+        bytes: file contents
+    """
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    app1 = build_app1(dt, dt_orig, model, endian) if with_exif else b''
+    sos = b'\xff\xda' + struct.pack('>H', 8) + b'\x01\x01\x00\x00\x3f\x00'
+    # avoid 0xFF in the scan data so no markers are created by accident
+    scan = random.randbytes(image_size).replace(b'\xff', b'\x00')
+    return JPEG_SOI + app0 + app1 + sos + scan + b'\xff\xd9'
+
+
+def write_corpus(target_dir: str, amount: int, image_size: int = 3_000_000,
+                 seed: int = 0) -> List[str]:
+    """Write amount of synthetic JPEG files to target_dir.
+
+    Args:
+        target_dir (str): directory to write to (created if it doesn't exist)
+        amount (int): number of files
+        image_size (int, optional): bytes of image data per file. Defaults to 3_000_000.
+        seed (int, optional): random seed, for reproducible corpora. Defaults to 0.
+
+    Returns:
+        List[str]: full paths of the generated files
+    """
+    random.seed(seed)
+    os.makedirs(target_dir, exist_ok=True)
+    paths = []
+    for idx in range(amount):
+        dt = datetime(2020, 1, 1) + (datetime(2021, 1, 1) - datetime(2020, 1, 1)) * random.random()
+        dt = dt.replace(microsecond=0)
+        path = os.path.join(target_dir, 'IMG_{:06d}.jpg'.format(idx))
+        with open(path, 'wb') as file:
+            file.write(make_jpeg(dt, dt, 'moto g(8) plus', image_size))
+        paths.append(path)
+    return paths
+
+
+def library_dir(root: str, dir_index: int, depth: int, fanout: int) -> str:
+    """Path of the dir_index-th directory of a tree with depth levels of fanout subdirectories."""
+    parts = ['d{}'.format((dir_index // fanout**level) % fanout) for level in range(depth)]
+    return os.path.join(root, *reversed(parts))
+
+
+def generate_library(root: str,
+                     amount: int,
+                     depth: int = 2,
+                     fanout: int = 10,
+                     files_per_dir: int = 100,
+                     jpeg_share: float = 0.1,
+                     whatsapp_share: float = 0.1,
+                     no_exif_share: float = 0.05,
+                     burst_share: float = 0.1,
+                     mismatch_share: float = 0.05,
+                     image_size: int = 100_000,
+                     seed: int = 0) -> Dict[str, int]:
+    """Write a synthetic photo library to root.
+
+    Files are spread over a tree of depth levels with fanout subdirectories per level,
+    files_per_dir files per directory. The shares are the fraction of files that:
+    - jpeg_share: have a .jpeg instead of a .jpg extension
+    - whatsapp_share: are WhatsApp pictures (IMG-YYYYMMDD-WAnnnn.jpg, without exif)
+    - no_exif_share: have no exif data (and are not WhatsApp pictures)
+    - burst_share: were taken in the same second as the previous picture (_COPY[n] names)
+    - mismatch_share: have a datetime that doesn't match datetime_original
+
+    Args:
+        root (str): directory to write to
+        amount (int): number of files
+        image_size (int, optional): bytes of image data per file. Defaults to 100_000.
+        seed (int, optional): random seed, the same arguments give the same library.
+                              Defaults to 0.
+
+    Returns:
+        Dict[str, int]: number of files of each kind
+    """
+    rng = random.Random(seed)
+    random.seed(seed)  # make_jpeg uses the module level random for the image data
+    kinds = {'normal': 0, 'jpeg': 0, 'whatsapp': 0, 'no_exif': 0, 'burst': 0, 'mismatch': 0}
+    dt = datetime(2015, 1, 1)
+    for idx in range(amount):
+        directory = library_dir(root, idx // files_per_dir, depth, fanout)
+        if idx % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        ext = '.jpg'
+        if rng.random() < jpeg_share:
+            ext = '.jpeg'
+            kinds['jpeg'] += 1
+
+        kind = rng.random()
+        if kind < whatsapp_share:
+            kinds['whatsapp'] += 1
+            name = 'IMG-{}-WA{:04d}.jpg'.format(dt.strftime('%Y%m%d'), idx % 3600)
+            data = make_jpeg(with_exif=False, image_size=image_size)
+        elif kind < whatsapp_share + no_exif_share:
+            kinds['no_exif'] += 1
+            name = 'IMG_{:07d}{}'.format(idx, ext)
+            data = make_jpeg(with_exif=False, image_size=image_size)
+        else:
+            if rng.random() < burst_share:
+                kinds['burst'] += 1
+            else:
+                kinds['normal'] += 1
+                dt += timedelta(seconds=rng.randint(1, 36000))
+            dt_orig = dt
+            if rng.random() < mismatch_share:
+                kinds['mismatch'] += 1
+                dt_orig = dt - timedelta(hours=1)
+            name = 'IMG_{:07d}{}'.format(idx, ext)
+            data = make_jpeg(dt, dt_orig, 'moto g(8) plus', image_size)
+        with open(os.path.join(directory, name), 'wb') as file:
+            file.write(data)
+    return kinds
+
+
+def box(box_type: bytes, payload: bytes) -> bytes:
+    """Build an ISO base media box."""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def make_mp4(creation_time: Union[datetime, None] = None,
+             model: Union[str, None] = None,
+             creationdate: Union[str, None] = None,
+             media_size: int = 1_000_000,
+             moov_first: bool = False) -> bytes:
+    """Build an MP4/MOV-like file: ftyp, mdat with random data and moov with the metadata.
+
+    Args:
+        creation_time (Union[datetime, None], optional): mvhd creation time (aware datetime, or
+                                                         naive in UTC). Defaults to None.
+        model (Union[str, None], optional): com.apple.quicktime.model. Defaults to None.
+        creationdate (Union[str, None], optional): com.apple.quicktime.creationdate, i.e.
+                                                   '2019-08-13T11:41:18+0200'. Defaults to None.
+        media_size (int, optional): bytes in mdat. Defaults to 1_000_000.
+        moov_first (bool, optional): put moov before mdat (a 'fast start' file), phones put it
+                                     at the end. Defaults to False.
+
+    Returns:
+        bytes: file contents
+    """
+    seconds = 0
+    if creation_time:
+        if creation_time.tzinfo is None:
+            creation_time = creation_time.replace(tzinfo=timezone.utc)
+        seconds = int((creation_time - datetime(1904, 1, 1, tzinfo=timezone.utc)).total_seconds())
+    mvhd = box(b'mvhd', struct.pack('>IIIII', 0, seconds, seconds, 1000, 0) + bytes(80))
+    quicktime = {'com.apple.quicktime.model': model,
+                 'com.apple.quicktime.creationdate': creationdate}
+    quicktime = {key: value for key, value in quicktime.items() if value is not None}
+    children = mvhd
+    if quicktime:
+        keys = b''.join(box(b'mdta', key.encode()) for key in quicktime)
+        ilst = b''.join(
+            box(struct.pack('>I', index), box(b'data', struct.pack('>II', 1, 0) + value.encode()))
+            for index, value in enumerate(quicktime.values(), 1))
+        children += box(b'meta', box(b'hdlr', bytes(24)) +
+                        box(b'keys', struct.pack('>II', 0, len(quicktime)) + keys) +
+                        box(b'ilst', ilst))
+    moov = box(b'moov', children)
+    mdat = box(b'mdat', random.randbytes(media_size))
+    ftyp = box(b'ftyp', b'qt  ' + bytes(4) + b'qt  ')
+    return ftyp + (moov + mdat if moov_first else mdat + moov)
+
+
+def make_heic(dt: Union[datetime, None] = None,
+              dt_orig: Union[datetime, None] = None,
+              model: Union[str, None] = None,
+              image_size: int = 1_000_000,
+              endian: str = '<') -> bytes:
+    """Build a HEIC-like file: ftyp, meta with an image and an Exif item, mdat with both.
+
+    The image item is random data, not a decodable picture. endian is the byte order of the
+    exif data ('<' or '>').
+
+    Returns:
+        bytes: file contents
+    """
+    exif = struct.pack('>I', 6) + build_app1(dt, dt_orig, model, endian)[4:]  # 'Exif\0\0' + TIFF
+    image = random.randbytes(image_size)
+    ftyp = box(b'ftyp', b'heic' + bytes(4) + b'mif1heic')
+    iinf = box(b'iinf', struct.pack('>IH', 0, 2) +
+               box(b'infe', struct.pack('>IHH', 2 << 24, 1, 0) + b'hvc1' + b'\x00') +
+               box(b'infe', struct.pack('>IHH', 2 << 24, 2, 0) + b'Exif' + b'\x00'))
+
+    def meta(image_offset: int, exif_offset: int) -> bytes:
+        # iloc version 0, 4 byte offsets and lengths, no base offset
+        iloc = box(b'iloc', struct.pack('>IBBH', 0, 0x44, 0x00, 2) +
+                   struct.pack('>HHHII', 1, 0, 1, image_offset, len(image)) +
+                   struct.pack('>HHHII', 2, 0, 1, exif_offset, len(exif)))
+        return box(b'meta', bytes(4) + box(b'hdlr', bytes(4) + bytes(4) + b'pict' + bytes(13)) +
+                   box(b'pitm', struct.pack('>IH', 0, 1)) + iinf + iloc)
+
+    # the size of meta doesn't depend on the offsets, so it can be built twice
+    mdat_offset = len(ftyp) + len(meta(0, 0)) + 8
+    return (ftyp + meta(mdat_offset, mdat_offset + len(image)) + box(b'mdat', image + exif))
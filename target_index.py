@@ -0,0 +1,139 @@
+"""In-memory index of the target directories.
+
+Each target directory (YYYY/MM) is listed once, the first time a file is moved to it. After that,
+checking if a filename is taken, finding the next free _COPY[n] name and checking if the
+directory exists are done in memory instead of with a stat per check.
+
+The index assumes this process is the only one adding files to the target directories (in a
+sharded run: while it owns the directory, see work_ledger).
+
+With max_names, the listings of the least recently used directories are dropped when the index
+holds more names, so memory doesn't grow with the size of the target. A dropped directory is
+listed again when it is needed. That is only correct if every name added to the index exists on
+disk: directories with names that are reserved for files that are moved later are pinned until
+the moves are done (--async). Plans reserve every name until the plan is executed, so they use an
+unbounded index.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Dict, Set, Union
+
+import metrics
+
+
+class TargetIndex:
+    def __init__(self, max_names: Union[int, None] = None):
+        """Create an empty index.
+
+        Args:
+            max_names (Union[int, None], optional): number of names to keep in memory (at least
+                                                    the names of the directory in use). None to
+                                                    keep every directory. Defaults to None.
+        """
+        self.max_names = max_names
+        # directory -> names of its entries, least recently used first
+        self._names: Dict[str, Set[str]] = OrderedDict()
+        self._missing: Set[str] = set()  # directories that don't exist (yet)
+        # directory -> copy filename pattern -> last used counter
+        self._last_copy: Dict[str, Dict[str, int]] = {}
+        self._count = 0  # names in the index
+        self._pinned: Dict[str, int] = {}  # directory -> reserved names not on disk yet
+        self.loaded_dirs = 0
+
+    def names(self, directory: str) -> Set[str]:
+        """Names in directory, listing the directory if it is not in the index yet."""
+        names = self._names.get(directory)
+        if names is None:
+            try:
+                with os.scandir(directory) as entries:
+                    names = {entry.name for entry in entries}
+            except FileNotFoundError:
+                names = set()
+                self._missing.add(directory)
+            self._names[directory] = names
+            self._count += len(names)
+            self.loaded_dirs += 1
+            if self.max_names is not None:
+                self._evict()
+        elif self.max_names is not None:
+            self._names.move_to_end(directory)
+        return names
+
+    def exists(self, path: str) -> bool:
+        """Check if path exists in the (indexed) target directory."""
+        directory, name = os.path.split(path)
+        return name in self.names(directory)
+
+    def makedirs(self, directory: str) -> None:
+        """Create directory if it doesn't exist yet."""
+        with metrics.timed('makedirs'):
+            self.names(directory)
+            if directory in self._missing:
+                os.makedirs(directory, exist_ok=True)
+                self._missing.discard(directory)
+
+    def add(self, path: str) -> None:
+        """Register a file that has been added to the target."""
+        directory, name = os.path.split(path)
+        names = self.names(directory)
+        if name not in names:
+            names.add(name)
+            self._count += 1
+            if self.max_names is not None:
+                self._evict()
+
+    def remove(self, path: str) -> None:
+        """Register a file that has been removed from the target."""
+        directory, name = os.path.split(path)
+        names = self.names(directory)
+        if name in names:
+            names.discard(name)
+            self._count -= 1
+
+    def pin(self, directory: str) -> None:
+        """Keep directory in the index: a name has been added for a file that is not moved yet."""
+        self._pinned[directory] = self._pinned.get(directory, 0) + 1
+
+    def unpin(self, directory: str) -> None:
+        """The file a pin was made for has been moved (or its name removed)."""
+        self._pinned[directory] -= 1
+        if not self._pinned[directory]:
+            del self._pinned[directory]
+
+    def forget(self, directory: str) -> None:
+        """Drop directory from the index, so it is listed again (i.e. after another process
+        may have added files to it)."""
+        self._count -= len(self._names.pop(directory, ()))
+        self._missing.discard(directory)
+        self._last_copy.pop(directory, None)
+
+    def next_free_copy(self, copy_filename: str) -> str:
+        """Find the first free name for copy_filename, formatted with an increasing counter.
+
+        The last used counter is remembered per copy_filename, so a burst of pictures with the
+        same base filename doesn't check the same taken names over and over again.
+
+        Args:
+            copy_filename (str): full path with a '{}' placeholder for the counter
+
+        Returns:
+            str: copy_filename formatted with the first free counter
+        """
+        last_copy = self._last_copy.setdefault(os.path.dirname(copy_filename), {})
+        counter = last_copy.get(copy_filename, 0) + 1
+        while self.exists(copy_filename.format(counter)):
+            counter += 1
+        last_copy[copy_filename] = counter
+        return copy_filename.format(counter)
+
+    def _evict(self) -> None:
+        """Forget the least recently used directories until at most max_names are indexed."""
+        if self._count <= self.max_names:
+            return
+        # the most recently used directory (the one in use) and pinned ones are never dropped
+        for directory in list(self._names)[:-1]:
+            if directory not in self._pinned:
+                self.forget(directory)
+                if self._count <= self.max_names:
+                    return
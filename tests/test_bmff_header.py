@@ -0,0 +1,65 @@
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+from bmff_header import EXIF_DT_FORMAT, read_bmff_header
+from exif_header import HeaderParseError, read_exif_header
+from synthetic_library import make_heic, make_jpeg, make_mp4
+
+CREATION_TIME = datetime(2019, 8, 13, 9, 41, 18, tzinfo=timezone.utc)
+
+
+def read(data: bytes) -> dict:
+    return read_bmff_header(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('moov_first', [False, True])
+def test_mvhd_creation_time(moov_first):
+    tags = read(make_mp4(CREATION_TIME, media_size=1000, moov_first=moov_first))
+    local = CREATION_TIME.astimezone().strftime(EXIF_DT_FORMAT)  # mvhd is UTC
+    assert tags == {'datetime': local, 'datetime_original': local, 'model': None}
+
+
+def test_quicktime_metadata():
+    tags = read(make_mp4(CREATION_TIME, model='iPhone 11', creationdate='2019-08-13T11:41:18+0200',
+                         media_size=1000))
+    assert tags == {'datetime': '2019:08:13 11:41:18', 'datetime_original': '2019:08:13 11:41:18',
+                    'model': 'iPhone 11'}
+
+
+def test_no_creation_time():
+    assert read(make_mp4(media_size=1000)) == {'datetime': None, 'datetime_original': None,
+                                               'model': None}
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_heic_exif_item(endian):
+    dt, dt_orig = datetime(2021, 6, 5, 10, 11, 12), datetime(2021, 6, 5, 10, 11, 11)
+    jpeg = make_jpeg(dt, dt_orig, 'iPhone 12', image_size=1000, endian=endian)
+    heic = make_heic(dt, dt_orig, 'iPhone 12', image_size=1000, endian=endian)
+    assert read(heic) == read_exif_header(io.BytesIO(jpeg))
+
+
+def test_not_an_iso_base_media_file():
+    with pytest.raises(HeaderParseError):
+        read(make_jpeg(image_size=1000))
+
+
+def test_video_without_moov():
+    # still being recorded: the moov box is written last
+    data = make_mp4(CREATION_TIME, model='iPhone 11', media_size=1000)
+    with pytest.raises(HeaderParseError):
+        read(data[:data.index(b'moov') - 4])
+
+
+@pytest.mark.parametrize('data', [
+    make_mp4(CREATION_TIME, model='iPhone 11', creationdate='2019-08-13T11:41:18+0200',
+             media_size=100),
+    make_heic(datetime(2021, 6, 5, 10, 11, 12), None, 'iPhone 12', image_size=100),
+    make_heic(datetime(2021, 6, 5, 10, 11, 12), None, 'iPhone 12', image_size=100, endian='>'),
+], ids=['mp4', 'heic-le', 'heic-be'])
+def test_truncated_file(data):
+    for size in range(len(data)):
+        with pytest.raises(HeaderParseError):
+            read(data[:size])
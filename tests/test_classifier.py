@@ -0,0 +1,58 @@
+import re
+from datetime import datetime
+
+import pytest
+
+from classifier import Classification, Classifier, trie_regex
+
+
+@pytest.mark.parametrize('name, ext', [
+    ('IMG_1234.jpg', '.jpg'),
+    ('IMG_1234.JPG', '.jpg'),
+    ('clip.Mov', '.mov'),
+    ('IMG_1234.HEIC', '.heic'),
+    ('notes.txt', None),
+    ('jpg', None),
+    ('archive.jpg.zip', None),
+])
+def test_extension(name, ext):
+    assert Classifier().extension(name) == ext
+
+
+def test_include_patterns():
+    classifier = Classifier(include=['DSC*.ARW', 'IMG_*', '*.dng'])
+    assert classifier.extension('DSC01234.ARW') == '.arw'
+    assert classifier.extension('DSC01234.arw') is None  # patterns are case sensitive
+    assert classifier.extension('XYZ01234.ARW') is None
+    assert classifier.extension('IMG_0001.CR2') == '.cr2'  # no literal extension
+    assert classifier.extension('holiday.dng') == '.dng'
+    assert classifier.extension('holiday.tif') is None
+
+
+def test_messenger_names():
+    classifier = Classifier()
+    assert classifier.classify('IMG-20181108-WA0025.jpg') == Classification(
+        '.jpg', 'whatsapp', datetime(2018, 11, 8, 0, 0, 25), ())
+    assert classifier.classify('VID-20181108-WA0125.mp4').messenger_dt == datetime(
+        2018, 11, 8, 0, 2, 5)
+    assert classifier.classify('signal-2020-01-31-123456.jpg') == Classification(
+        '.jpg', 'signal', datetime(2020, 1, 31, 12, 34, 56), ())
+    assert classifier.classify('IMG-20181308-WA0025.jpg') == Classification(
+        '.jpg', 'whatsapp', None, ())  # not a valid date
+    assert classifier.classify('IMG_20181108_123456.jpg').messenger is None
+
+
+def test_keywords_in_configured_order():
+    classifier = Classifier(keywords=['HDR', 'COVER', 'OVER', 'HOT'])
+    assert classifier.classify('OVER_HDR_COVER.jpg').keywords == ('HDR', 'COVER', 'OVER')
+    assert classifier.classify('hdr.jpg').keywords == ()  # keywords are case sensitive
+    assert classifier.classify('notes.txt') is None
+
+
+def test_trie_regex():
+    words = ['HDR', 'HOT', 'H', 'PANO', 'PAN']
+    regex = re.compile(trie_regex(words))
+    for word in words:
+        assert regex.fullmatch(word)
+    for other in ['HD', 'HO', 'PA', 'PANOS', '']:
+        assert not regex.fullmatch(other)
@@ -0,0 +1,95 @@
+import io
+import struct
+from datetime import datetime
+
+import exif
+import pytest
+
+from exif_header import (EXIF_HEADER, TAG_DATETIME, TAG_MODEL, TIFF_READ_SIZE, TYPE_ASCII,
+                         HeaderParseError, read_exif_header, read_tiff_header)
+from synthetic_library import build_app1, build_ifd, make_jpeg
+
+DT = datetime(2019, 8, 13, 11, 41, 18)
+DT_ORIG = datetime(2019, 8, 13, 11, 41, 17)
+TAG_SETS = [
+    (DT, DT_ORIG, 'ILCE-7M3'),
+    (DT, None, 'Pixel'),  # model short enough to be stored in the entry itself
+    (None, DT_ORIG, None),
+    (None, None, None),
+]
+
+
+def exif_image_tags(data: bytes) -> dict:
+    """The tags as read by exif.Image, which parses the complete file."""
+    image = exif.Image(data)
+    if not image.has_exif:
+        return {'datetime': None, 'datetime_original': None, 'model': None}
+    return {key: image.get(key) for key in ('datetime', 'datetime_original', 'model')}
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('dt, dt_orig, model', TAG_SETS)
+def test_same_tags_as_exif_image(endian, dt, dt_orig, model):
+    data = make_jpeg(dt, dt_orig, model, image_size=1000, endian=endian)
+    assert read_exif_header(io.BytesIO(data)) == exif_image_tags(data)
+
+
+def test_no_app1_segment():
+    data = make_jpeg(image_size=1000, with_exif=False)
+    assert read_exif_header(io.BytesIO(data)) == {'datetime': None, 'datetime_original': None,
+                                                  'model': None}
+
+
+def test_not_a_jpeg():
+    with pytest.raises(HeaderParseError):
+        read_exif_header(io.BytesIO(b'\x89PNG\r\n\x1a\n' + bytes(100)))
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_truncated_header(endian):
+    data = make_jpeg(DT, DT_ORIG, 'ILCE-7M3', image_size=1000, endian=endian)
+    header_size = data.index(b'\xff\xda')  # start of the image data
+    for size in range(header_size):
+        with pytest.raises(HeaderParseError):
+            read_exif_header(io.BytesIO(data[:size]))
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_truncated_tiff_structure(endian):
+    # a valid APP1 segment whose TIFF structure is cut off: offsets point past its end
+    tiff = build_app1(DT, DT_ORIG, 'ILCE-7M3', endian)[4 + len(EXIF_HEADER):]
+    for size in range(len(tiff)):
+        payload = EXIF_HEADER + tiff[:size]
+        app1 = b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+        with pytest.raises(HeaderParseError):
+            read_exif_header(io.BytesIO(b'\xff\xd8' + app1 + b'\xff\xda'))
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+@pytest.mark.parametrize('dt, dt_orig, model', TAG_SETS)
+def test_tiff_header(endian, dt, dt_orig, model):
+    # a TIFF based raw file is the TIFF structure of the APP1 segment on its own
+    data = make_jpeg(dt, dt_orig, model, image_size=1000, endian=endian)
+    tiff = build_app1(dt, dt_orig, model, endian)[4 + len(EXIF_HEADER):]
+    assert read_tiff_header(io.BytesIO(tiff + bytes(1000))) == exif_image_tags(data)
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_tiff_tags_beyond_first_read(endian):
+    ifd0_offset = 3 * TIFF_READ_SIZE
+    header = (b'II' if endian == '<' else b'MM') + struct.pack(endian + 'HI', 42, ifd0_offset)
+    ifd0 = build_ifd([(TAG_MODEL, TYPE_ASCII, b'ILCE-7M3\x00'),
+                      (TAG_DATETIME, TYPE_ASCII, b'2019:08:13 11:41:18\x00')], ifd0_offset,
+                     endian=endian)
+    tiff = header + bytes(ifd0_offset - len(header)) + ifd0
+    assert read_tiff_header(io.BytesIO(tiff)) == {'datetime': '2019:08:13 11:41:18',
+                                                  'datetime_original': None,
+                                                  'model': 'ILCE-7M3'}
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_truncated_tiff_file(endian):
+    tiff = build_app1(DT, DT_ORIG, 'ILCE-7M3', endian)[4 + len(EXIF_HEADER):]
+    for size in range(len(tiff)):
+        with pytest.raises(HeaderParseError):
+            read_tiff_header(io.BytesIO(tiff[:size]))
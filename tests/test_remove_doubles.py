@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+from dedup import CHUNK_SIZE, Deduplicator, append_double
+from metadata_cache import MetadataCache
+from remove_doubles import (DIFFERENT, GONE, KEPT_MISSING, RECLAIMED, UNVERIFIED, VERIFIED,
+                            read_doubles, reclaim)
+
+
+def write(path, data: bytes) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def doubles(tmp_path):
+    """A doubles list with a kept file and a double per case."""
+    data = os.urandom(3 * CHUNK_SIZE)
+    src, target = tmp_path / 'src', tmp_path / 'target'
+    files = {
+        'identical': (data, data),
+        'last_byte': (data[:-1] + bytes([data[-1] ^ 1]), data),
+        'middle_byte': (data[:len(data) // 2] + bytes([data[len(data) // 2] ^ 1])
+                        + data[len(data) // 2 + 1:], data),  # not in the quick hash
+        'size': (data + b'\x00', data),
+    }
+    paths = {}
+    list_filename = str(tmp_path / 'doubles.list')
+    for name, (double, kept) in files.items():
+        paths[name] = (write(src / f'{name}.jpg', double), write(target / f'{name}.jpg', kept))
+        append_double(list_filename, *paths[name])
+    paths['kept_missing'] = (write(src / 'kept_missing.jpg', data), str(target / 'missing.jpg'))
+    append_double(list_filename, *paths['kept_missing'])
+    paths['gone'] = (str(src / 'gone.jpg'), paths['identical'][1])
+    append_double(list_filename, *paths['gone'])
+    paths['hard_link'] = (write(src / 'hard_link.jpg', data), str(target / 'hard_link.jpg'))
+    os.link(paths['hard_link'][0], paths['hard_link'][1])
+    append_double(list_filename, *paths['hard_link'])
+    paths['unverified'] = (write(src / 'unverified.jpg', data), None)
+    with open(list_filename, 'a') as file:  # written by an older version: no kept file
+        file.write(paths['unverified'][0] + '\n')
+    return list_filename, paths
+
+
+def test_only_identical_doubles_are_removed(doubles):
+    list_filename, paths = doubles
+    stats = reclaim(list_filename, Deduplicator(), jobs=2)
+    assert (stats[RECLAIMED], stats[DIFFERENT], stats[KEPT_MISSING], stats[GONE],
+            stats[UNVERIFIED]) == (1, 4, 1, 1, 1)
+    assert stats['bytes'] == os.path.getsize(paths['identical'][1])
+    for name, (src_file, kept_file) in paths.items():
+        assert os.path.exists(src_file) == (name not in ('identical', 'gone')), name
+        if kept_file and name != 'kept_missing':
+            assert os.path.exists(kept_file), name
+    remaining = read_doubles(list_filename)
+    assert paths['identical'][0] not in remaining
+    assert paths['gone'][0] not in remaining
+    assert remaining[paths['middle_byte'][0]] == paths['middle_byte'][1]
+    assert remaining[paths['unverified'][0]] is None
+
+
+def test_dry_run(doubles):
+    list_filename, paths = doubles
+    with open(list_filename) as file:
+        before = file.read()
+    stats = reclaim(list_filename, Deduplicator(), dry_run=True)
+    assert (stats[VERIFIED], stats[RECLAIMED]) == (1, 0)
+    assert all(os.path.exists(src_file) for name, (src_file, _) in paths.items() if name != 'gone')
+    with open(list_filename) as file:
+        assert file.read() == before
+
+
+def test_trash(doubles, tmp_path):
+    list_filename, paths = doubles
+    trash = tmp_path / 'trash'
+    stats = reclaim(list_filename, Deduplicator(), trash_dir=str(trash))
+    assert stats[RECLAIMED] == 1
+    src_file = paths['identical'][0]
+    assert not os.path.exists(src_file)
+    moved = os.path.join(trash, os.path.splitdrive(src_file)[1].lstrip(os.sep))
+    with open(moved, 'rb') as moved_file, open(paths['identical'][1], 'rb') as kept_file:
+        assert moved_file.read() == kept_file.read()
+
+
+def test_changed_double_is_not_removed_with_cached_hashes(tmp_path):
+    data = os.urandom(3 * CHUNK_SIZE)
+    src_file = write(tmp_path / 'src' / 'a.jpg', data)
+    kept_file = write(tmp_path / 'target' / 'a.jpg', data)
+    list_filename = str(tmp_path / 'doubles.list')
+    append_double(list_filename, src_file, kept_file)
+    cache = MetadataCache(str(tmp_path / 'cache.sqlite'))
+    try:
+        assert reclaim(list_filename, Deduplicator(cache=cache), dry_run=True)[VERIFIED] == 1
+        # same size, but different content: the cached hashes are not valid anymore
+        middle = len(data) // 2
+        write(src_file, data[:middle] + bytes([data[middle] ^ 1]) + data[middle + 1:])
+        stat = os.stat(src_file)
+        os.utime(src_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        stats = reclaim(list_filename, Deduplicator(cache=cache))
+    finally:
+        cache.close()
+    assert (stats[DIFFERENT], stats[RECLAIMED]) == (1, 0)
+    assert os.path.exists(src_file)
@@ -0,0 +1,112 @@
+import os
+
+from target_index import TargetIndex
+
+
+def make_dir(root, name: str, files: int = 0) -> str:
+    directory = os.path.join(root, name)
+    os.makedirs(directory)
+    for idx in range(files):
+        open(os.path.join(directory, f'{idx}.jpg'), 'w').close()
+    return directory
+
+
+def test_lists_directory_once(tmp_path):
+    directory = make_dir(tmp_path, '2020/01', files=2)
+    index = TargetIndex()
+    assert index.exists(os.path.join(directory, '0.jpg'))
+    assert not index.exists(os.path.join(directory, '2.jpg'))
+    index.add(os.path.join(directory, '2.jpg'))
+    assert index.exists(os.path.join(directory, '2.jpg'))
+    index.remove(os.path.join(directory, '0.jpg'))
+    assert not index.exists(os.path.join(directory, '0.jpg'))
+    assert index.loaded_dirs == 1
+
+
+def test_makedirs(tmp_path):
+    directory = os.path.join(tmp_path, '2020', '02')
+    index = TargetIndex()
+    assert not index.exists(os.path.join(directory, 'a.jpg'))
+    index.makedirs(directory)
+    assert os.path.isdir(directory)
+
+
+def test_next_free_copy(tmp_path):
+    directory = make_dir(tmp_path, '2020/03')
+    for name in ('a_COPY[1].jpg', 'a_COPY[2].jpg'):
+        open(os.path.join(directory, name), 'w').close()
+    index = TargetIndex()
+    copy_filename = os.path.join(directory, 'a_COPY[{}].jpg')
+    assert index.next_free_copy(copy_filename) == copy_filename.format(3)
+    index.add(copy_filename.format(3))
+    assert index.next_free_copy(copy_filename) == copy_filename.format(4)
+
+
+def test_forget_lists_again(tmp_path):
+    directory = make_dir(tmp_path, '2020/04')
+    index = TargetIndex()
+    assert not index.exists(os.path.join(directory, 'new.jpg'))
+    open(os.path.join(directory, 'new.jpg'), 'w').close()  # added by another process
+    index.forget(directory)
+    assert index.exists(os.path.join(directory, 'new.jpg'))
+    assert index.loaded_dirs == 2
+
+
+def test_evicts_least_recently_used(tmp_path):
+    dirs = [make_dir(tmp_path, f'2020/{month:02}', files=3) for month in range(1, 4)]
+    index = TargetIndex(max_names=6)
+    index.exists(os.path.join(dirs[0], 'x.jpg'))
+    index.exists(os.path.join(dirs[1], 'x.jpg'))
+    index.exists(os.path.join(dirs[0], 'x.jpg'))  # dirs[1] is the least recently used now
+    index.exists(os.path.join(dirs[2], 'x.jpg'))
+    assert index.loaded_dirs == 3
+    index.exists(os.path.join(dirs[0], 'x.jpg'))
+    assert index.loaded_dirs == 3  # still indexed
+    index.exists(os.path.join(dirs[1], 'x.jpg'))
+    assert index.loaded_dirs == 4  # listed again
+
+
+def test_never_evicts_directory_in_use(tmp_path):
+    small = make_dir(tmp_path, '2020/01', files=1)
+    large = make_dir(tmp_path, '2020/02', files=10)
+    index = TargetIndex(max_names=5)
+    index.exists(os.path.join(small, 'x.jpg'))
+    for idx in range(10, 20):  # more names than max_names in one directory
+        index.add(os.path.join(large, f'{idx}.jpg'))
+    assert index.loaded_dirs == 2
+    for idx in range(20):
+        assert index.exists(os.path.join(large, f'{idx}.jpg'))
+    assert index.loaded_dirs == 2
+
+
+def test_never_evicts_pinned_directory(tmp_path):
+    pinned = make_dir(tmp_path, '2020/01', files=1)
+    others = [make_dir(tmp_path, f'2021/{month:02}', files=3) for month in range(1, 13)]
+    index = TargetIndex(max_names=4)
+    reserved = os.path.join(pinned, 'reserved.jpg')  # not on disk until it is moved
+    index.add(reserved)
+    index.pin(pinned)
+    for directory in others:
+        index.exists(os.path.join(directory, 'x.jpg'))
+    assert index.exists(reserved)
+    assert index.loaded_dirs == 1 + len(others)  # pinned was never listed again
+
+    index.unpin(pinned)
+    for directory in others[:2]:
+        index.forget(directory)
+        index.exists(os.path.join(directory, 'x.jpg'))
+    assert not index.exists(reserved)  # dropped and listed again: the name is not on disk
+
+
+def test_pins_are_counted(tmp_path):
+    pinned = make_dir(tmp_path, '2020/01', files=1)
+    others = [make_dir(tmp_path, f'2021/{month:02}', files=3) for month in range(1, 4)]
+    index = TargetIndex(max_names=4)
+    index.add(os.path.join(pinned, 'a.jpg'))
+    index.pin(pinned)
+    index.add(os.path.join(pinned, 'b.jpg'))
+    index.pin(pinned)
+    index.unpin(pinned)  # a.jpg moved, b.jpg not yet
+    for directory in others:
+        index.exists(os.path.join(directory, 'x.jpg'))
+    assert index.exists(os.path.join(pinned, 'b.jpg'))
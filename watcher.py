@@ -0,0 +1,210 @@
+"""Find new files in the source tree as they arrive, for --watch.
+
+InotifyWatcher gets events from the kernel (Linux only, through libc with ctypes), PollingWatcher
+is the fallback for other platforms and for mounts that don't send inotify events (i.e. FUSE
+mounts like pCloud Drive). Both return paths of files that may be new; Debouncer holds them until
+they are completely written.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from exif_header import HeaderParseError, read_exif_header
+from photo_renamer import METADATA_READERS
+from scan_state import ScanState
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+READ_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    def __init__(self, root: str, is_match: Callable[[str], bool], logger: logging.Logger):
+        """Watch root and all its subdirectories.
+
+        Args:
+            root (str): directory to watch
+            is_match (Callable[[str], bool]): returns True for the (full) paths to report
+            logger (logging.Logger): where to log to
+
+        Raises:
+            OSError: if inotify is not available, or a directory can't be watched (i.e. the
+                     fs.inotify.max_user_watches limit is reached)
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.is_match = is_match
+        self.logger = logger
+        self.overflowed = False  # events were lost, a sweep is needed
+        self.initial_files: List[str] = []  # matching files when the watcher was started
+        self._dirs: Dict[int, str] = {}  # watch descriptor -> directory
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        try:
+            self.initial_files = self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, root: str) -> List[str]:
+        """Watch root and its subdirectories.
+
+        Returns:
+            List[str]: matching files already in the directories (they may have been created
+                       before the watch was in place)
+        """
+        matches = []
+        for path, _, files in os.walk(root):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path),
+                                              WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f'Could not watch "{path}"')
+            self._dirs[wd] = path
+            matches.extend(file for file in (os.path.join(path, name) for name in files)
+                           if self.is_match(file))
+        return matches
+
+    def changed_files(self, timeout: float) -> List[str]:
+        """Wait at most timeout seconds for events, return the files they are about."""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:
+                                    offset + EVENT_HEADER.size + length].rstrip(b'\x00'))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif mask & IN_IGNORED:
+                self._dirs.pop(wd, None)  # directory removed (or moved out of the tree)
+            elif wd in self._dirs:
+                path = os.path.join(self._dirs[wd], name)
+                if mask & IN_ISDIR:
+                    try:
+                        changed.extend(self.add_tree(path))
+                    except OSError as err:
+                        self.logger.warning('Could not watch new directory "%s": %s', path, err)
+                        self.overflowed = True
+                elif self.is_match(path):
+                    changed.append(path)
+        return changed
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    def __init__(self,
+                 root: str,
+                 scan: Callable[[str, ScanState], Iterator[str]],
+                 interval: float):
+        """Find new files by listing the directories whose mtime changed since the last poll.
+
+        Args:
+            root (str): directory to watch
+            scan (Callable[[str, ScanState], Iterator[str]]): scan function (i.e. a partial of
+                                                              sort_them.scan_directory)
+            interval (float): seconds between two polls
+        """
+        self.root = root
+        self.scan = scan
+        self.interval = interval
+        self.overflowed = False
+        self.state = ScanState(None)
+        self._next_poll = 0
+        self.initial_files = self.poll()
+
+    def poll(self) -> List[str]:
+        """Files in the directories that changed since the previous poll."""
+        self.state.previous, self.state.current = self.state.current, {}
+        self.state.listed = []  # per poll, don't let them grow with every poll
+        self.state.skipped = 0
+        self._next_poll = monotonic() + self.interval
+        return list(self.scan(self.root, self.state))
+
+    def changed_files(self, timeout: float) -> List[str]:
+        """Wait at most timeout seconds, poll if it is time to do so."""
+        wait = self._next_poll - monotonic()
+        if wait > timeout:
+            sleep(timeout)
+            return []
+        sleep(max(wait, 0))
+        return self.poll()
+
+    def close(self) -> None:
+        pass
+
+
+def header_complete(path: str) -> bool:
+    """Check if the header of path can be parsed (i.e. the header has been written)."""
+    reader = METADATA_READERS.get(os.path.splitext(path)[1].lower(), read_exif_header)
+    try:
+        with open(path, 'rb') as file:
+            reader(file)
+    except (HeaderParseError, OSError):
+        return False
+    return True
+
+
+class Debouncer:
+    def __init__(self, settle_s: float, max_wait_s: float):
+        """Hold files until they are completely written.
+
+        A file is ready when its size and mtime didn't change for settle_s seconds and its exif
+        header is complete. Files whose header never gets complete (i.e. not a JPEG after all)
+        are released when they didn't change for max_wait_s seconds.
+
+        Args:
+            settle_s (float): seconds the size and mtime must be stable
+            max_wait_s (float): seconds after which a stable file is ready anyway
+        """
+        self.settle_s = settle_s
+        self.max_wait_s = max_wait_s
+        self.pending: Dict[str, Tuple[int, int, float]] = {}  # path -> size, mtime_ns, since
+
+    def add(self, path: str) -> None:
+        if path not in self.pending:
+            self.pending[path] = (-1, -1, monotonic())
+
+    def ready(self) -> List[str]:
+        """Remove and return the files that are completely written."""
+        now = monotonic()
+        ready = []
+        for path, (size, mtime_ns, since) in list(self.pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self.pending[path]  # removed or renamed before it was complete
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                continue
+            stable_s = now - since
+            if stable_s >= self.max_wait_s or (stable_s >= self.settle_s
+                                               and header_complete(path)):
+                del self.pending[path]
+                ready.append(path)
+        return ready
@@ -0,0 +1,216 @@
+"""Shared work ledger for sharded runs: several workers, on one or more machines, sort one source
+tree together.
+
+The ledger is a SQLite database, i.e. on the target volume. The source tree is divided in shards
+of one directory (its files, not its subdirectories). A worker claims a shard with a lease, lists
+the directory, adds its subdirectories as new shards, processes the files and marks the shard
+done. Leases are renewed by a background thread as long as the worker runs, so the shards of a
+worker that crashed are claimed by another worker when their lease has expired.
+
+Finding a free _COPY[n] name needs the complete content of the target directory, so a worker only
+moves files to a (YYYY/MM) target directory while it holds the lease of that directory.
+
+Shards, target directories and results are stored relative to the source and target root, with
+'/' separators (see to_key), so workers that mount the share at different paths use the same
+keys for the same directories.
+
+SQLite locking on a network share is as reliable as the locking of the file server (NFS needs a
+working lock daemon). The ledger uses a rollback journal (WAL needs shared memory, which doesn't
+work across machines) and short transactions. Leases are compared with the clock of each worker,
+so the clocks of the machines should be in sync (NTP) to well within LEASE_SECONDS.
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Tuple, Union
+
+LEASE_SECONDS = 300  # a shard or target directory is free again this long after a worker died
+RENEW_INTERVAL = 60  # seconds between lease renewals
+BUSY_TIMEOUT = 60  # seconds to wait for the database lock of another worker
+MAX_ATTEMPTS = 3  # a shard that has been claimed this often without finishing is marked failed
+SHARD_PENDING = 'pending'
+SHARD_CLAIMED = 'claimed'
+SHARD_DONE = 'done'
+SHARD_FAILED = 'failed'
+
+
+def to_key(path: str, root: str) -> str:
+    """Key of path in the ledger: relative to root, with '/' separators ('.' for root)."""
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+def from_key(key: str, root: str) -> str:
+    """Local path of a ledger key, below root."""
+    return os.path.normpath(os.path.join(root, *key.split('/')))
+
+
+class WorkLedger:
+    def __init__(self, filename: str, worker: Union[str, None] = None):
+        """Open (or create) the ledger and start renewing the leases of this worker.
+
+        Args:
+            filename (str): sqlite database file, on a volume all workers can reach
+            worker (Union[str, None], optional): name of this worker. Defaults to None, which
+                                                 is hostname:pid.
+        """
+        self.filename = filename
+        self.worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+        self._lock = threading.Lock()  # connection is shared with the renewal thread
+        self._db = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=DELETE')
+        with self._transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS shards ('
+                       'path TEXT PRIMARY KEY, state TEXT, worker TEXT, lease_until REAL, '
+                       'attempts INTEGER DEFAULT 0, files INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS target_dirs ('
+                       'path TEXT PRIMARY KEY, worker TEXT, lease_until REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS results ('
+                       'src TEXT PRIMARY KEY, decision TEXT, target TEXT, worker TEXT)')
+        self._stop = threading.Event()
+        self._renewer = threading.Thread(name='lease_renewer', target=self._renew_leases,
+                                         daemon=True)
+        self._renewer.start()
+
+    def add_shards(self, paths: Iterable[str]) -> None:
+        """Add directories (keys) to process, directories that are in the ledger are ignored."""
+        with self._transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO shards (path, state) VALUES (?, ?)',
+                           ((path, SHARD_PENDING) for path in paths))
+
+    def claim_shard(self) -> Union[str, None]:
+        """Claim a pending shard, or a shard whose lease has expired.
+
+        Returns:
+            Union[str, None]: key of the directory to process, None if no shard can be claimed
+                              now
+        """
+        now = time.time()
+        with self._transaction() as db:
+            # claimed MAX_ATTEMPTS times by workers that died: don't let it kill more workers
+            db.execute('UPDATE shards SET state = ? WHERE state = ? AND lease_until < ? '
+                       'AND attempts >= ?', (SHARD_FAILED, SHARD_CLAIMED, now, MAX_ATTEMPTS))
+            row = db.execute('SELECT path FROM shards WHERE state = ? '
+                             'OR (state = ? AND lease_until < ?) LIMIT 1',
+                             (SHARD_PENDING, SHARD_CLAIMED, now)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE shards SET state = ?, worker = ?, lease_until = ?, '
+                       'attempts = attempts + 1 WHERE path = ?',
+                       (SHARD_CLAIMED, self.worker, now + LEASE_SECONDS, row[0]))
+        return row[0]
+
+    def shards_in_progress(self) -> int:
+        """Number of shards claimed by live workers (they may still add subdirectories)."""
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM shards WHERE state = ? '
+                                    'AND lease_until >= ?',
+                                    (SHARD_CLAIMED, time.time())).fetchone()[0]
+
+    def complete_shard(self, path: str, files: int,
+                       results: Iterable[Tuple[str, str, Union[str, None]]] = (),
+                       failed: bool = False) -> None:
+        """Mark a shard done (or failed) and record the results that have not been recorded yet.
+
+        Args:
+            path (str): key of the directory of the shard
+            files (int): number of files found in it
+            results (Iterable[Tuple[str, str, Union[str, None]]], optional): source file,
+                                                                             decision, target.
+                                                                             Defaults to ().
+            failed (bool, optional): the shard could not be processed. Defaults to False.
+        """
+        with self._transaction() as db:
+            self._record(db, results)
+            db.execute('UPDATE shards SET state = ?, files = ?, lease_until = NULL '
+                       'WHERE path = ? AND worker = ?',
+                       (SHARD_FAILED if failed else SHARD_DONE, files, path, self.worker))
+
+    def acquire_dir(self, path: str) -> bool:
+        """Try to become the owner of a target directory.
+
+        Args:
+            path (str): key of the target directory
+
+        Returns:
+            bool: True if this worker owns the directory now, False if another worker does
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute('INSERT OR IGNORE INTO target_dirs (path) VALUES (?)', (path, ))
+            cursor = db.execute('UPDATE target_dirs SET worker = ?, lease_until = ? '
+                                'WHERE path = ? AND (worker IS NULL OR worker = ? '
+                                'OR lease_until < ?)',
+                                (self.worker, now + LEASE_SECONDS, path, self.worker, now))
+        return cursor.rowcount == 1
+
+    def release_dir(self, path: str,
+                    results: Iterable[Tuple[str, str, Union[str, None]]] = ()) -> bool:
+        """Record the results of the files moved to a target directory and release it.
+
+        Args:
+            path (str): key of the target directory
+            results (Iterable[Tuple[str, str, Union[str, None]]], optional): source file,
+                                                                             decision, target.
+                                                                             Defaults to ().
+
+        Returns:
+            bool: False if the lease had expired and was taken by another worker
+        """
+        with self._transaction() as db:
+            self._record(db, results)
+            cursor = db.execute('UPDATE target_dirs SET worker = NULL, lease_until = NULL '
+                                'WHERE path = ? AND worker = ?', (path, self.worker))
+        return cursor.rowcount == 1
+
+    def summary(self) -> Dict[str, int]:
+        """Number of shards per state and number of files found in them."""
+        with self._lock:
+            rows = self._db.execute('SELECT state, COUNT(*), SUM(files) FROM shards '
+                                    'GROUP BY state').fetchall()
+        summary = {state: count for state, count, _ in rows}
+        summary['files'] = sum(files or 0 for _, _, files in rows)
+        return summary
+
+    def close(self) -> None:
+        """Stop renewing leases and hand back what this worker has not finished."""
+        self._stop.set()
+        self._renewer.join()
+        with self._transaction() as db:
+            db.execute('UPDATE shards SET state = ?, worker = NULL, lease_until = NULL, '
+                       'attempts = attempts - 1 WHERE state = ? AND worker = ?',
+                       (SHARD_PENDING, SHARD_CLAIMED, self.worker))
+            db.execute('UPDATE target_dirs SET worker = NULL, lease_until = NULL '
+                       'WHERE worker = ?', (self.worker, ))
+        with self._lock:
+            self._db.close()
+
+    def _renew_leases(self) -> None:
+        while not self._stop.wait(RENEW_INTERVAL):
+            lease_until = time.time() + LEASE_SECONDS
+            with self._transaction() as db:
+                db.execute('UPDATE shards SET lease_until = ? WHERE state = ? AND worker = ?',
+                           (lease_until, SHARD_CLAIMED, self.worker))
+                db.execute('UPDATE target_dirs SET lease_until = ? WHERE worker = ?',
+                           (lease_until, self.worker))
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run the statements in one transaction, taking the database lock at the start."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _record(self, db: sqlite3.Connection,
+                results: Iterable[Tuple[str, str, Union[str, None]]]) -> None:
+        db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                       ((src, decision, target, self.worker) for src, decision, target in results))